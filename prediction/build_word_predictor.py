@@ -11,6 +11,10 @@ if __name__ == '__main__':
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
+from src.corpus import open_token_corpus, SENTENCE_END
+from src.compression import open_text, find_file
+from src.normalization import normalize
+
 from prediction.trie import Trie
 
 
@@ -42,14 +46,24 @@ def size_to_str(size_bytes: int) -> str:
 
 def build_trie():
     print('Reading words list...')
-    word_size = {}
-    word_freq: dict[str, int] = defaultdict(int)
-    with open(mkpath('../results/word_freq.txt'), 'r', encoding='utf-8') as file:
-        for line in map(str.strip, filter(None, file)):
-            word, freq = line.split()
-            word = word.lower()
-            word_freq[word] += int(freq)
-            word_size[word] = len(word.encode('utf-8'))
+    # Words of the token corpus ids (case-folded), see `src/corpus.py`
+    id_words = ['']
+    with open_text(mkpath('../results/word_freq.txt')) as file:
+        # The whole list is folded in a single pass
+        for line in filter(None, normalize(file.read(), fold_case=True).split('\n')):
+            id_words.append(line.split()[0])
+
+    word_freq: dict[str, int]
+    if os.path.isfile(find_file(mkpath('../results/word_freq_folded.txt'))):
+        # Written by `run.py --case-folded`: case variants are already summed up
+        with open_text(mkpath('../results/word_freq_folded.txt')) as file:
+            word_freq = {word: int(freq) for word, freq in map(str.split, filter(None, map(str.strip, file)))}
+    else:
+        word_freq = defaultdict(int)
+        with open_text(mkpath('../results/word_freq.txt')) as file:
+            for line in map(str.strip, filter(None, file)):
+                word, freq = line.split()
+                word_freq[normalize(word, fold_case=True)] += int(freq)
 
     force_add_words = {word for word, freq in word_freq.items() if freq >= WORD_FREQ_THRESHOLD}
 
@@ -58,10 +72,10 @@ def build_trie():
 
     print('Reading Apertium mapper...')
     apertium_mapper: dict[str, str] = {}
-    with open(mkpath('../results/apertium_mapper.txt'), 'r', encoding='utf-8') as file:
+    with open_text(mkpath('../results/apertium_mapper.txt')) as file:
         for line in map(str.strip, filter(None, file)):
             if ' ' in line:
-                key, value = map(str.lower, line.split(' '))
+                key, value = normalize(line, fold_case=True).split(' ')
                 apertium_mapper[key] = value
 
     print(f'Apertium Mapper: {len(apertium_mapper):,d} -> {len(set(apertium_mapper.values())):,d}')
@@ -69,7 +83,7 @@ def build_trie():
     print('Preparation done')
     print()
 
-    source_file_size = os.path.getsize(mkpath('../results/sentences.txt'))
+    source_file_size = os.path.getsize(mkpath('../results/corpus.bin'))
     print(f'Source file size: {size_to_str(source_file_size)}')
 
     print('Building trie...')
@@ -77,29 +91,32 @@ def build_trie():
     all_words.extend(word for word in apertium_mapper.values() if word not in word_freq)
     trie = Trie(all_words, apertium_mapper)
 
-    total_read_size = 0
+    # Resolve every word only once instead of on every occurrence
+    context_keys, last_keys = map(list, zip(*map(trie.get_word_keys, id_words)))
+
     next_log = LOG_EVERY_N_BYTES
     start_time = perf_counter()
 
-    with open(mkpath('../results/sentences.txt'), 'r', encoding='utf-8') as file:
-        for sentence in map(str.strip, file):
-            word_window: deque[str] = deque(maxlen=Trie.MAX_LAYERS)
+    with open_token_corpus(mkpath('../results/corpus.bin')) as token_ids:
+        word_window: deque[int] = deque(maxlen=Trie.MAX_LAYERS)
 
-            for word in map(str.lower, sentence.split(' ')):
-                total_read_size += word_size[word]
+        for position, token_id in enumerate(token_ids):
+            if token_id == SENTENCE_END:
+                word_window.clear()
 
-                word_window.append(word)
-                trie.add(word_window)
+                if position * token_ids.itemsize >= next_log:
+                    print(
+                        f'Processed {size_to_str(position * token_ids.itemsize)} / '
+                        f'{size_to_str(source_file_size)} in {perf_counter() - start_time:.0f} seconds'
+                    )
+                    next_log += LOG_EVERY_N_BYTES
 
-            if total_read_size >= next_log:
-                print(
-                    f'Processed {size_to_str(total_read_size)} / {size_to_str(source_file_size)} bytes in '
-                    f'{perf_counter() - start_time:.0f} seconds'
-                )
-                next_log += LOG_EVERY_N_BYTES
+                # if position * token_ids.itemsize >= FINISH_AT_N_BYTES:
+                #     break
+                continue
 
-            # if total_read_size >= FINISH_AT_N_BYTES:
-            #     break
+            word_window.append(token_id)
+            trie.add_ids(word_window, context_keys, last_keys)
 
     print()
     trie.dump_file(mkpath('../results/trie.bin'), force_add_words, RESULT_FREQ_THRESHOLD, MAX_RESULTS)
@@ -8,6 +8,8 @@ if __name__ == '__main__':
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
+from src.normalization import normalize
+
 from prediction.trie import Trie
 
 
@@ -32,7 +34,7 @@ def main(request: str):
     trie = Trie.load_file(mkpath('../results/trie.bin'))
     print(f'Trie knows about {len(trie.words_indexed):,d} words')
 
-    words = list(map(str.lower, request.split()))
+    words = normalize(request, fold_case=True).split()
     words_with_stem = [(word, word or word) for word in words]
     print('Request:', words_with_stem)
 
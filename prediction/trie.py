@@ -33,6 +33,7 @@ WORD_INDEX_SHIFT = 1
 
 #               freq         is_stem  word_index
 TrieNode = list[int, dict[tuple[bool, int], 'TrieNode']]  # type: ignore[type-arg]
+TrieKey = tuple[bool, int]
 TrieNodeRepr = tuple[int, dict[str, 'TrieNodeRepr']]
 
 RETURN_MARKER = 1 << 7
@@ -197,6 +198,47 @@ class Trie:
 
             cur_data.setdefault((False, self.words_indexed[words[-1]]), [0, {}])[0] += 1
 
+    def get_word_keys(self, word: str) -> tuple[TrieKey | None, TrieKey | None]:
+        """
+        Keys `add` would use for the word: as a context word and as the predicted (last) word.
+        `None` means that `add` skips the window.
+        """
+        context_key = None
+        if word in self.words_indexed or word in self.apertium_mapper:
+            context_key = (
+                word in self.apertium_mapper,
+                self.words_indexed[self.apertium_mapper.get(word, word)]
+            )
+
+        last_key = (False, self.words_indexed[word]) if word in self.words_indexed else None
+
+        return context_key, last_key
+
+    def add_ids(
+        self,
+        ids: Sequence[int],
+        context_keys: Sequence[TrieKey | None],
+        last_keys: Sequence[TrieKey | None]
+    ):
+        """Same as `add`, but for word ids with keys precomputed by `get_word_keys`"""
+        last_key = last_keys[ids[-1]]
+        if last_key is None:
+            return
+
+        keys: list[TrieKey] = []
+        for i in range(len(ids) - 1):
+            key = context_keys[ids[i]]
+            if key is None:
+                return
+            keys.append(key)
+
+        for slice_start in range(len(keys)):
+            cur_data = self.data
+            for key in keys[slice_start:]:
+                cur_data = cur_data.setdefault(key, [0, {}])[1]
+
+            cur_data.setdefault(last_key, [0, {}])[0] += 1
+
     def dump(self, file_obj: BytesIO, force_add_words: set[str], min_usage: int = 0, max_results: int = 5):
         print('Preparing trie for dumping...')
         words_used_set: set[int] = set()
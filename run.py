@@ -1,66 +1,412 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from collections import defaultdict
-from time import perf_counter
-from math import ceil
+from typing import Any, Iterable, Iterator, NamedTuple, TypedDict
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections import defaultdict, Counter
+from contextlib import suppress
+from time import perf_counter, time
+import itertools
+import threading
+import argparse
+import shutil
+import pickle
+import json
+import sys
 import os
 
-from datasets import load_dataset
-
-from src.utils import print_async, FileWriter, empty_file
-from src.suffixes import ApertiumMapper, get_appertium_mapper
-from src.tokenizer import Tokenizer
+from src.utils import print_async, FileWriter, empty_file, mkpath, append_to_manifest, SHARDS_MANIFEST, PAYLOAD_MODES
+from src.suffixes import ApertiumMapper, SuffixTrie, get_appertium_mapper
+from src.tokenizer import Tokenizer, TOKENIZERS
+from src.normalization import normalize
+from src.quality import QualityThresholds, check_text
+from src.dedup import SharedHashSet, hash_key, get_minhash_bands, DEDUP_CAPACITY
+from src.compression import COMPRESSIONS, get_index_path
+from src.corpus import encode_sentences, link_token_corpus, get_ids_path, get_vocab_path
+from src.metrics import Metrics, StageMetrics, get_peak_rss
+from src.counts import CountReducer, SharedCountReducer, write_count_run, get_unit_run_path, write_freq_file
+from src.prefetch import Prefetcher
 
 
 BATCH_SIZE = 1_000_000
+# Characters per work unit handed to a single worker.
+# Document lengths are very skewed, so units are cut by size and not by the number of texts
+UNIT_CHARS = 10_000_000
+# How many work units may be queued or running per worker before the reader waits.
+# Keeping more than one per worker lets idle workers pick up the next unit right away
+UNITS_IN_FLIGHT_PER_WORKER = 4
+# How many finished units may wait for an earlier (slow) unit before the reader waits as well
+UNITS_FINISHED_AHEAD_PER_WORKER = 8
+# Work units read and pickled by a background thread ahead of dispatch, limited by their pickled size
+PREFETCH_UNITS_PER_WORKER = 2
+PREFETCH_MAX_BYTES = 1_000_000_000
+# How often the parent checks for prefetched units while all workers are busy
+PREFETCH_POLL_INTERVAL = 0.05
+# Characters waiting in the FileWriter queue before producers block (streaming mode only)
+STREAMING_WRITE_QUEUE_SIZE = 500_000_000
+# Words remembered by the suffix trie of every worker (`--suffix-bases`), its distinct words over many units
+SUFFIX_BASES_CACHE_SIZE = 1 << 20
+# Texts between two checkpoints
+CHECKPOINT_EVERY = BATCH_SIZE
+CHECKPOINT_VERSION = 8
+
+CHECKPOINT_PATH = 'results/checkpoint.pickle'
+# Every work unit writes its sentences into its own shard, the manifest records the order of finished shards.
+# Read them with `src.utils.iter_shards_lines` or build a single file with `scripts/compact_sentences.py`
+SENTENCE_SHARDS_DIR = 'results/sentences'
+# Sentences as word ids (lines of `word_freq.txt`), see `src/corpus.py`
+TOKEN_CORPUS_PATH = 'results/corpus.bin'
+# Sorted count runs of the units and their merges, see `src/counts.py`
+COUNTS_DIR = 'results/counts'
+COUNTERS = {
+    'word_freq': 'results/word_freq.txt',
+    'base_apertium_freq': 'results/base_apertium_freq.txt',
+}
+# Only with `--case-folded`: `word_freq` with the case variants of every word summed up (used by the trie builder)
+FOLDED_COUNTERS = {
+    'word_freq_folded': 'results/word_freq_folded.txt',
+}
+# Only with `--suffix-bases`: like `base_apertium_freq`, with the bases found by `SuffixTrie` (longest known suffix
+# stripped off). Covers the words missing from the Apertium mapper
+SUFFIX_COUNTERS = {
+    'base_suffix_freq': 'results/base_suffix_freq.txt',
+}
+METRICS_PATH = 'results/metrics.json'
+# `--prefilter tag`: texts that would be skipped, as `text index<TAB>reason` lines (in the order units finish)
+QUALITY_TAGS_PATH = 'results/quality_tags.txt'
+# Hash sets of the deduplication (`--dedup`, `--dedup-documents`), saved with every checkpoint
+DEDUP_PATHS = {
+    'sentences': 'results/dedup_sentences.bin',
+    'documents': 'results/dedup_documents.bin',
+}
 # os.environ['HF_HUB_OFFLINE'] = '1'
 
+# Loaded once per worker process by `init_worker`, so it never travels with the tasks
+_apertium_mapper: ApertiumMapper = {}
+# Shared with the parent and the other workers, by the kind of deduplication
+_dedup_sets: dict[str, SharedHashSet] = {}
+# Only with `--suffix-bases`. Mapped by every worker, its cache remembers the splits of the words of all its units
+_suffix_trie: SuffixTrie | None = None
+
+WorkUnit = tuple[tuple[int, str], ...]
+Counts = dict[str, int]
+
+
+class ChunkResult(NamedTuple):
+    texts_count: int
+    chars_count: int
+    bytes_count: int
+    tokens_count: int
+    metrics: Metrics
+    worker_pid: int
+    worker_peak_rss: int | None
+    started_at: float
+    finished_at: float
+    # Counts of the unit, when they are not written as runs (workers in threads)
+    counts: dict[str, Counts] | None
+
+
+class PreparedUnit(NamedTuple):
+    unit_num: int
+    # Pickled for worker processes, as is for worker threads
+    payload: bytes | WorkUnit
+    size: int
+    load_time: float
+    pickle_time: float
+
+
+class Checkpoint(TypedDict):
+    version: int
+    source: str
+    unit_chars: int
+    units_done: int
+    texts_done: int
+    manifest_offset: int
+    # Complete count runs (path, level) of the processed units and the last merge number for every counter
+    count_runs: dict[str, list[tuple[str, int]]]
+    merge_seq: dict[str, int]
+    # Pre-filter mode and thresholds, the output depends on them
+    prefilter: tuple[str, QualityThresholds] | None
+    # Capacities of the deduplication hash sets
+    dedup: dict[str, int]
+    # Codec of the sentence shards
+    compression: str | None
+
+
+def iter_dataset_texts(streaming: bool, num_proc: int, skip: int = 0) -> Iterator[str]:
+    from datasets import load_dataset
 
-def process_chunk(
-    batch_num: int,
-    worker_num: int,
-    texts: tuple[tuple[int, str], ...],
-    apertium_mapper: ApertiumMapper
-):
-    print_async(f'Worker {batch_num}_{worker_num} started processing {len(texts):,d} texts')
+    print('Loading dataset...')
 
-    sentences: list[list[str]] = []
-    sentences_of_bases_apertium: list[list[str]] = []
+    if streaming:
+        dataset = load_dataset(
+            'HuggingFaceFW/fineweb-2',
+            name='kir_Cyrl',
+            split='train',
+            streaming=True
+        ).select_columns('text').skip(skip)
 
-    word_freq: dict[str, int] = defaultdict(int)
-    base_freq_apertium: dict[str, int] = defaultdict(int)
+        for row in dataset:
+            yield row['text']
+        return
 
-    for _, text in texts:
-        # FileWriter.write_file(f'results/texts/{batch_num}_{worker_num}_{text_index}.txt', text)
+    dataset = load_dataset(
+        'HuggingFaceFW/fineweb-2',
+        name='kir_Cyrl',
+        split='train',
+        num_proc=num_proc,
+    ).select_columns('text')
 
-        for sentence in Tokenizer.process_text(text):
-            sentence_of_bases_apertium = []
+    print(f'Texts in dataset: {len(dataset):,d}')
 
-            for word in sentence:
-                # Word may not be in the mapper, if the mapper is outdated
-                base_apertium = apertium_mapper.get(word, word)
+    for batch in dataset.skip(skip).iter(batch_size=BATCH_SIZE):
+        yield from batch['text']
 
-                word_freq[word] += 1
-                base_freq_apertium[base_apertium] += 1
 
-                sentence_of_bases_apertium.append(base_apertium)
+def _iter_directory_files(path: str) -> Iterator[str]:
+    for root, dirs, filenames in os.walk(path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(root, filename)
 
-            if len(sentence) > 1:
-                sentences.append(sentence)
-                sentences_of_bases_apertium.append(sentence_of_bases_apertium)
 
-    # print_async(f'Worker {batch_num}_{worker_num} is storing sentences...')
-    # FileWriter.write_file(
-    #     f'results/sentences/{batch_num}_{worker_num}.txt',
-    #     ''.join(sentence + '\n' for sentence in map(' '.join, sentences))
-    # )
-    FileWriter.write_file(
-        'results/sentences.txt',
-        ''.join(sentence + '\n' for sentence in map(' '.join, sentences)),
-        append=True
-    )
+def iter_file_texts(paths: Iterable[str]) -> Iterator[str]:
+    """
+    Reads texts from local files one at a time.
+    Directories are walked in sorted order, `.jsonl` files yield the `text` field of every line
+    and any other file is treated as a single text.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from iter_file_texts(_iter_directory_files(path))
+            continue
+
+        with open(path, 'r', encoding='utf-8') as file:
+            if path.endswith('.jsonl'):
+                for line in filter(None, map(str.strip, file)):
+                    yield json.loads(line)['text']
+            else:
+                yield file.read()
+
+
+def iter_work_units(texts: Iterable[str], unit_chars: int, start: int = 0) -> Iterator[WorkUnit]:
+    """Groups texts into units of at least `unit_chars` characters (except for the last one)"""
+    unit: list[tuple[int, str]] = []
+    chars = 0
+
+    for text_index, text in enumerate(texts, start):
+        unit.append((text_index, text))
+        chars += len(text)
+
+        if chars >= unit_chars:
+            yield tuple(unit)
+            unit.clear()
+            chars = 0
+
+    if unit:
+        yield tuple(unit)
 
+
+def prepare_work_units(units: Iterator[tuple[int, WorkUnit]], pickled: bool = True) -> Iterator[PreparedUnit]:
+    """Pickles numbered units for dispatch. Runs in the prefetch thread, so both stages overlap with processing"""
+    while True:
+        stage_start = perf_counter()
+        next_unit = next(units, None)
+        load_time = perf_counter() - stage_start
+        if next_unit is None:
+            return
+
+        unit_num, unit = next_unit
+        if not pickled:
+            yield PreparedUnit(unit_num, unit, sum(len(text) for _, text in unit), load_time, 0.0)
+            continue
+
+        stage_start = perf_counter()
+        payload = pickle.dumps(unit, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle_time = perf_counter() - stage_start
+        del next_unit, unit
+
+        yield PreparedUnit(unit_num, payload, len(payload), load_time, pickle_time)
+
+
+def init_worker(writer_args: tuple[Any, ...], dedup_args: dict[str, tuple[Any, ...]], suffix_bases: bool = False):
+    global _apertium_mapper, _dedup_sets, _suffix_trie
+
+    FileWriter.bind_worker(*writer_args)
+    _apertium_mapper = get_appertium_mapper()
+    _dedup_sets = {name: SharedHashSet(*args) for name, args in dedup_args.items()}
+    _suffix_trie = SuffixTrie(cache_size=SUFFIX_BASES_CACHE_SIZE) if suffix_bases else None
+
+
+def process_chunk(
+    unit_num: int,
+    texts_payload: bytes | WorkUnit,
+    write_runs: bool = True,
+    tokenizer: type[Tokenizer] = Tokenizer,
+    fold_case: bool = False,
+    prefilter: tuple[str, QualityThresholds] | None = None,
+    compression: str | None = None
+) -> ChunkResult:
+    """
+    Processes a unit in a worker process (pickled texts, counts written as runs)
+    or in a worker thread (texts and counts are shared with the parent as they are).
+    With `prefilter`, texts failing the quality checks are dropped before tokenization (or only tagged).
+    With deduplication, near-duplicate texts are dropped before tokenization as well,
+    and sentences seen before (in any unit) are not written again. Counts still include them.
+    With the suffix trie of the worker, distinct words are also counted by their suffix-stripped bases
+    """
+    started_at = time()
+    metrics = Metrics()
+
+    # Texts are pickled by the parent, so that both sides of the transfer can be measured
+    stage_start = perf_counter()
+    texts: WorkUnit = pickle.loads(texts_payload) if isinstance(texts_payload, bytes) else texts_payload
+    del texts_payload
+    unpickle_time = perf_counter() - stage_start
+
+    # print_async(f'Worker {unit_num} started processing {len(texts):,d} texts')
+
+    apertium_mapper = _apertium_mapper
+
+    # FileWriter.write_file(f'results/texts/{unit_num}_{text_index}.txt', text)
+
+    # Cheap checks of whole texts, so that the expensive stages below do not see the noisy ones
+    kept_texts = texts
+    skipped_bytes = 0
+    if prefilter is not None:
+        stage_start = perf_counter()
+        mode, thresholds = prefilter
+        kept: list[tuple[int, str]] = []
+        tags: list[str] = []
+        for text_index, text in texts:
+            reason = check_text(text, thresholds)
+            if reason is None:
+                kept.append((text_index, text))
+                continue
+
+            text_bytes = len(text.encode('utf-8'))
+            metrics.add_skipped(reason, 1, text_bytes)
+            if mode == 'tag':
+                kept.append((text_index, text))
+                tags.append(f'{text_index}\t{reason}\n')
+            else:
+                skipped_bytes += text_bytes
+        kept_texts = tuple(kept)
+        del kept
+
+        if tags:
+            FileWriter.write_file(QUALITY_TAGS_PATH, ''.join(tags), append=True)
+        metrics.add('prefilter', perf_counter() - stage_start, len(texts))
+
+    if (documents_set := _dedup_sets.get('documents')) is not None:
+        stage_start = perf_counter()
+        kept = []
+        for text_index, text in kept_texts:
+            if all(documents_set.add_new(get_minhash_bands(text), unit_num)):
+                kept.append((text_index, text))
+                continue
+
+            text_bytes = len(text.encode('utf-8'))
+            metrics.add_skipped('duplicate_document', 1, text_bytes)
+            skipped_bytes += text_bytes
+        metrics.add('dedup_documents', perf_counter() - stage_start, len(kept_texts))
+        kept_texts = tuple(kept)
+        del kept
+
+    # Tokens are interned right away, so everything below works with the ids of distinct words
+    # instead of a string for every token
+    stage_start = perf_counter()
+    vocab: dict[str, int] = {}
+    spans = tokenizer.tokenize_batch((text for _, text in kept_texts), vocab)
+    token_ids = spans.token_ids
+    assert token_ids is not None
+    tokenize_time = perf_counter() - stage_start
+
+    stage_start = perf_counter()
+    # Words by id, in the order of their first appearance
+    words = list(vocab)
+    del vocab
+    id_counts = Counter(token_ids)
+    word_freq: Counts = {word: id_counts[word_id] for word_id, word in enumerate(words)}
+
+    # Every distinct word is mapped once
+    base_freq_apertium: Counts = defaultdict(int)
+    for word, freq in word_freq.items():
+        # Word may not be in the mapper, if the mapper is outdated
+        base_freq_apertium[apertium_mapper.get(word, word)] += freq
+
+    word_freq_folded: Counts = defaultdict(int)
+    if fold_case:
+        for word, freq in word_freq.items():
+            word_freq_folded[normalize(word, fold_case=True)] += freq
+
+    mapper_time = perf_counter() - stage_start
+
+    base_freq_suffix: Counts = defaultdict(int)
+    if _suffix_trie is not None:
+        stage_start = perf_counter()
+        for (stem, _), (word, freq) in zip(_suffix_trie.remove_suffixes(word_freq), word_freq.items()):
+            # A word that is a suffix as a whole (e.g. a particle) is its own base
+            base_freq_suffix[stem or word] += freq
+        metrics.add('suffix_bases', perf_counter() - stage_start, len(kept_texts))
+
+    stage_start = perf_counter()
+    sentences = [
+        list(map(words.__getitem__, token_ids[sentence.start:sentence.stop]))
+        for sentence in spans.iter_sentences()
+        if len(sentence) > 1
+    ]
+    del spans, id_counts
+    sentence_lines = list(map(' '.join, sentences))
+    mapper_time += perf_counter() - stage_start
+
+    if (sentences_set := _dedup_sets.get('sentences')) is not None:
+        stage_start = perf_counter()
+        is_new = sentences_set.add_new(map(hash_key, sentence_lines), unit_num)
+        sentences_bytes = sum(len(line.encode('utf-8')) + 1 for line in sentence_lines)
+        duplicates = list(itertools.compress(sentence_lines, (not new for new in is_new)))
+        metrics.add_skipped(
+            'duplicate_sentence', len(duplicates), sum(len(line.encode('utf-8')) + 1 for line in duplicates)
+        )
+        sentences = list(itertools.compress(sentences, is_new))
+        sentence_lines = list(itertools.compress(sentence_lines, is_new))
+        metrics.add('dedup_sentences', perf_counter() - stage_start, data_bytes=sentences_bytes)
+        del is_new, duplicates
+
+    # Every stage processes the same unit, so they all report the same amounts
+    amounts = (len(kept_texts), sum(len(text.encode('utf-8')) for _, text in kept_texts), len(token_ids))
+    metrics.add('dispatch', unpickle_time, *amounts)
+    metrics.add('tokenize', tokenize_time, *amounts)
+    metrics.add('mapper', mapper_time, *amounts)
+
+    # print_async(f'Worker {unit_num} is storing sentences...')
+    stage_start = perf_counter()
+    shard_path = mkpath(SENTENCE_SHARDS_DIR, get_sentence_shard_name(unit_num, compression))
+    sentences_data = ''.join(line + '\n' for line in sentence_lines)
+    # Same sentences as word ids, local to this shard. Linked into `TOKEN_CORPUS_PATH` after the run
+    ids_data, vocab_data = encode_sentences(sentences, word_freq.keys())
+    metrics.add('serialize', perf_counter() - stage_start, *amounts)
+
+    # Counts are written right away (not through FileWriter): merges of these runs may start as soon as we return
+    counts = {'word_freq': word_freq, 'base_apertium_freq': base_freq_apertium}
+    if fold_case:
+        counts['word_freq_folded'] = word_freq_folded
+    if _suffix_trie is not None:
+        counts['base_suffix_freq'] = base_freq_suffix
+    if write_runs:
+        stage_start = perf_counter()
+        for name, unit_counts in counts.items():
+            write_count_run(get_unit_run_path(COUNTS_DIR, name, unit_num), unit_counts)
+        metrics.add('count_runs', perf_counter() - stage_start, *amounts)
+
+    stage_start = perf_counter()
+    FileWriter.write_file(shard_path, sentences_data)
+    FileWriter.write_file(get_ids_path(shard_path), ids_data, binary=True)
+    FileWriter.write_file(get_vocab_path(shard_path), vocab_data)
+    metrics.add('file_writer_queue', perf_counter() - stage_start, *amounts)
+    del sentences_data, ids_data, vocab_data
+
+    # sentences_of_bases_apertium = [[apertium_mapper.get(word, word) for word in sentence] for sentence in sentences]
     # FileWriter.write_file(
-    #     f'results/sentences_of_bases_apertium/{batch_num}_{worker_num}.txt',
+    #     f'results/sentences_of_bases_apertium/{unit_num}.txt',
     #     '\n'.join(map(' '.join, sentences_of_bases_apertium)),
     # )
     # FileWriter.write_file(
@@ -69,92 +415,557 @@ def process_chunk(
     #     append=True
     # )
 
-    # print_async(f'Worker {batch_num}_{worker_num} finished writing results')
-    return word_freq, base_freq_apertium
+    # print_async(f'Worker {unit_num} finished writing results')
+    return ChunkResult(
+        texts_count=len(texts),
+        chars_count=sum(len(text) for _, text in texts),
+        bytes_count=amounts[1] + skipped_bytes,
+        tokens_count=amounts[2],
+        metrics=metrics,
+        # Threads share the process, so they are told apart by their own ids
+        worker_pid=os.getpid() if write_runs else threading.get_native_id(),
+        worker_peak_rss=get_peak_rss(),
+        started_at=started_at,
+        finished_at=time(),
+        counts=None if write_runs else counts,
+    )
+
 
+def report_worker_stats(metrics: Metrics):
+    wall_time = time() - metrics.started_at
+    print_async(f'Worker utilization over {wall_time:.0f} seconds:')
+
+    for worker_num, (pid, stats) in enumerate(sorted(metrics.workers.items()), 1):
+        print_async(
+            f'  Worker {worker_num} (pid {pid}): {stats.units:,d} units, {stats.texts:,d} texts, '
+            f'{stats.chars:,d} chars, busy {stats.busy_time:.0f} s, idle {max(0.0, wall_time - stats.busy_time):.0f} s '
+            f'({stats.busy_time / wall_time if wall_time else 0:.1%})'
+            + (f', peak RSS {stats.peak_rss / 1024 ** 2:,.0f} MB' if stats.peak_rss is not None else '')
+        )
+
+    print_async(f'  Average utilization: {metrics.get_utilization():.1%}')
+
+
+def get_sentence_shard_name(unit_num: int, compression: str | None = None) -> str:
+    return f'{unit_num:08d}.txt' + (COMPRESSIONS[compression] if compression else '')
+
+
+def commit_sentence_shards(first_unit_num: int, last_unit_num: int, compression: str | None = None) -> int:
+    """
+    Records sentence shards of the finished units in the manifest in unit order.
+    Returns the size of the manifest afterwards.
+    """
+    shard_names = [
+        get_sentence_shard_name(unit_num, compression) for unit_num in range(first_unit_num, last_unit_num + 1)
+    ]
+    # Shards of the finished units must be on disk before they are listed. Only theirs: the writes of the units
+    # still being processed go on meanwhile
+    shard_paths = [mkpath(SENTENCE_SHARDS_DIR, shard_name) for shard_name in shard_names]
+    FileWriter.flush(itertools.chain(shard_paths, map(get_ids_path, shard_paths), map(get_vocab_path, shard_paths)))
+
+    return append_to_manifest(SENTENCE_SHARDS_DIR, shard_names)
+
+
+def save_checkpoint(checkpoint: Checkpoint):
+    with open(CHECKPOINT_PATH + '.tmp', 'wb') as file:
+        pickle.dump(checkpoint, file, protocol=pickle.HIGHEST_PROTOCOL)
+    # Atomic replace: a crash while saving leaves the previous checkpoint intact
+    os.replace(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+
+def load_checkpoint(
+    source: str,
+    unit_chars: int,
+    counters: Iterable[str],
+    prefilter: tuple[str, QualityThresholds] | None,
+    dedup: dict[str, int],
+    compression: str | None
+) -> Checkpoint | None:
+    if not os.path.isfile(CHECKPOINT_PATH):
+        print('[Checkpoint] No checkpoint found, starting from scratch')
+        return None
+
+    with open(CHECKPOINT_PATH, 'rb') as file:
+        checkpoint: Checkpoint = pickle.load(file)
+
+    if (checkpoint['version'], checkpoint['source'], checkpoint.get('unit_chars')) != (
+        CHECKPOINT_VERSION, source, unit_chars
+    ):
+        raise ValueError(
+            f'[Checkpoint] {CHECKPOINT_PATH} was created for a different run '
+            f'(source: {checkpoint["source"]}, unit size: {checkpoint.get("unit_chars")} chars). '
+            'Start without --resume to discard it'
+        )
+
+    if set(checkpoint['count_runs']) != set(counters):
+        raise ValueError(
+            f'[Checkpoint] {CHECKPOINT_PATH} was created with different counters '
+            f'({", ".join(checkpoint["count_runs"])}). '
+            'Resume with the same options or start without --resume to discard it'
+        )
+
+    if checkpoint['prefilter'] != prefilter:
+        raise ValueError(
+            f'[Checkpoint] {CHECKPOINT_PATH} was created with a different pre-filter ({checkpoint["prefilter"]}). '
+            'Resume with the same options or start without --resume to discard it'
+        )
+
+    if checkpoint['dedup'] != dedup:
+        raise ValueError(
+            f'[Checkpoint] {CHECKPOINT_PATH} was created with different deduplication ({checkpoint["dedup"]}). '
+            'Resume with the same options or start without --resume to discard it'
+        )
+
+    if checkpoint['compression'] != compression:
+        raise ValueError(
+            f'[Checkpoint] {CHECKPOINT_PATH} was created with different compression ({checkpoint["compression"]}). '
+            'Resume with the same options or start without --resume to discard it'
+        )
 
-def main():
+    print(
+        f'[Checkpoint] Resuming after {checkpoint["units_done"]:,d} work units '
+        f'({checkpoint["texts_done"]:,d} texts)'
+    )
+    return checkpoint
+
+
+def main(
+    streaming: bool = False,
+    files: list[str] | None = None,
+    unit_chars: int = UNIT_CHARS,
+    resume: bool = False,
+    checkpoint_every: int = CHECKPOINT_EVERY,
+    metrics_interval: float = 0,
+    prefetch_units: int | None = None,
+    prefetch_bytes: int = PREFETCH_MAX_BYTES,
+    executor_type: str = 'processes',
+    tokenizer_name: str = 'regex',
+    case_folded: bool = False,
+    prefilter_mode: str | None = None,
+    quality_thresholds: QualityThresholds | None = None,
+    dedup_sentences: bool = False,
+    dedup_documents: bool = False,
+    dedup_capacity: int = DEDUP_CAPACITY,
+    fsync_interval: float | None = None,
+    writer_payloads: str = 'queue',
+    compression: str | None = None,
+    suffix_bases: bool = False
+):
     num_workers = os.cpu_count() or 4
     # num_workers = os.process_cpu_count() or os.cpu_count() or 4
     # num_workers = 1
+    max_in_flight = num_workers * UNITS_IN_FLIGHT_PER_WORKER
+    max_finished_ahead = num_workers * UNITS_FINISHED_AHEAD_PER_WORKER
+    if prefetch_units is None:
+        prefetch_units = num_workers * PREFETCH_UNITS_PER_WORKER
+
+    source = f'files:{files}' if files else f'dataset:{"streaming" if streaming else "batch"}'
+    counters = COUNTERS | (FOLDED_COUNTERS if case_folded else {}) | (SUFFIX_COUNTERS if suffix_bases else {})
+    prefilter = (prefilter_mode, quality_thresholds or QualityThresholds()) if prefilter_mode else None
+    dedup = {
+        name: dedup_capacity for name, enabled in (('sentences', dedup_sentences), ('documents', dedup_documents))
+        if enabled
+    }
+    checkpoint = load_checkpoint(source, unit_chars, counters, prefilter, dedup, compression) if resume else None
+
+    bind_args = FileWriter.init(
+        max_size=STREAMING_WRITE_QUEUE_SIZE if streaming or files else None,
+        fsync_interval=fsync_interval,
+        payload_mode=writer_payloads
+    )
 
-    bind_args = FileWriter.init()
-    apertium_mapper = get_appertium_mapper()
-
-    empty_file('results/sentences.txt')
-    empty_file('results/sentences_of_bases_apertium.txt')
-
-    print('Loading dataset...')
-    dataset = load_dataset(
-        'HuggingFaceFW/fineweb-2',
-        name='kir_Cyrl',
-        split='train',
-        num_proc=num_workers,
-        # streaming=True
-    ).select_columns('text')
-
-    print(f'Texts in dataset: {len(dataset):,d}')
+    if checkpoint is None:
+        checkpoint = Checkpoint(
+            version=CHECKPOINT_VERSION,
+            source=source,
+            unit_chars=unit_chars,
+            units_done=0,
+            texts_done=0,
+            manifest_offset=0,
+            count_runs={name: [] for name in counters},
+            merge_seq=dict.fromkeys(counters, 0),
+            prefilter=prefilter,
+            dedup=dedup,
+            compression=compression,
+        )
+        with suppress(FileNotFoundError):
+            os.remove(CHECKPOINT_PATH)
+        for ext in ('', *COMPRESSIONS.values()):
+            for path in (f'results/sentences.txt{ext}', get_index_path(f'results/sentences.txt{ext}')):
+                with suppress(FileNotFoundError):
+                    # A compacted file from the previous run would be stale
+                    os.remove(path)
+        for output_path in (
+            *FOLDED_COUNTERS.values(), *SUFFIX_COUNTERS.values(), QUALITY_TAGS_PATH, *DEDUP_PATHS.values()
+        ):
+            with suppress(FileNotFoundError):
+                # Also stale, even if it is not written this time
+                os.remove(output_path)
+        shutil.rmtree(SENTENCE_SHARDS_DIR, ignore_errors=True)
+        shutil.rmtree(COUNTS_DIR, ignore_errors=True)
+        empty_file(mkpath(SENTENCE_SHARDS_DIR, SHARDS_MANIFEST))
+        empty_file('results/sentences_of_bases_apertium.txt')
+    else:
+        # Forget shards that were listed after the checkpoint was saved, they are going to be rewritten
+        os.truncate(mkpath(SENTENCE_SHARDS_DIR, SHARDS_MANIFEST), checkpoint['manifest_offset'])
+
+    # Created before the workers, which share them
+    dedup_sets = {name: SharedHashSet.create(capacity) for name, capacity in dedup.items()}
+    for name, dedup_set in dedup_sets.items():
+        if checkpoint['units_done']:
+            # Hashes of the units after the checkpoint are forgotten, the units are processed again
+            dedup_set.load(DEDUP_PATHS[name], checkpoint['units_done'])
+            print(f'[Dedup] Loaded {len(dedup_set):,d} {name} hashes')
+    dedup_args = {name: dedup_set.bind_args for name, dedup_set in dedup_sets.items()}
+
+    texts: Iterator[str]
+    if files:
+        texts = itertools.islice(iter_file_texts(files), checkpoint['texts_done'], None)
+    else:
+        texts = iter_dataset_texts(streaming, num_workers, skip=checkpoint['texts_done'])
+
+    if suffix_bases:
+        # Built here once if the dictionaries changed, the workers map the saved trie
+        SuffixTrie(cache_size=0).close()
+
+    use_threads = executor_type == 'threads'
+    executor: Executor
+    if use_threads:
+        if getattr(sys, '_is_gil_enabled', lambda: True)():
+            print_async('Warning: the GIL is enabled, worker threads will not run in parallel')
+        # Shared by all threads, loaded once
+        init_worker(bind_args, dedup_args, suffix_bases)
+        executor = ThreadPoolExecutor(max_workers=num_workers)
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=num_workers, initializer=init_worker, initargs=(bind_args, dedup_args, suffix_bases)
+        )
 
-    batches_to_process = ceil(len(dataset) / BATCH_SIZE)
     print(
-        f'Using {num_workers} workers and {batches_to_process} batches of size {BATCH_SIZE:,d} '
-        f'({max(1, ceil(BATCH_SIZE / num_workers)):,d} texts per run)'
-    )
-
-    word_freq: dict[str, int] = defaultdict(int)
-    base_apertium_freq: dict[str, int] = defaultdict(int)
-
-    with ProcessPoolExecutor(
-        max_workers=num_workers,
-        initializer=FileWriter.bind_worker,
-        initargs=bind_args
-    ) as executor:
-        for batch_num, texts in enumerate((batch['text'] for batch in dataset.iter(batch_size=BATCH_SIZE)), 1):
-            print_async(f'Processing batch {batch_num}/{batches_to_process}...')
-            chunk_size = ceil(len(texts) / num_workers)
-
-            start_time = perf_counter()
-            futures = [
-                executor.submit(
-                    process_chunk,
-                    batch_num,
-                    i,
-                    tuple(
-                        ((batch_num - 1) * BATCH_SIZE + (i * chunk_size) + j, text)
-                        for j, text in enumerate(texts[i * chunk_size:(i + 1) * chunk_size])
-                    ),
-                    apertium_mapper
-                )
-                for i in range(num_workers)
-            ]
-            del texts
-
-            for future in as_completed(futures):
-                # print(f'Merging results from one of the workers in {batch_num}...')
-                word_freq_chunk, base_apertium_freq_chunk = future.result()
-
-                for word, freq in word_freq_chunk.items():
-                    word_freq[word] += freq
-                for base, freq in base_apertium_freq_chunk.items():
-                    base_apertium_freq[base] += freq
-                del word_freq_chunk, base_apertium_freq_chunk
+        f'Using {num_workers} worker {executor_type}, {unit_chars:,d} characters per work unit '
+        f'and up to {max_in_flight} work units in flight, {prefetch_units} prefetched'
+    )
 
-            print_async(f'Batch processed in {perf_counter() - start_time:.0f} seconds')
+    texts_processed = 0
+    next_checkpoint = checkpoint['texts_done'] + checkpoint_every
+    start_time = perf_counter()
+    metrics = Metrics()
+    last_metrics_dump = time()
 
-    print('Sorting...')
-    word_freq_sorted = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)
-    base_apertium_freq_sorted = sorted(base_apertium_freq.items(), key=lambda x: x[1], reverse=True)
-    del word_freq, base_apertium_freq
+    units = enumerate(
+        iter_work_units(texts, unit_chars, start=checkpoint['texts_done']),
+        checkpoint['units_done'] + 1
+    )
+    # The next units are read (e.g. decoded from Arrow) and pickled while the current ones are processed
+    prefetcher = Prefetcher(
+        prepare_work_units(units, pickled=not use_threads),
+        max_items=prefetch_units,
+        max_bytes=prefetch_bytes,
+        get_size=lambda prepared: prepared.size
+    )
 
-    print('Saving results...')
-    FileWriter.write_file('results/word_freq.txt', '\n'.join(f'{word} {freq}' for word, freq in word_freq_sorted))
-    FileWriter.write_file(
-        'results/base_apertium_freq.txt',
-        '\n'.join(f'{base} {freq}' for base, freq in base_apertium_freq_sorted)
+    try:
+        with executor:
+            pending: dict[Future[ChunkResult], int] = {}
+            # Units that finished ahead of an earlier one. They are merged strictly in order,
+            # so that a checkpoint always describes a contiguous prefix of the corpus
+            finished: dict[int, ChunkResult] = {}
+            committed_units = checkpoint['units_done']
+            # Time spent by the prefetch thread on reading and pickling every pending unit
+            parent_times: dict[int, tuple[float, float]] = {}
+
+            reducers = {
+                name: (SharedCountReducer if use_threads else CountReducer)(
+                    name, COUNTS_DIR, checkpoint['merge_seq'][name]
+                )
+                for name in counters
+            }
+            for name, reducer in reducers.items():
+                for run_path, level in checkpoint['count_runs'][name]:
+                    reducer.add(executor, run_path, level)
+
+            while True:
+                # Backpressure: do not dispatch further while enough units are queued (or wait for a slow one),
+                # merge the finished ones instead. There is no barrier otherwise: idle workers take the next queued unit
+                can_dispatch = len(pending) < max_in_flight and len(finished) < max_finished_ahead
+                if can_dispatch and not prefetcher.is_done():
+                    # Only wait for the prefetch thread if some worker would be idle otherwise
+                    stage_start = perf_counter()
+                    prepared = prefetcher.get(block=len(pending) < num_workers)
+                    metrics.add('prefetch_wait', perf_counter() - stage_start)
+
+                    if prepared is not None:
+                        chunk_future = executor.submit(
+                            process_chunk,
+                            prepared.unit_num,
+                            prepared.payload,
+                            not use_threads,
+                            TOKENIZERS[tokenizer_name],
+                            case_folded,
+                            prefilter,
+                            compression
+                        )
+                        pending[chunk_future] = prepared.unit_num
+                        parent_times[prepared.unit_num] = (prepared.load_time, prepared.pickle_time)
+                        del prepared
+                        continue
+
+                merges = {future: reducer for reducer in reducers.values() for future in reducer.merging}
+                if not pending and not merges and prefetcher.is_done():
+                    break
+
+                futures: list[Future[Any]] = [*pending, *merges]
+                done, _ = wait(
+                    futures,
+                    timeout=PREFETCH_POLL_INTERVAL if can_dispatch and not prefetcher.is_done() else None,
+                    return_when=FIRST_COMPLETED
+                )
+                for future in done:
+                    if future in merges:
+                        metrics.add('merge', merges[future].on_merged(executor, future))
+                        continue
+
+                    unit_num = pending.pop(future)
+                    result = future.result()
+
+                    load_time, pickle_time = parent_times.pop(unit_num)
+                    metrics.add('load', load_time, result.texts_count, result.bytes_count, result.tokens_count)
+                    # Amounts are already reported by the worker for its (unpickling) part of the dispatch
+                    metrics.add('dispatch', pickle_time)
+                    metrics.merge(result.metrics)
+                    metrics.update_worker(
+                        result.worker_pid,
+                        result.texts_count,
+                        result.chars_count,
+                        result.finished_at - result.started_at,
+                        result.worker_peak_rss
+                    )
+
+                    finished[unit_num] = result
+                    del result
+
+                while checkpoint['units_done'] + 1 in finished:
+                    result = finished.pop(checkpoint['units_done'] + 1)
+
+                    # Counts of the unit join the merge tree only now, so that the runs always cover a prefix of units
+                    for name, reducer in reducers.items():
+                        if isinstance(reducer, SharedCountReducer):
+                            assert result.counts is not None
+                            reducer.add_counts(executor, result.counts[name])
+                        else:
+                            reducer.add(executor, get_unit_run_path(COUNTS_DIR, name, checkpoint['units_done'] + 1))
+
+                    checkpoint['units_done'] += 1
+                    checkpoint['texts_done'] += result.texts_count
+                    texts_processed += result.texts_count
+                    del result
+
+                    if checkpoint['texts_done'] >= next_checkpoint:
+                        stage_start = perf_counter()
+                        checkpoint['manifest_offset'] = commit_sentence_shards(
+                            committed_units + 1, checkpoint['units_done'], compression
+                        )
+                        committed_units = checkpoint['units_done']
+                        for name, reducer in reducers.items():
+                            checkpoint['count_runs'][name] = reducer.get_runs()
+                            checkpoint['merge_seq'][name] = reducer.merge_seq
+                        for name, dedup_set in dedup_sets.items():
+                            dedup_set.save(DEDUP_PATHS[name])
+                        save_checkpoint(checkpoint)
+                        for reducer in reducers.values():
+                            reducer.remove_obsolete()
+                        next_checkpoint += checkpoint_every
+                        metrics.add('checkpoint', perf_counter() - stage_start)
+
+                        print_async(
+                            f'Processed {checkpoint["texts_done"]:,d} texts '
+                            f'({texts_processed:,d} in this run) in {perf_counter() - start_time:.0f} seconds, '
+                            f'worker utilization {metrics.get_utilization():.1%}'
+                        )
+
+                if metrics_interval and time() - last_metrics_dump >= metrics_interval:
+                    metrics.histograms.update(FileWriter.get_histograms())
+                    metrics.file_writer = FileWriter.get_stats()
+                    metrics.dump(METRICS_PATH)
+                    last_metrics_dump = time()
+                    print_async(f'[Metrics] {metrics.get_summary()}')
+    except BaseException:
+        # After the workers, which may still be writing. The writer process is not a daemon,
+        # the interpreter would wait for it forever
+        FileWriter.stop()
+        raise
+    finally:
+        prefetcher.close()
+
+    metrics.add('prefetch_full', prefetcher.full_time)
+    report_worker_stats(metrics)
+
+    commit_sentence_shards(committed_units + 1, checkpoint['units_done'], compression)
+
+    print_async(
+        f'All {checkpoint["texts_done"]:,d} texts processed '
+        f'({texts_processed:,d} in this run) in {perf_counter() - start_time:.0f} seconds'
     )
+    if prefilter is not None:
+        print_async(
+            f'Pre-filter ({prefilter_mode}): '
+            f'{sum(skipped.texts for skipped in metrics.skipped.values()):,d} texts '
+            f'({sum(skipped.bytes for skipped in metrics.skipped.values()):,d} bytes) in this run failed the checks'
+            + ''.join(
+                f', {reason} {skipped.texts:,d} ({skipped.bytes:,d} bytes)'
+                for reason, skipped in sorted(metrics.skipped.items())
+                if not reason.startswith('duplicate_')
+            )
+        )
+    if dedup_documents:
+        skipped = metrics.skipped.get('duplicate_document', StageMetrics())
+        print_async(
+            f'Dedup: {skipped.texts:,d} near-duplicate texts ({skipped.bytes:,d} bytes) in this run were skipped'
+        )
+    if dedup_sentences:
+        skipped = metrics.skipped.get('duplicate_sentence', StageMetrics())
+        sentences_bytes = metrics.stages['dedup_sentences'].bytes if 'dedup_sentences' in metrics.stages else 0
+        print_async(
+            f'Dedup: {skipped.texts:,d} repeated sentences ({skipped.bytes:,d} bytes, '
+            f'{skipped.bytes / sentences_bytes if sentences_bytes else 0:.1%} of the sentences) '
+            'in this run were removed'
+        )
 
     FileWriter.stop()
 
+    print('Combining and sorting counts...')
+    for name, output_path in counters.items():
+        stage_start = perf_counter()
+        words_count = write_freq_file([path for path, _ in reducers[name].get_runs()], output_path)
+        metrics.add('combine', perf_counter() - stage_start)
+        print(f'Saved {words_count:,d} words to {output_path}')
+
+    _, written_bytes, write_time = FileWriter.get_write_stats()
+    metrics.add('file_writer_write', write_time, data_bytes=written_bytes)
+    metrics.histograms.update(FileWriter.get_histograms())
+    metrics.file_writer = FileWriter.get_stats()
+
+    print('Linking token corpus...')
+    stage_start = perf_counter()
+    tokens_count = link_token_corpus(SENTENCE_SHARDS_DIR, 'results/word_freq.txt', TOKEN_CORPUS_PATH)
+    metrics.add('link', perf_counter() - stage_start, tokens=tokens_count)
+    print(f'Saved {tokens_count:,d} ids to {TOKEN_CORPUS_PATH}')
+
+    metrics.dump(METRICS_PATH)
+    print(f'Metrics saved to {METRICS_PATH}: {metrics.get_summary()}')
+
+    # The run is complete, nothing to resume anymore
+    with suppress(FileNotFoundError):
+        os.remove(CHECKPOINT_PATH)
+    for name in dedup_sets:
+        for path in (DEDUP_PATHS[name], DEDUP_PATHS[name] + '.tmp'):
+            with suppress(FileNotFoundError):
+                os.remove(path)
+    shutil.rmtree(COUNTS_DIR, ignore_errors=True)
+
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Builds word frequencies and sentences from the corpus')
+    parser.add_argument(
+        '--streaming', action='store_true',
+        help='Stream the dataset instead of materializing it locally (memory stays flat)'
+    )
+    parser.add_argument(
+        '--files', nargs='+', metavar='PATH',
+        help='Read texts from local files or directories instead of the dataset (always streamed)'
+    )
+    parser.add_argument('--unit-chars', type=int, default=UNIT_CHARS, help='Characters per work unit')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help=f'Continue from the last checkpoint in {CHECKPOINT_PATH} instead of starting over'
+    )
+    parser.add_argument(
+        '--checkpoint-every', type=int, default=CHECKPOINT_EVERY, metavar='TEXTS',
+        help='Save a checkpoint after every this many texts'
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=0, metavar='SECONDS',
+        help=f'Also update {METRICS_PATH} and print a summary while running (it is always saved at the end)'
+    )
+    parser.add_argument(
+        '--executor', choices=('processes', 'threads'), default='processes',
+        help='Run workers in processes, or in threads sharing the mapper and the counts (for free-threaded Python)'
+    )
+    parser.add_argument(
+        '--tokenizer', choices=TOKENIZERS, default='regex',
+        help='Tokenizer engine: regular expressions, or a linear-time scan with the same output'
+    )
+    parser.add_argument(
+        '--case-folded', action='store_true',
+        help=f'Also write {FOLDED_COUNTERS["word_freq_folded"]} with lowercased words'
+    )
+    parser.add_argument(
+        '--suffix-bases', action='store_true',
+        help=f'Also write {SUFFIX_COUNTERS["base_suffix_freq"]} with the bases found by stripping known suffixes'
+    )
+    parser.add_argument(
+        '--prefilter', choices=('drop', 'tag'), default=None,
+        help=f'Check texts by length and character classes before tokenization, and drop the failing ones '
+             f'or only list them in {QUALITY_TAGS_PATH}'
+    )
+    for field, default in QualityThresholds._field_defaults.items():
+        parser.add_argument(
+            f'--{field.replace("_", "-")}', type=type(default), default=default,
+            help=f'Pre-filter threshold (default: {default})'
+        )
+    parser.add_argument(
+        '--dedup', action='store_true',
+        help='Write every distinct sentence only once (across all units; word counts still include the repeats)'
+    )
+    parser.add_argument(
+        '--dedup-documents', action='store_true',
+        help='Skip texts that are near-duplicates (MinHash) of earlier ones before tokenization'
+    )
+    parser.add_argument(
+        '--dedup-capacity', type=int, default=DEDUP_CAPACITY, metavar='HASHES',
+        help='Size of every deduplication hash set (12 bytes per hash, in shared memory)'
+    )
+    parser.add_argument(
+        '--fsync-interval', type=float, default=None, metavar='SECONDS',
+        help='Sync written files to disk at most this often (0: after every write, default: only when the OS does)'
+    )
+    parser.add_argument(
+        '--writer-payloads', choices=PAYLOAD_MODES, default='queue',
+        help='Send sentences to the file writer through its queue, or in shared memory blocks'
+    )
+    parser.add_argument(
+        '--compress', choices=COMPRESSIONS, default=None,
+        help='Compress the sentence shards in independent blocks (read them with `src.compression.open_text`)'
+    )
+    parser.add_argument(
+        '--prefetch-units', type=int, default=None, metavar='UNITS',
+        help=f'Work units prepared ahead of dispatch (default: {PREFETCH_UNITS_PER_WORKER} per worker)'
+    )
+    parser.add_argument(
+        '--prefetch-memory', type=int, default=PREFETCH_MAX_BYTES, metavar='BYTES',
+        help='Limit on the pickled size of the prefetched work units'
+    )
+    args = parser.parse_args()
+
+    main(
+        streaming=args.streaming,
+        files=args.files,
+        unit_chars=args.unit_chars,
+        resume=args.resume,
+        checkpoint_every=args.checkpoint_every,
+        metrics_interval=args.metrics_interval,
+        prefetch_units=args.prefetch_units,
+        prefetch_bytes=args.prefetch_memory,
+        executor_type=args.executor,
+        tokenizer_name=args.tokenizer,
+        case_folded=args.case_folded,
+        prefilter_mode=args.prefilter,
+        quality_thresholds=QualityThresholds(**{field: getattr(args, field) for field in QualityThresholds._fields}),
+        dedup_sentences=args.dedup,
+        dedup_documents=args.dedup_documents,
+        dedup_capacity=args.dedup_capacity,
+        fsync_interval=args.fsync_interval,
+        writer_payloads=args.writer_payloads,
+        compression=args.compress,
+        suffix_bases=args.suffix_bases
+    )
@@ -0,0 +1,85 @@
+import sys
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import PathMagic
+mkpath = PathMagic(__file__)
+
+from typing import Any
+
+from time import perf_counter
+import subprocess
+import argparse
+import tempfile
+import hashlib
+import json
+import os
+
+
+OUTPUTS = ('results/word_freq.txt', 'results/base_apertium_freq.txt', 'results/corpus.bin')
+
+
+def get_file_hash(path: str) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def run_pipeline(executor: str, files: list[str], unit_chars: int, work_dir: str) -> dict[str, Any]:
+    """Runs `run.py` in `work_dir` (it writes into `work_dir/results`) and returns its wall time and metrics"""
+    env = dict(os.environ, PYTHONPATH=mkpath('..'))
+    start_time = perf_counter()
+    subprocess.run(
+        [
+            sys.executable, mkpath('../run.py'),
+            '--files', *map(os.path.abspath, files),
+            '--unit-chars', str(unit_chars),
+            '--executor', executor,
+        ],
+        cwd=work_dir, env=env, check=True, stdout=subprocess.DEVNULL
+    )
+    wall_time = perf_counter() - start_time
+
+    with open(os.path.join(work_dir, 'results/metrics.json'), 'r', encoding='utf-8') as file:
+        metrics = json.load(file)
+
+    return {
+        'wall_seconds': wall_time,
+        'parent_peak_rss': metrics['parent_peak_rss'],
+        'workers': len(metrics['workers']),
+        'utilization': sum(w['utilization'] for w in metrics['workers'].values()) / max(1, len(metrics['workers'])),
+        'outputs': [get_file_hash(os.path.join(work_dir, path)) for path in OUTPUTS],
+    }
+
+
+def benchmark_executors(files: list[str], unit_chars: int, repeats: int):
+    gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print(f'Python {sys.version.split()[0]}, GIL {"enabled" if gil_enabled else "disabled"}, {os.cpu_count()} CPUs')
+
+    results: dict[str, list[dict[str, Any]]] = {'processes': [], 'threads': []}
+    for _ in range(repeats):
+        for executor, executor_results in results.items():
+            with tempfile.TemporaryDirectory() as work_dir:
+                executor_results.append(run_pipeline(executor, files, unit_chars, work_dir))
+
+    for executor, executor_results in results.items():
+        best = min(executor_results, key=lambda result: result['wall_seconds'])
+        peak_rss = best['parent_peak_rss']
+        print(
+            f'{executor:>9}: best {best["wall_seconds"]:.2f} s of {repeats}, '
+            f'{best["workers"]} workers, utilization {best["utilization"]:.1%}, '
+            f'parent peak RSS {peak_rss / 2 ** 20 if peak_rss else 0:,.0f} MB'
+        )
+
+    outputs = {tuple(result['outputs']) for executor_results in results.values() for result in executor_results}
+    print('Outputs are identical' if len(outputs) == 1 else 'Outputs differ!')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares the process and thread executors of run.py')
+    parser.add_argument('files', nargs='+', help='Corpus files, as for `run.py --files`')
+    parser.add_argument('--unit-chars', type=int, default=1_000_000)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark_executors(args.files, args.unit_chars, args.repeats)
@@ -0,0 +1,70 @@
+import sys
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import PathMagic
+mkpath = PathMagic(__file__)
+
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import argparse
+import tempfile
+import os
+
+from src.utils import FileWriter, PAYLOAD_MODES
+
+
+SIZES = (64 * 1024, 1024 * 1024, 8 * 1024 * 1024)
+SENTENCE = 'кыргыз тилиндеги сүйлөм жана анын сөздөрү\n'
+
+
+def write_payloads(directory: str, producer: int, payloads: int, size: int) -> float:
+    """Writes the payloads as shards, like the workers of `run.py`. Returns the time spent in `write_file`"""
+    data = (SENTENCE * (size // len(SENTENCE) + 1))[:size]
+    write_time = 0.0
+    for payload_num in range(payloads):
+        start_time = perf_counter()
+        FileWriter.write_file(os.path.join(directory, f'{producer}_{payload_num}.txt'), data)
+        write_time += perf_counter() - start_time
+    return write_time
+
+
+def run_benchmark(mode: str, producers: int, payloads: int, size: int) -> tuple[float, float]:
+    """End-to-end seconds (until everything is written) and seconds spent by producers in `write_file`"""
+    with tempfile.TemporaryDirectory() as directory:
+        start_time = perf_counter()
+        bind_args = FileWriter.init(payload_mode=mode)
+        with ProcessPoolExecutor(producers, initializer=FileWriter.bind_worker, initargs=bind_args) as executor:
+            producer_times = list(executor.map(
+                write_payloads, [directory] * producers, range(producers), [payloads] * producers, [size] * producers
+            ))
+        FileWriter.stop()
+        return perf_counter() - start_time, sum(producer_times)
+
+
+def benchmark_file_writer(producers: int, payloads: int, sizes: list[int], repeats: int):
+    print(f'{producers} producers, {payloads} payloads each')
+
+    for size in sizes:
+        total_bytes = producers * payloads * len((SENTENCE * (size // len(SENTENCE) + 1))[:size].encode('utf-8'))
+        print(f'Payloads of {size:,d} characters ({total_bytes / 2 ** 20:,.0f} MB in total):')
+        for mode in PAYLOAD_MODES:
+            wall_time, producer_time = min(run_benchmark(mode, producers, payloads, size) for _ in range(repeats))
+            print(
+                f'  {mode:>13}: {total_bytes / wall_time / 2 ** 20:,.0f} MB/s end-to-end, '
+                f'producers spent {producer_time:.2f} s in write_file'
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compares the end-to-end write throughput of the FileWriter payload modes'
+    )
+    parser.add_argument('--producers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--payloads', type=int, default=50, help='Payloads written by every producer')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Characters per payload')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark_file_writer(args.producers, args.payloads, args.sizes, args.repeats)
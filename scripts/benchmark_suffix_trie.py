@@ -0,0 +1,104 @@
+import sys
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import PathMagic
+mkpath = PathMagic(__file__)
+
+from typing import Any, Callable
+
+from time import perf_counter
+import tracemalloc
+import argparse
+import os
+
+from src.suffixes import SuffixTrie, get_suffixes, SUFFIX_CACHE_SIZE
+from src.compression import open_text, find_file
+from tests.test_suffixes import DictSuffixTrie
+
+
+def load_suffixes(path: str) -> list[str]:
+    if not os.path.isfile(path):
+        # Derived from the dictionaries, and saved to `results/suffixes.txt`
+        return sorted(get_suffixes())
+    with open(path, 'r', encoding='utf-8') as file:
+        return list(filter(None, map(str.strip, file)))
+
+
+def load_words(path: str) -> list[str]:
+    """Words of a frequency file (`word freq` lines)"""
+    with open_text(path) as file:
+        return [line.split(' ', 1)[0] for line in filter(None, map(str.strip, file))]
+
+
+def measure(build: Callable[[], Any], words: list[str]) -> dict[str, float]:
+    # Memory first, tracing slows everything down
+    tracemalloc.start()
+    trie = build()
+    trie_memory = tracemalloc.get_traced_memory()[0]
+    for word in words:
+        trie.remove_suffix(word)
+    cache_memory = tracemalloc.get_traced_memory()[0] - trie_memory
+    tracemalloc.stop()
+    del trie
+
+    start_time = perf_counter()
+    trie = build()
+    build_time = perf_counter() - start_time
+
+    # Every word of the vocabulary once, so nothing is cached yet
+    start_time = perf_counter()
+    for word in words:
+        trie.remove_suffix(word)
+    cold_time = perf_counter() - start_time
+
+    # Only cached if the whole vocabulary fits in the cache
+    start_time = perf_counter()
+    for word in words:
+        trie.remove_suffix(word)
+    warm_time = perf_counter() - start_time
+
+    return {
+        'build_seconds': build_time,
+        'trie_mb': trie_memory / 2 ** 20,
+        'cache_mb': cache_memory / 2 ** 20,
+        'cold_words_per_second': len(words) / cold_time,
+        'warm_words_per_second': len(words) / warm_time,
+    }
+
+
+def benchmark_suffix_trie(suffixes_path: str, words_path: str, cache_size: int):
+    suffixes = load_suffixes(suffixes_path)
+    words = load_words(words_path)
+    print(f'{len(suffixes):,d} suffixes, {len(words):,d} words, cache of {cache_size:,d} words')
+
+    implementations: dict[str, Callable[[], Any]] = {
+        'dict': lambda: DictSuffixTrie(suffixes),
+        'array': lambda: SuffixTrie(suffixes, cache_size=cache_size),
+    }
+    results = {name: measure(build, words) for name, build in implementations.items()}
+
+    array_trie = SuffixTrie(suffixes, cache_size=0)
+    dict_trie = DictSuffixTrie(suffixes)
+    mismatches = sum(array_trie.remove_suffix(word) != dict_trie.remove_suffix(word) for word in words)
+    print(f'Nodes: {len(array_trie):,d}, mismatches: {mismatches:,d}')
+
+    for name, result in results.items():
+        print(
+            f'  {name:>5}: built in {result["build_seconds"]:.2f} s, trie {result["trie_mb"]:,.1f} MB, '
+            f'cache {result["cache_mb"]:,.1f} MB, {result["cold_words_per_second"]:,.0f} words/s cold, '
+            f'{result["warm_words_per_second"]:,.0f} words/s on the second pass'
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compares the memory and throughput of the array-backed SuffixTrie with the nested dict one'
+    )
+    parser.add_argument('--suffixes', default=mkpath('../results/suffixes.txt'))
+    parser.add_argument('--words', default=find_file(mkpath('../results/word_freq.txt')))
+    parser.add_argument('--cache-size', type=int, default=SUFFIX_CACHE_SIZE)
+    args = parser.parse_args()
+
+    benchmark_suffix_trie(args.suffixes, args.words, args.cache_size)
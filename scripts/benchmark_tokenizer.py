@@ -0,0 +1,252 @@
+import sys
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import PathMagic
+mkpath = PathMagic(__file__)
+
+from typing import Any, Callable, Iterator
+
+from time import perf_counter
+import itertools
+import argparse
+import random
+import json
+import os
+
+from src.tokenizer import TOKENIZERS
+
+
+BASELINE_PATH = 'results/tokenizer_benchmark.json'
+SIZES = (100_000, 1_000_000, 10_000_000)
+MAX_REGRESSION = 20  # %
+# Latencies below this are noise: changes are relative to at least this much
+MIN_COMPARED_LATENCY = 1.0  # ms
+
+SAMPLE_FILES = (
+    'tokenizer_dot_after_digit_before_letter.txt',
+    'tokenizer_long_word_1.txt',
+    'tokenizer_question_mark.txt',
+)
+
+SYNTHETIC_WORDS = (
+    'бул', 'жана', 'менен', 'үчүн', 'деп', 'болуп', 'анын', 'кыргыз', 'эле', 'мен', 'дагы', 'өлкөнүн',
+    'шаардык', 'милиция', 'жылы', 'бөлүмүнүн', 'маалыматтарына', 'караганда', 'республиканын', 'аймактарынан',
+    'Бишкек', 'Ош', 'Кыргызстан', 'Ак-Буура', 'жаңы', 'ырлар', 'көп', 'сөз', 'Sputnik', 'Public', 'ѳзгөчө',
+)
+SYNTHETIC_TAILS = ('.', '.', '.', '?', '!', '...', ':', '\n')
+
+
+def make_synthetic_text(rng: random.Random, size: int) -> str:
+    """Kyrgyz-like sentences with numbers, times and abbreviations"""
+    parts: list[str] = []
+    length = 0
+    while length < size:
+        words = rng.choices(SYNTHETIC_WORDS, k=rng.randint(3, 15))
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), rng.choice(('2017', '1,5', '23:59', '12.06.2024', 'т.б.', '№5')))
+        sentence = ' '.join(words).capitalize() + rng.choice(SYNTHETIC_TAILS)
+        parts.append(sentence)
+        length += len(sentence) + 1
+    return ' '.join(parts)
+
+
+def make_synthetic_texts(total_chars: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    texts: list[str] = []
+    while (chars := sum(map(len, texts))) < total_chars:
+        texts.append(make_synthetic_text(rng, min(rng.randint(200, 5_000), total_chars - chars)))
+    return texts
+
+
+def make_sample_texts(sample: list[str], total_chars: int) -> list[str]:
+    """Repeats the sample texts up to `total_chars`"""
+    texts: list[str] = []
+    chars = 0
+    for text in itertools.cycle(sample):
+        if chars >= total_chars:
+            break
+        texts.append(text)
+        chars += len(text)
+    return texts
+
+
+# Pathological documents, each is built with about `size` characters
+ADVERSARIAL: dict[str, Callable[[int], str]] = {
+    'dots': lambda size: 'Бул' + '.' * size + 'сөз',
+    'digits_colons': lambda size: '12:30:' * (size // 6) + '5',
+    'digits_dots': lambda size: '1.' * (size // 2) + '1,5',
+    'mixed_scripts': lambda size: 'kитеп Cөз ' * (size // 10),
+    # Dotted "word" that ends right before a word character which is not a letter,
+    # every dot is a new start for the word pattern (the runaway regex document #28158)
+    'runaway_word': lambda size: 'а.' * (size // 2) + 'а_',
+}
+ADVERSARIAL_SIZES = (1_000, 10_000, 100_000)
+
+
+def get_suites(sizes: list[int], sample: list[str]) -> dict[str, list[str]]:
+    suites: dict[str, list[str]] = {}
+    for size in sizes:
+        suites[f'synthetic_{size}'] = make_synthetic_texts(size)
+        suites[f'sample_{size}'] = make_sample_texts(sample, size)
+    for name, make_text in ADVERSARIAL.items():
+        suites[f'adversarial_{name}'] = [make_text(size) for size in ADVERSARIAL_SIZES]
+    return suites
+
+
+def iter_fineweb_texts() -> Iterator[str]:
+    from datasets import load_dataset
+
+    dataset = load_dataset('HuggingFaceFW/fineweb-2', name='kir_Cyrl', split='train', streaming=True)
+    for row in dataset.select_columns('text'):
+        yield row['text']
+
+
+def measure(process_text: Callable[[str], Iterator[list[str]]], texts: list[str], repeats: int) -> dict[str, Any]:
+    """The best time of every text over `repeats`, so that a single slow run does not count as a regression"""
+    text_times = [float('inf')] * len(texts)
+    tokens = 0
+    for _ in range(repeats):
+        tokens = 0
+        for text_index, text in enumerate(texts):
+            start_time = perf_counter()
+            tokens += sum(map(len, process_text(text)))
+            text_times[text_index] = min(text_times[text_index], perf_counter() - start_time)
+
+    total_time = sum(text_times)
+    chars = sum(map(len, texts))
+    worst_index = max(range(len(texts)), key=text_times.__getitem__)
+    return {
+        'texts': len(texts),
+        'chars': chars,
+        'tokens': tokens,
+        'seconds': total_time,
+        'chars_per_sec': chars / total_time,
+        'tokens_per_sec': tokens / total_time,
+        'worst_latency_ms': text_times[worst_index] * 1000,
+        'worst_chars': len(texts[worst_index]),
+    }
+
+
+def compare_with_baseline(
+    results: dict[str, dict[str, dict[str, Any]]],
+    baseline: dict[str, dict[str, dict[str, Any]]],
+    max_regression: float
+) -> list[str]:
+    """Descriptions of the regressions of more than `max_regression` %"""
+    regressions = []
+    for engine, suites in results.items():
+        for suite, result in suites.items():
+            if (expected := baseline.get(engine, {}).get(suite)) is None:
+                continue
+
+            change = (expected['chars_per_sec'] - result['chars_per_sec']) / expected['chars_per_sec'] * 100
+            if change > max_regression:
+                regressions.append(
+                    f'{engine} {suite}: {result["chars_per_sec"] / 1e6:.2f} M chars/s, '
+                    f'{change:.0f}% slower than {expected["chars_per_sec"] / 1e6:.2f}'
+                )
+
+            latency, expected_latency = result['worst_latency_ms'], expected['worst_latency_ms']
+            change = (latency - expected_latency) / max(expected_latency, MIN_COMPARED_LATENCY) * 100
+            if change > max_regression:
+                regressions.append(
+                    f'{engine} {suite}: worst latency {latency:.1f} ms, '
+                    f'{change:.0f}% slower than {expected_latency:.1f} ms'
+                )
+    return regressions
+
+
+def benchmark_tokenizers(
+    suites: dict[str, list[str]],
+    engines: list[str],
+    repeats: int,
+    baseline_path: str,
+    save_baseline: bool,
+    max_regression: float
+) -> bool:
+    results: dict[str, dict[str, dict[str, Any]]] = {engine: {} for engine in engines}
+    outputs_differ = []
+
+    for suite, texts in suites.items():
+        print(f'{suite}: {len(texts):,d} texts, {sum(map(len, texts)):,d} characters')
+        outputs = []
+        for engine in engines:
+            process_text = TOKENIZERS[engine].process_text
+            results[engine][suite] = result = measure(process_text, texts, repeats)
+            outputs.append([list(process_text(text)) for text in texts])
+            print(
+                f'  {engine:>6}: {result["chars_per_sec"] / 1e6:.2f} M chars/s, '
+                f'{result["tokens_per_sec"] / 1e6:.2f} M tokens/s, '
+                f'worst text {result["worst_latency_ms"]:.1f} ms ({result["worst_chars"]:,d} characters)'
+            )
+        if any(output != outputs[0] for output in outputs[1:]):
+            outputs_differ.append(suite)
+
+    print()
+    print(f'Outputs differ in: {", ".join(outputs_differ)}' if outputs_differ else 'Outputs are identical')
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(baseline_path) or '.', exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as file:
+            json.dump({'python': sys.version.split()[0], 'results': results}, file, indent=2)
+        print(f'Baseline saved to {baseline_path}')
+        return not outputs_differ
+
+    if not os.path.isfile(baseline_path):
+        print(f'No baseline at {baseline_path}, save one with --save-baseline')
+        return not outputs_differ
+
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = json.load(file)
+
+    regressions = compare_with_baseline(results, baseline['results'], max_regression)
+    if regressions:
+        print(f'Regressions of more than {max_regression}% against {baseline_path}:')
+        for regression in regressions:
+            print(f'  {regression}')
+    else:
+        print(f'No regressions of more than {max_regression}% against {baseline_path}')
+
+    return not regressions and not outputs_differ
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the tokenizer engines on synthetic, sample and adversarial texts '
+                    'and compares the results with a saved baseline'
+    )
+    parser.add_argument(
+        '--files', nargs='+', metavar='PATH',
+        help='Sample texts as for `run.py --files` (default: the texts of tests/data)'
+    )
+    parser.add_argument('--fineweb', action='store_true', help='Take the sample texts from fineweb-2')
+    parser.add_argument('--texts', type=int, default=10_000, help='Number of sample texts to read')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Characters of the corpora')
+    parser.add_argument('--engines', nargs='+', choices=TOKENIZERS, default=list(TOKENIZERS))
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--baseline', default=mkpath('..', BASELINE_PATH), help='Baseline JSON')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument(
+        '--max-regression', type=float, default=MAX_REGRESSION,
+        help='Fail if slower than the baseline by more than this many percent'
+    )
+    args = parser.parse_args()
+
+    if args.files:
+        from run import iter_file_texts
+        sample = list(itertools.islice(iter_file_texts(args.files), args.texts))
+    elif args.fineweb:
+        sample = list(itertools.islice(iter_fineweb_texts(), args.texts))
+    else:
+        sample = []
+        for filename in SAMPLE_FILES:
+            with open(mkpath('../tests/data', filename), 'r', encoding='utf-8') as file:
+                sample.append(file.read())
+
+    passed = benchmark_tokenizers(
+        get_suites(args.sizes, sample), args.engines, args.repeats, args.baseline, args.save_baseline,
+        args.max_regression
+    )
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,23 @@
+import sys
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import PathMagic
+mkpath = PathMagic(__file__)
+
+from src.utils import compact_shards, get_shard_paths
+from src.compression import get_compression_ext
+
+
+def compact_sentences():
+    print('Compacting sentence shards...')
+    shard_paths = get_shard_paths(mkpath('../results/sentences'))
+    # Compressed shards make a compressed file
+    output_name = 'sentences.txt' + ((get_compression_ext(shard_paths[0]) or '') if shard_paths else '')
+    size = compact_shards(mkpath('../results/sentences'), mkpath('../results', output_name))
+    print(f'Saved {size:,d} bytes to results/{output_name}')
+
+
+if __name__ == '__main__':
+    compact_sentences()
@@ -6,6 +6,8 @@ if __name__ == '__main__':
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
+from src.compression import open_text
+
 
 def count_words(min_freq=0):
     print(f'--- Freq >= {min_freq} ---')
@@ -13,7 +15,7 @@ def count_words(min_freq=0):
     letters: set[str] = set()
     words, apertium_words = set(), set()
 
-    with open(mkpath('../results/word_freq.txt'), 'r', encoding='utf-8') as file:
+    with open_text(mkpath('../results/word_freq.txt')) as file:
         for line in filter(None, file):
             word, freq = line.split(' ')
             if int(freq) < min_freq:
@@ -23,7 +25,7 @@ def count_words(min_freq=0):
 
     print(f'Words:          {len(words):{9 + 2},d}')
 
-    with open(mkpath('../results/base_apertium_freq.txt'), 'r', encoding='utf-8') as file:
+    with open_text(mkpath('../results/base_apertium_freq.txt')) as file:
         for line in filter(None, file):
             word, freq = line.split(' ')
             if int(freq) < min_freq:
@@ -34,7 +36,7 @@ def count_words(min_freq=0):
     print(f'Apertium words: {len(apertium_words):{9 + 2},d} ({len(apertium_words) / len(words):.2%})')
     print()
 
-    with open(mkpath('../results/apertium_mapper.txt'), 'r', encoding='utf-8') as file:
+    with open_text(mkpath('../results/apertium_mapper.txt')) as file:
         mapper_keys, mapper_values, mapper_unmapped = set(), set(), set()
         for line in map(str.strip, filter(None, file)):
             if ' ' in line:
@@ -0,0 +1,105 @@
+"""
+Compressed text outputs, made of independently compressed blocks (gzip members, xz or bz2 streams one after another),
+so that the blocks of a file can be compressed in parallel while any standard tool still reads the whole file.
+An index next to the file lists where every block ends, so that reading can start in the middle
+"""
+
+from typing import BinaryIO, Callable, Iterator, TextIO, cast
+
+from contextlib import contextmanager
+from functools import partial
+import lzma
+import gzip
+import bz2
+import io
+import os
+
+
+# Codecs by name (e.g. `run.py --compress`), and the extensions that select them
+COMPRESSIONS = {
+    'gzip': '.gz',
+    'lzma': '.xz',
+    'bz2': '.bz2',
+}
+# Uncompressed bytes per block
+BLOCK_SIZE = 4 * 1024 * 1024
+
+_COMPRESSORS: dict[str, Callable[[bytes], bytes]] = {
+    # No timestamp, so that the same data always gives the same file
+    '.gz': partial(gzip.compress, compresslevel=6, mtime=0),
+    '.xz': lzma.compress,
+    '.bz2': bz2.compress,
+}
+_DECOMPRESSORS: dict[str, Callable[[BinaryIO], BinaryIO]] = {
+    '.gz': lambda file: cast(BinaryIO, gzip.GzipFile(fileobj=file, mode='rb')),
+    '.xz': lambda file: cast(BinaryIO, lzma.LZMAFile(file)),
+    '.bz2': lambda file: cast(BinaryIO, bz2.BZ2File(file)),
+}
+
+
+def get_compression_ext(path: str) -> str | None:
+    """Extension of the codec of `path`, None for an uncompressed file"""
+    ext = os.path.splitext(path)[1]
+    return ext if ext in _COMPRESSORS else None
+
+
+def compress_block(ext: str, data: bytes | memoryview) -> bytes:
+    return _COMPRESSORS[ext](data)
+
+
+def get_index_path(path: str) -> str:
+    return path + '.idx'
+
+
+def read_index(path: str) -> list[tuple[int, int]]:
+    """Compressed and uncompressed offsets of the ends of the blocks of a compressed file"""
+    if not os.path.isfile(get_index_path(path)):
+        return []
+    with open(get_index_path(path), 'r', encoding='utf-8') as file:
+        return [(int(compressed), int(uncompressed)) for compressed, uncompressed in map(str.split, file)]
+
+
+def append_index(path: str, block_ends: list[tuple[int, int]], overwrite: bool = False):
+    with open(get_index_path(path), 'w' if overwrite else 'a', encoding='utf-8') as file:
+        file.write(''.join(f'{compressed} {uncompressed}\n' for compressed, uncompressed in block_ends))
+
+
+def find_file(path: str) -> str:
+    """`path`, or its compressed version if only that one exists"""
+    if not os.path.exists(path):
+        for ext in COMPRESSIONS.values():
+            if os.path.exists(path + ext):
+                return path + ext
+    return path
+
+
+@contextmanager
+def open_text(path: str, offset: int = 0) -> Iterator[TextIO]:
+    """
+    Opens a text file (or its compressed version, see `find_file`) for reading, decompressing it on the fly.
+    Reading starts at `offset` bytes of the uncompressed text. For compressed files only the blocks
+    from the one containing the offset are decompressed
+    """
+    path = find_file(path)
+    ext = get_compression_ext(path)
+
+    with open(path, 'rb') as raw_file:
+        if ext is None:
+            raw_file.seek(offset)
+            yield io.TextIOWrapper(raw_file, encoding='utf-8')
+            return
+
+        block_start = (0, 0)
+        for block_end in read_index(path):
+            if block_end[1] > offset:
+                break
+            block_start = block_end
+        if block_start[0] >= os.fstat(raw_file.fileno()).st_size:
+            # From the end of the text (or of an empty one), not a valid stream on its own
+            yield io.StringIO()
+            return
+        raw_file.seek(block_start[0])
+
+        with _DECOMPRESSORS[ext](raw_file) as file:
+            file.seek(offset - block_start[1])
+            yield io.TextIOWrapper(file, encoding='utf-8')
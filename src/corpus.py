@@ -0,0 +1,133 @@
+"""
+Binary token corpus: the sentences as a flat array of unsigned 32-bit little-endian word ids.
+
+Id `n` is the word on line `n` of `word_freq.txt` (1-based), `SENTENCE_END` (0) terminates every sentence.
+The file can be mapped directly, e.g. `numpy.memmap(path, dtype='<u4')` or `open_token_corpus`.
+
+Workers do not know the final ids, so every sentence shard gets a `.ids` file with ids local to the shard
+and a `.vocab` file with the words of these ids. `link_token_corpus` translates them into the final corpus.
+"""
+
+from typing import Iterable, Generator, Sequence, Final
+
+from contextlib import contextmanager
+from array import array
+import mmap
+import sys
+import os
+
+from src.compression import get_compression_ext, open_text
+from src.utils import get_shard_paths, mkpath
+
+
+SENTENCE_END = 0
+ID_TYPECODE: Final = 'I'
+
+assert array(ID_TYPECODE).itemsize == 4
+
+
+def _to_bytes(ids: 'array[int]') -> bytes:
+    if sys.byteorder == 'big':
+        ids = array(ID_TYPECODE, ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def _from_bytes(data: bytes) -> 'array[int]':
+    ids = array(ID_TYPECODE)
+    ids.frombytes(data)
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return ids
+
+
+def _get_shard_stem(shard_path: str) -> str:
+    # Without the compression extension as well (`00000001.txt.gz`)
+    if get_compression_ext(shard_path) is not None:
+        shard_path = os.path.splitext(shard_path)[0]
+    return os.path.splitext(shard_path)[0]
+
+
+def get_ids_path(shard_path: str) -> str:
+    return _get_shard_stem(shard_path) + '.ids'
+
+
+def get_vocab_path(shard_path: str) -> str:
+    return _get_shard_stem(shard_path) + '.vocab'
+
+
+def encode_sentences(sentences: Iterable[Sequence[str]], vocab: Iterable[str]) -> tuple[bytes, str]:
+    """
+    Encodes sentences with ids local to this shard. `vocab` must contain every word of the sentences.
+    Returns the contents of the `.ids` and `.vocab` files.
+    """
+    local_ids: dict[str, int] = {}
+    vocab_lines = []
+    for local_id, word in enumerate(vocab, SENTENCE_END + 1):
+        local_ids[word] = local_id
+        vocab_lines.append(word + '\n')
+
+    ids = array(ID_TYPECODE)
+    for sentence in sentences:
+        ids.extend(map(local_ids.__getitem__, sentence))
+        ids.append(SENTENCE_END)
+
+    return _to_bytes(ids), ''.join(vocab_lines)
+
+
+def load_vocab(word_freq_path: str) -> dict[str, int]:
+    """Final ids of the words, according to their order in `word_freq.txt`"""
+    with open_text(word_freq_path) as file:
+        return {
+            line.split(' ', 1)[0]: word_id
+            for word_id, line in enumerate(filter(None, map(str.strip, file)), SENTENCE_END + 1)
+        }
+
+
+def link_token_corpus(shards_directory: str, word_freq_path: str, output_path: str, remove_parts: bool = True) -> int:
+    """
+    Translates the local ids of all sentence shards (in manifest order) into the final ids
+    and concatenates them into `output_path`. Returns the number of ids written.
+    """
+    vocab = load_vocab(word_freq_path)
+    total_ids = 0
+
+    output_path = mkpath(output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    with open(output_path, 'wb') as output_file:
+        for shard_path in get_shard_paths(shards_directory):
+            with open(get_vocab_path(shard_path), 'r', encoding='utf-8') as file:
+                remap = [SENTENCE_END]
+                remap.extend(vocab[word] for word in map(str.strip, file))
+
+            with open(get_ids_path(shard_path), 'rb') as file:
+                local_ids = _from_bytes(file.read())
+
+            output_file.write(_to_bytes(array(ID_TYPECODE, map(remap.__getitem__, local_ids))))
+            total_ids += len(local_ids)
+            del local_ids
+
+            if remove_parts:
+                os.remove(get_ids_path(shard_path))
+                os.remove(get_vocab_path(shard_path))
+
+    return total_ids
+
+
+@contextmanager
+def open_token_corpus(path: str) -> Generator[memoryview, None, None]:
+    """Maps the corpus into memory as an array of ids (native byte order is assumed to be little-endian)"""
+    assert sys.byteorder == 'little', 'Memory-mapped corpus requires a little-endian machine'
+
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            yield memoryview(b'').cast(ID_TYPECODE)
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            ids = memoryview(mapped).cast(ID_TYPECODE)
+            try:
+                yield ids
+            finally:
+                ids.release()
@@ -0,0 +1,248 @@
+"""
+Word counts stored as runs: files with `word count` lines sorted by word.
+
+Runs are merged pairwise (in a tree) in the worker pool by `CountReducer`, and the few runs left at the end
+are combined with a k-way merge and an external sort by frequency, so no process holds all counts at once.
+
+With a thread pool the workers share memory, so `SharedCountReducer` adds the counts of every unit
+to a single `ShardedCounter` instead, and writes runs only for checkpoints.
+"""
+
+from typing import Iterable, Iterator, Mapping
+
+from concurrent.futures import Executor, Future, wait
+from collections import defaultdict
+from time import perf_counter
+import itertools
+import threading
+import tempfile
+import heapq
+import os
+
+from src.utils import mkpath
+
+
+# Counts sorted by frequency in memory at once when writing the final file
+SORT_BLOCK_SIZE = 1_000_000
+# Independently locked parts of a `ShardedCounter`
+COUNTER_SHARDS = 64
+
+
+def write_count_run(path: str, counts: 'Mapping[str, int] | ShardedCounter'):
+    path = mkpath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'w', encoding='utf-8') as file:
+        file.writelines(f'{word} {count}\n' for word, count in sorted(counts.items()))
+
+
+def iter_count_run(path: str) -> Iterator[tuple[str, int]]:
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            word, count = line.split(' ')
+            yield word, int(count)
+
+
+def iter_merged_counts(paths: Iterable[str]) -> Iterator[tuple[str, int]]:
+    """k-way merge of runs: yields every word once (in sorted order) with the sum of its counts"""
+    for word, group in itertools.groupby(
+        heapq.merge(*map(iter_count_run, paths)),
+        key=lambda item: item[0]
+    ):
+        yield word, sum(count for _, count in group)
+
+
+def merge_count_runs(paths: list[str], output_path: str) -> float:
+    """Merges runs into a single run. Returns the time spent (it usually runs in a worker)"""
+    start_time = perf_counter()
+
+    with open(output_path + '.tmp', 'w', encoding='utf-8') as file:
+        file.writelines(f'{word} {count}\n' for word, count in iter_merged_counts(paths))
+    os.replace(output_path + '.tmp', output_path)
+
+    return perf_counter() - start_time
+
+
+def get_unit_run_path(directory: str, name: str, unit_num: int) -> str:
+    """Run of a single work unit, written by the worker that processed it"""
+    return mkpath(directory, f'{name}.u{unit_num:08d}.run')
+
+
+def _freq_order(item: tuple[str, int]) -> tuple[int, str]:
+    # Ties are broken by the word itself, so the output does not depend on the order of merging
+    return -item[1], item[0]
+
+
+def _write_block(block: list[tuple[str, int]], directory: str) -> str:
+    block.sort(key=_freq_order)
+    with tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', dir=directory, suffix='.block', delete=False
+    ) as file:
+        file.writelines(f'{word} {count}\n' for word, count in block)
+        return file.name
+
+
+def write_freq_file(
+    runs: Iterable[str],
+    output_path: str,
+    block_size: int = SORT_BLOCK_SIZE
+) -> int:
+    """
+    Combines runs into `word freq` lines sorted by descending frequency (`word_freq.txt` format)
+    with an external sort: sorted blocks of `block_size` words are spilled to disk and merged.
+    Returns the number of words.
+    """
+    output_path = mkpath(output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    words_count = 0
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path)) as tmp_directory:
+        blocks = []
+        merged_counts = iter_merged_counts(runs)
+        while block := list(itertools.islice(merged_counts, block_size)):
+            words_count += len(block)
+            blocks.append(_write_block(block, tmp_directory))
+            del block
+
+        with open(output_path, 'w', encoding='utf-8') as file:
+            for i, (word, count) in enumerate(heapq.merge(*map(iter_count_run, blocks), key=_freq_order)):
+                file.write(f'{word} {count}' if not i else f'\n{word} {count}')
+
+    return words_count
+
+
+class CountReducer:
+    """
+    Merges runs of one counter pairwise in the executor, like a binary counter:
+    two runs of the same level (covering the same number of units) become one run of the next level.
+    At most ~log2(units) runs are left for the final combine.
+    """
+
+    def __init__(self, name: str, directory: str, merge_seq: int = 0):
+        self.name = name
+        self.directory = directory
+        self.merge_seq = merge_seq
+        # Complete runs waiting for a pair: level -> path
+        self.waiting: dict[int, str] = {}
+        # Merges in progress: output path, its level and inputs
+        self.merging: dict[Future[float], tuple[str, int, list[str]]] = {}
+        # Inputs of finished merges. They can be removed once no checkpoint refers to them
+        self.obsolete: list[str] = []
+
+    def add(self, executor: Executor, path: str, level: int = 0):
+        if level not in self.waiting:
+            self.waiting[level] = path
+            return
+
+        self.merge_seq += 1
+        output_path = mkpath(self.directory, f'{self.name}.m{self.merge_seq:08d}.run')
+        inputs = [self.waiting.pop(level), path]
+        self.merging[executor.submit(merge_count_runs, inputs, output_path)] = (output_path, level + 1, inputs)
+
+    def on_merged(self, executor: Executor, future: Future[float]) -> float:
+        """Handles a finished merge, returns the time it took"""
+        output_path, level, inputs = self.merging.pop(future)
+        merge_time = future.result()
+        self.obsolete.extend(inputs)
+        self.add(executor, output_path, level)
+        return merge_time
+
+    def get_runs(self) -> list[tuple[str, int]]:
+        """All complete runs with their levels (inputs of unfinished merges are still complete runs)"""
+        runs = [(path, level) for level, path in self.waiting.items()]
+        for _, level, inputs in self.merging.values():
+            runs.extend((path, level - 1) for path in inputs)
+        return runs
+
+    def remove_obsolete(self):
+        for path in self.obsolete:
+            os.remove(path)
+        self.obsolete.clear()
+
+
+class ShardedCounter:
+    """
+    Thread-safe word counts. Words are spread over shards with their own locks,
+    so threads adding different units rarely wait for each other.
+    """
+
+    def __init__(self, num_shards: int = COUNTER_SHARDS):
+        self._shards: list[defaultdict[str, int]] = [defaultdict(int) for _ in range(num_shards)]
+        self._locks = [threading.Lock() for _ in range(num_shards)]
+
+    def update(self, counts: Iterable[tuple[str, int]]):
+        # Grouped by shard first, so that every lock is taken once per update
+        num_shards = len(self._shards)
+        shard_items: list[list[tuple[str, int]]] = [[] for _ in range(num_shards)]
+        for item in counts:
+            shard_items[hash(item[0]) % num_shards].append(item)
+
+        for shard, lock, items in zip(self._shards, self._locks, shard_items):
+            if not items:
+                continue
+            with lock:
+                for word, count in items:
+                    shard[word] += count
+
+    def items(self) -> Iterator[tuple[str, int]]:
+        """All counts. Not synchronized: updates must not run at the same time"""
+        for shard in self._shards:
+            yield from shard.items()
+
+    def __len__(self) -> int:
+        return sum(map(len, self._shards))
+
+
+class SharedCountReducer:
+    """
+    Same role as `CountReducer` for workers in threads: the counts of every unit are added to a shared
+    `ShardedCounter` in the executor. `get_runs` saves a snapshot run (it waits for the updates in progress).
+    """
+
+    def __init__(self, name: str, directory: str, merge_seq: int = 0):
+        self.name = name
+        self.directory = directory
+        self.merge_seq = merge_seq
+        self.counter = ShardedCounter()
+        # Updates in progress
+        self.merging: set[Future[float]] = set()
+        # Runs no checkpoint will refer to after the next one
+        self.obsolete: list[str] = []
+        self._snapshot: str | None = None
+        self._changed = True
+
+    def _update(self, counts: Mapping[str, int]) -> float:
+        start_time = perf_counter()
+        self.counter.update(counts.items())
+        return perf_counter() - start_time
+
+    def add(self, executor: Executor, path: str, level: int = 0):
+        """Loads a run, e.g. a snapshot saved by a checkpoint"""
+        self.counter.update(iter_count_run(path))
+        self.obsolete.append(path)
+        self._changed = True
+
+    def add_counts(self, executor: Executor, counts: Mapping[str, int]):
+        self.merging.add(executor.submit(self._update, counts))
+        self._changed = True
+
+    def on_merged(self, executor: Executor, future: Future[float]) -> float:
+        self.merging.remove(future)
+        return future.result()
+
+    def get_runs(self) -> list[tuple[str, int]]:
+        wait(self.merging)
+        if self._changed or self._snapshot is None:
+            if self._snapshot is not None:
+                self.obsolete.append(self._snapshot)
+            self.merge_seq += 1
+            self._snapshot = mkpath(self.directory, f'{self.name}.s{self.merge_seq:08d}.run')
+            write_count_run(self._snapshot, self.counter)
+            self._changed = False
+        return [(self._snapshot, 0)]
+
+    def remove_obsolete(self):
+        for path in self.obsolete:
+            os.remove(path)
+        self.obsolete.clear()
@@ -0,0 +1,147 @@
+"""
+Exact deduplication of sentences and near-duplicate detection of documents (MinHash),
+shared by all worker processes through a hash set in shared memory
+"""
+
+from typing import Any, Iterable
+
+from multiprocessing import Lock, RawArray
+from hashlib import blake2b
+from zlib import crc32
+import random
+import os
+
+from src.utils import print_async
+
+
+# Slots of a set. Every slot takes 12 bytes (64-bit hash and the unit that added it)
+DEDUP_CAPACITY = 1 << 24
+# Fuller sets stop taking new hashes (their duplicates pass unnoticed), probing would become too long
+MAX_LOAD = 0.9
+# Unit of a hash that was forgotten (see `SharedHashSet.load`), its slot is reused by the same hash
+FORGOTTEN = 0xFFFFFFFF
+
+MINHASH_BINS = 32
+MINHASH_BAND_SIZE = 4
+SHINGLE_WORDS = 5
+# The bins that an empty bin is filled from, in order. Random, but the same in every process and run
+_DENSIFICATION_ORDERS = [
+    random.Random(bin_index).sample(range(MINHASH_BINS), MINHASH_BINS) for bin_index in range(MINHASH_BINS)
+]
+
+
+def hash_key(data: str) -> int:
+    """Stable (unlike `hash`) 64-bit hash, never 0 (an empty slot)"""
+    return int.from_bytes(blake2b(data.encode('utf-8'), digest_size=8).digest(), 'little') or 1
+
+
+def get_minhash_bands(text: str) -> list[int]:
+    """
+    Keys of the MinHash bands of the word shingles of a text (one-permutation hashing: every shingle hash goes
+    into one of `MINHASH_BINS` bins by its value). Texts sharing a band key are likely near-duplicates
+    """
+    # Stable hashes of the words, combined by the hash of int tuples (which is not salted, unlike `str`)
+    word_hashes = list(map(crc32, map(str.encode, text.lower().split())))
+    shingle_hashes = set(map(hash, zip(*(word_hashes[i:] for i in range(SHINGLE_WORDS))))) or {hash(tuple(word_hashes))}
+
+    # The smallest hash of every bin is assigned last
+    min_hashes = {shingle_hash % MINHASH_BINS: shingle_hash for shingle_hash in sorted(shingle_hashes, reverse=True)}
+    # Short texts leave bins empty. Filled from the first non-empty bin in a fixed order (optimal densification),
+    # so that two texts still share a bin with the probability of their similarity
+    bins = [
+        min_hashes[bin_index] if bin_index in min_hashes
+        else next(min_hashes[other] for other in _DENSIFICATION_ORDERS[bin_index] if other in min_hashes)
+        for bin_index in range(MINHASH_BINS)
+    ]
+
+    return [
+        hash_key(f'{band_start}:' + ','.join(map(str, bins[band_start:band_start + MINHASH_BAND_SIZE])))
+        for band_start in range(0, MINHASH_BINS, MINHASH_BAND_SIZE)
+    ]
+
+
+class SharedHashSet:
+    """
+    Open addressing set of 64-bit hashes in shared memory, safe to use from the worker processes.
+    Every hash remembers the work unit that added it, so that a resumed run forgets the hashes of the units
+    that were not committed by the checkpoint
+    """
+
+    def __init__(self, keys: Any, units: Any, size: Any, lock: Any):
+        self.bind_args = (keys, units, size, lock)
+        self.capacity = len(keys)
+        self._keys = memoryview(keys).cast('B').cast('Q')
+        self._units = memoryview(units).cast('B').cast('I')
+        self._size = size
+        self._lock = lock
+        self._warned = False
+
+    @classmethod
+    def create(cls, capacity: int = DEDUP_CAPACITY) -> 'SharedHashSet':
+        return cls(RawArray('Q', capacity), RawArray('I', capacity), RawArray('Q', 1), Lock())
+
+    def __len__(self) -> int:
+        return self._size[0]
+
+    def add_new(self, keys: Iterable[int], unit_num: int) -> list[bool]:
+        """Adds the hashes, and tells for every one of them if it was new (repeated ones are new only once)"""
+        capacity = self.capacity
+        set_keys = self._keys
+        set_units = self._units
+        max_size = int(capacity * MAX_LOAD)
+        result = []
+
+        with self._lock:
+            size = self._size[0]
+            for key in keys:
+                slot = key % capacity
+                while (slot_key := set_keys[slot]) and slot_key != key:
+                    slot = slot + 1 if slot + 1 < capacity else 0
+
+                if slot_key:
+                    if set_units[slot] != FORGOTTEN:
+                        result.append(False)
+                        continue
+                elif size >= max_size:
+                    # The hash is not stored, so its duplicates are not going to be found
+                    result.append(True)
+                    if not self._warned:
+                        print_async(f'[Dedup] Hash set is full ({size:,d} hashes), increase its capacity')
+                        self._warned = True
+                    continue
+                else:
+                    set_keys[slot] = key
+                    size += 1
+
+                set_units[slot] = unit_num
+                result.append(True)
+            self._size[0] = size
+
+        return result
+
+    def save(self, path: str):
+        """Writes the set (atomically replacing `path`)"""
+        with open(path + '.tmp', 'wb') as file, self._lock:
+            file.write(self._keys.cast('B'))
+            file.write(self._units.cast('B'))
+        os.replace(path + '.tmp', path)
+
+    def load(self, path: str, max_unit_num: int):
+        """Reads a set saved by `save`, and forgets the hashes added by the units after `max_unit_num`"""
+        if os.path.getsize(path) != self.capacity * 12:
+            raise ValueError(f'[Dedup] {path} was saved with a different capacity')
+
+        with open(path, 'rb') as file, self._lock:
+            file.readinto(self._keys.cast('B'))
+            file.readinto(self._units.cast('B'))
+
+            set_units = self._units
+            size = 0
+            for slot, key in enumerate(self._keys):
+                if not key:
+                    continue
+                # Forgotten hashes keep their slots, the probing of the others goes through them
+                size += 1
+                if set_units[slot] > max_unit_num:
+                    set_units[slot] = FORGOTTEN
+            self._size[0] = size
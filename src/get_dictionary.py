@@ -1,3 +1,11 @@
+from typing import Any, ItemsView, Iterable, Iterator, Mapping
+
+from functools import partial
+from hashlib import blake2b
+from array import array
+import itertools
+import mmap
+import json
 import sys
 import os
 
@@ -8,16 +16,44 @@ from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
 
-def _get_dictionary_path(dictionary_name: str) -> str:
-    return mkpath(f'../results/{dictionary_name}.txt')
+DICTIONARIES_DIR = mkpath('../results')
+KAIKKI_TILI = 'kaikki_words_by_base'
+KYRGYZ_TILI = 'kyrgyz_tili_words_by_base'
+# Changes whenever the layout of the compiled dictionaries changes
+DICTIONARY_CACHE_VERSION = 1
 
 
-def _load_file(dictionary_name) -> tuple[dict[str, list[str]], dict[str, str]]:
-    print(f'[Dictionary] Loading {dictionary_name} dictionary...')
+def get_dictionary_path(dictionary_name: str) -> str:
+    return os.path.join(DICTIONARIES_DIR, f'{dictionary_name}.txt')
+
+
+def get_dictionary_cache_path(dictionary_name: str) -> str:
+    return os.path.join(DICTIONARIES_DIR, f'{dictionary_name}.bin')
+
+
+def get_file_digest(path: str) -> str:
+    digest = blake2b()
+    with open(path, 'rb') as file:
+        for chunk in iter(partial(file.read, 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 
+def get_file_stamp(path: str) -> list[int]:
+    """Size and modification time, compared before the (slower) digest"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _align(size: int) -> int:
+    # Arrays of the compiled dictionary start at 8-byte boundaries
+    return (size + 7) & ~7
+
+
+def _parse_file(dictionary_name: str) -> tuple[dict[str, list[str]], dict[str, str]]:
     pre_dictionary: list[tuple[str, list[str]]] = []
 
-    with open(_get_dictionary_path(dictionary_name), 'r', encoding='utf-8') as file:
+    with open(get_dictionary_path(dictionary_name), 'r', encoding='utf-8') as file:
         for line in filter(None, map(str.strip, file)):
             if not line.startswith('├╴'):
                 pre_dictionary.append((line, []))
@@ -41,18 +77,222 @@ def _load_file(dictionary_name) -> tuple[dict[str, list[str]], dict[str, str]]:
     return dictionary, word_to_base
 
 
-def get_kaikki_tili() -> tuple[dict[str, list[str]], dict[str, str]]:
-    if not os.path.isfile(_get_dictionary_path('kaikki_words_by_base')):
+def _compile(
+    path: str, dictionary: dict[str, list[str]], word_to_base: dict[str, str], stamp: list[int], digest: str
+):
+    """
+    Writes a dictionary as a JSON header line followed by arrays (in native byte order) over its words
+    sorted by their UTF-8 bytes: offsets of the words in the blob of all words, the id of the base of every word,
+    offsets of the forms of every word in the ids of all forms, flags of the bases, and the blob itself
+    """
+    encoded_words = sorted(word.encode('utf-8') for word in word_to_base)
+    words = [word.decode('utf-8') for word in encoded_words]
+    word_ids = {word: word_id for word_id, word in enumerate(words)}
+    word_offsets = array('I', itertools.accumulate(map(len, encoded_words), initial=0))
+    word_bases = array('i', (word_ids[word_to_base[word]] for word in words))
+
+    form_starts = array('I', [0])
+    form_ids = array('i')
+    is_base = bytearray(len(words))
+    for word_id, word in enumerate(words):
+        if (forms := dictionary.get(word)) is not None:
+            is_base[word_id] = 1
+            form_ids.extend(map(word_ids.__getitem__, forms))
+        form_starts.append(len(form_ids))
+
+    header = {
+        'version': DICTIONARY_CACHE_VERSION,
+        'byteorder': sys.byteorder,
+        'source': stamp,
+        'digest': digest,
+        'words': len(words),
+        'bases': len(dictionary),
+        'forms': len(form_ids),
+    }
+    _write_sections(path, header, (word_offsets, word_bases, form_starts, form_ids, is_base, b''.join(encoded_words)))
+
+
+def _write_sections(
+    path: str, header: dict[str, Any], sections: Iterable['bytes | bytearray | memoryview | array[int]']
+):
+    # Replaced atomically: other processes may have the previous one mapped
+    with open(path + '.tmp', 'wb') as file:
+        for section in (json.dumps(header).encode('utf-8') + b'\n', *sections):
+            data = memoryview(section).cast('B')
+            file.write(data)
+            file.write(bytes(_align(len(data)) - len(data)))
+    os.replace(path + '.tmp', path)
+
+
+class CompiledDictionary:
+    """
+    Dictionary mapped from the file written by `_compile`. Words are found by binary search over the sorted
+    words and decoded only when they are returned, so nothing is loaded up front. Mapped until `close`,
+    or until neither it nor its `WordBases` and `DictionaryForms` are referenced anymore
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = self.mmap.find(b'\n') + 1
+        self.header = json.loads(self.mmap[:header_size])
+
+        words = self.header['words']
+        offset = self.data_offset = _align(header_size)
+        sections = []
+        with memoryview(self.mmap) as data:
+            for size in (4 * (words + 1), 4 * words, 4 * (words + 1), 4 * self.header['forms'], words):
+                sections.append(data[offset:offset + size])
+                offset += _align(size)
+        self.word_offsets = sections[0].cast('I')
+        self.word_bases = sections[1].cast('i')
+        self.form_starts = sections[2].cast('I')
+        self.form_ids = sections[3].cast('i')
+        self.is_base = sections[4]
+        self._blob_offset = offset
+
+    def close(self):
+        # The views first, a mapping with exported buffers can not be closed
+        for view in (self.word_offsets, self.word_bases, self.form_starts, self.form_ids, self.is_base):
+            view.release()
+        self.mmap.close()
+
+    def __len__(self) -> int:
+        return self.header['words']
+
+    def _get_word_bytes(self, word_id: int) -> bytes:
+        return self.mmap[
+            self._blob_offset + self.word_offsets[word_id]:self._blob_offset + self.word_offsets[word_id + 1]
+        ]
+
+    def get_word(self, word_id: int) -> str:
+        return self._get_word_bytes(word_id).decode('utf-8')
+
+    def get_forms(self, word_id: int) -> list[str]:
+        return [
+            self.get_word(form_id)
+            for form_id in self.form_ids[self.form_starts[word_id]:self.form_starts[word_id + 1]]
+        ]
+
+    def find(self, word: str) -> int | None:
+        """Id of the word, None if it is not in the dictionary"""
+        key = word.encode('utf-8')
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_word_bytes(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low if low < len(self) and self._get_word_bytes(low) == key else None
+
+
+class WordBases(Mapping[str, str]):
+    """`word_to_base` of a compiled dictionary, iterated in the order of the UTF-8 bytes of the words"""
+
+    def __init__(self, compiled: CompiledDictionary):
+        self._compiled = compiled
+
+    def __getitem__(self, word: str) -> str:
+        if (word_id := self._compiled.find(word)) is None:
+            raise KeyError(word)
+        return self._compiled.get_word(self._compiled.word_bases[word_id])
+
+    def __iter__(self) -> Iterator[str]:
+        return map(self._compiled.get_word, range(len(self._compiled)))
+
+    def __len__(self) -> int:
+        return len(self._compiled)
+
+
+class DictionaryForms(Mapping[str, list[str]]):
+    """Forms of every base word of a compiled dictionary, iterated in the order of the UTF-8 bytes of the bases"""
+
+    def __init__(self, compiled: CompiledDictionary):
+        self._compiled = compiled
+
+    def __getitem__(self, base: str) -> list[str]:
+        if (word_id := self._compiled.find(base)) is None or not self._compiled.is_base[word_id]:
+            raise KeyError(base)
+        return self._compiled.get_forms(word_id)
+
+    def __iter__(self) -> Iterator[str]:
+        return (self._compiled.get_word(word_id) for word_id in self._get_base_ids())
+
+    def __len__(self) -> int:
+        return self._compiled.header['bases']
+
+    def _get_base_ids(self) -> Iterator[int]:
+        return (word_id for word_id, is_base in enumerate(self._compiled.is_base) if is_base)
+
+    def iter_items(self) -> Iterator[tuple[str, list[str]]]:
+        return (
+            (self._compiled.get_word(word_id), self._compiled.get_forms(word_id)) for word_id in self._get_base_ids()
+        )
+
+    def items(self) -> ItemsView[str, list[str]]:
+        return _DictionaryItems(self)
+
+
+class _DictionaryItems(ItemsView[str, list[str]]):
+    # Sequential, instead of a search for every base
+    def __init__(self, forms: DictionaryForms):
+        super().__init__(forms)
+        self._forms = forms
+
+    def __iter__(self) -> Iterator[tuple[str, list[str]]]:
+        return self._forms.iter_items()
+
+
+def _load_file(dictionary_name: str) -> tuple[Mapping[str, list[str]], Mapping[str, str]]:
+    """
+    Maps the compiled dictionary, compiling it first if the text file changed since (sizes and modification times
+    are compared first, the contents are hashed only if they differ)
+    """
+    print(f'[Dictionary] Loading {dictionary_name} dictionary...')
+    path = get_dictionary_path(dictionary_name)
+    cache_path = get_dictionary_cache_path(dictionary_name)
+    stamp = get_file_stamp(path)
+
+    compiled = CompiledDictionary(cache_path) if os.path.isfile(cache_path) else None
+    if compiled is not None and (
+        compiled.header['version'] != DICTIONARY_CACHE_VERSION
+        or compiled.header['byteorder'] != sys.byteorder
+        or (compiled.header['source'] != stamp and compiled.header['digest'] != get_file_digest(path))
+    ):
+        # Closed before the file is replaced, which Windows refuses while it is mapped
+        compiled.close()
+        compiled = None
+
+    if compiled is None:
+        dictionary, word_to_base = _parse_file(dictionary_name)
+        _compile(cache_path, dictionary, word_to_base, stamp, get_file_digest(path))
+        del dictionary, word_to_base
+        compiled = CompiledDictionary(cache_path)
+    elif compiled.header['source'] != stamp:
+        # Touched only: the same arrays with the new stamp, so that the file is not hashed next time.
+        # Copied and closed first, like a stale one
+        header, arrays = compiled.header | {'source': stamp}, compiled.mmap[compiled.data_offset:]
+        compiled.close()
+        _write_sections(cache_path, header, [arrays])
+        del arrays
+        compiled = CompiledDictionary(cache_path)
+
+    return DictionaryForms(compiled), WordBases(compiled)
+
+
+def get_kaikki_tili() -> tuple[Mapping[str, list[str]], Mapping[str, str]]:
+    if not os.path.isfile(get_dictionary_path(KAIKKI_TILI)):
         from dictionary.gen import gen_kaikki
         gen_kaikki()
-    return _load_file('kaikki_words_by_base')
+    return _load_file(KAIKKI_TILI)
 
 
-def get_kyrgyz_tili() -> tuple[dict[str, list[str]], dict[str, str]]:
-    if not os.path.isfile(_get_dictionary_path('kyrgyz_tili_words_by_base')):
+def get_kyrgyz_tili() -> tuple[Mapping[str, list[str]], Mapping[str, str]]:
+    if not os.path.isfile(get_dictionary_path(KYRGYZ_TILI)):
         from dictionary.gen import gen_kyrgyz_tili
         gen_kyrgyz_tili()
-    return _load_file('kyrgyz_tili_words_by_base')
+    return _load_file(KYRGYZ_TILI)
 
 
 if __name__ == '__main__':
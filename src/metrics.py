@@ -0,0 +1,152 @@
+from typing import Any
+
+from time import time
+import json
+import sys
+import os
+
+from src.utils import mkpath
+
+try:
+    import resource
+
+    def get_peak_rss() -> int | None:
+        """Peak resident set size of the current process in bytes"""
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+except ImportError:  # Windows
+    def get_peak_rss() -> int | None:
+        return None
+
+
+class StageMetrics:
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.texts = 0
+        self.bytes = 0
+        self.tokens = 0
+
+    def add(self, seconds: float, texts: int = 0, data_bytes: int = 0, tokens: int = 0):
+        self.seconds += seconds
+        self.calls += 1
+        self.texts += texts
+        self.bytes += data_bytes
+        self.tokens += tokens
+
+    def merge(self, other: 'StageMetrics'):
+        self.seconds += other.seconds
+        self.calls += other.calls
+        self.texts += other.texts
+        self.bytes += other.bytes
+        self.tokens += other.tokens
+
+    def to_dict(self) -> dict[str, float]:
+        return {
+            'seconds': round(self.seconds, 3),
+            'calls': self.calls,
+            'texts': self.texts,
+            'bytes': self.bytes,
+            'tokens': self.tokens,
+            'texts_per_second': round(self.texts / self.seconds, 1) if self.seconds else 0,
+            'bytes_per_second': round(self.bytes / self.seconds, 1) if self.seconds else 0,
+            'tokens_per_second': round(self.tokens / self.seconds, 1) if self.seconds else 0,
+        }
+
+
+class WorkerStats:
+    def __init__(self):
+        self.units = 0
+        self.texts = 0
+        self.chars = 0
+        self.busy_time = 0.0
+        self.peak_rss: int | None = None
+
+    def update(self, texts: int, chars: int, busy_time: float, peak_rss: int | None):
+        self.units += 1
+        self.texts += texts
+        self.chars += chars
+        self.busy_time += busy_time
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, peak_rss)
+
+
+class Metrics:
+    """
+    Time and amount of data for every stage of the pipeline.
+    Every process collects its own metrics, the parent merges them.
+    """
+
+    def __init__(self):
+        self.started_at = time()
+        self.stages: dict[str, StageMetrics] = {}
+        self.workers: dict[int, WorkerStats] = {}
+        # Texts or sentences (and their bytes) left out by the pre-filter and deduplication, by reason
+        self.skipped: dict[str, StageMetrics] = {}
+        # Log2 histograms (e.g. of the FileWriter queue), see `src.utils.HISTOGRAM_BUCKETS`
+        self.histograms: dict[str, list[int]] = {}
+        # Counters of the FileWriter process, see `FileWriter.get_stats`
+        self.file_writer: dict[str, Any] = {}
+
+    def add(self, stage: str, seconds: float, texts: int = 0, data_bytes: int = 0, tokens: int = 0):
+        if stage not in self.stages:
+            self.stages[stage] = StageMetrics()
+        self.stages[stage].add(seconds, texts, data_bytes, tokens)
+
+    def add_skipped(self, reason: str, count: int = 0, data_bytes: int = 0):
+        self.skipped.setdefault(reason, StageMetrics()).add(0, count, data_bytes)
+
+    def merge(self, other: 'Metrics'):
+        for stage, stage_metrics in other.stages.items():
+            self.stages.setdefault(stage, StageMetrics()).merge(stage_metrics)
+        for reason, skipped in other.skipped.items():
+            self.skipped.setdefault(reason, StageMetrics()).merge(skipped)
+
+    def update_worker(self, pid: int, texts: int, chars: int, busy_time: float, peak_rss: int | None):
+        self.workers.setdefault(pid, WorkerStats()).update(texts, chars, busy_time, peak_rss)
+
+    def get_utilization(self) -> float:
+        wall_time = time() - self.started_at
+        if not self.workers or not wall_time:
+            return 0
+        return sum(stats.busy_time for stats in self.workers.values()) / (wall_time * len(self.workers))
+
+    def to_dict(self) -> dict[str, Any]:
+        wall_time = time() - self.started_at
+        return {
+            'wall_seconds': round(wall_time, 3),
+            'parent_peak_rss': get_peak_rss(),
+            'stages': {stage: stage_metrics.to_dict() for stage, stage_metrics in self.stages.items()},
+            'histograms': self.histograms,
+            'file_writer': self.file_writer,
+            'skipped': {
+                reason: {'count': skipped.texts, 'bytes': skipped.bytes} for reason, skipped in self.skipped.items()
+            },
+            'workers': {
+                str(pid): {
+                    'units': stats.units,
+                    'texts': stats.texts,
+                    'chars': stats.chars,
+                    'busy_seconds': round(stats.busy_time, 3),
+                    'idle_seconds': round(max(0.0, wall_time - stats.busy_time), 3),
+                    'utilization': round(stats.busy_time / wall_time, 4) if wall_time else 0,
+                    'peak_rss': stats.peak_rss,
+                }
+                for pid, stats in sorted(self.workers.items())
+            },
+        }
+
+    def dump(self, path: str):
+        path = mkpath(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self.to_dict(), file, indent=4)
+        os.replace(path + '.tmp', path)
+
+    def get_summary(self) -> str:
+        return ', '.join(
+            f'{stage} {stage_metrics.seconds:.0f} s'
+            for stage, stage_metrics in sorted(self.stages.items(), key=lambda x: x[1].seconds, reverse=True)
+        )
@@ -0,0 +1,55 @@
+"""
+Normalization shared by every stage: look-alike characters are replaced by the Kyrgyz ones,
+and, where words are compared regardless of case, lowercasing is fused into the same `str.translate` pass.
+"""
+
+REPLACEMENTS = {
+    # 'c': 'с',
+    # 'o': 'о',
+    # 'p': 'р',
+    # 'a': 'а',
+    # 'e': 'е',
+    # 'y': 'у',
+
+    # 'ё': 'е',
+    # 'ң': 'н',
+    # 'ө': 'о',
+    # 'ү': 'у',
+
+    'ѳ': 'ө',  # Careful! Renders the same
+
+    # '-': None,
+    # '–': None,
+    # '—': None,
+
+    'ї': 'ү',
+    'є': 'ө',
+    'ў': 'ң',
+}
+REPLACEMENTS.update({k.upper(): (v.upper() if v else v) for k, v in REPLACEMENTS.items()})
+TRANSLATION_TABLE = str.maketrans(REPLACEMENTS)
+
+
+class _FoldedTranslationTable(dict[int, str | None]):
+    """
+    `TRANSLATION_TABLE` followed by lowercasing, computed once per distinct character.
+    Characters that change length when lowercased (e.g. `İ`) are only replaced, so offsets stay the same
+    """
+
+    def __missing__(self, code: int) -> str | None:
+        char = chr(code).translate(TRANSLATION_TABLE)
+        folded = char.lower()
+        value = folded if len(folded) == len(char) else char
+        self[code] = value
+        return value
+
+
+FOLDED_TRANSLATION_TABLE = _FoldedTranslationTable()
+
+
+def normalize(text: str, fold_case: bool = False) -> str:
+    """
+    Replaces look-alike characters, and lowercases the text if `fold_case`.
+    Same as `text.translate(TRANSLATION_TABLE).lower()` for the words of the tokenizer, in a single pass
+    """
+    return text.translate(FOLDED_TRANSLATION_TABLE if fold_case else TRANSLATION_TABLE)
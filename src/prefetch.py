@@ -0,0 +1,103 @@
+"""
+Background preparation of the next items of an iterator (e.g. reading and pickling the next work units)
+while the current ones are processed.
+"""
+
+from typing import Callable, Generic, Iterator, TypeVar
+
+from collections import deque
+from time import perf_counter
+import threading
+
+T = TypeVar('T')
+
+
+class Prefetcher(Generic[T]):
+    """
+    Runs `items` in a daemon thread and keeps up to `max_items` of them ready, but no more than `max_bytes`
+    in total according to `get_size` (a single item is always allowed, however large it is).
+
+    Exceptions of the iterator are raised by `get`. `close` stops the thread after the item it is preparing.
+    """
+
+    def __init__(self, items: Iterator[T], max_items: int, max_bytes: int, get_size: Callable[[T], int]):
+        self.max_items = max(1, max_items)
+        self.max_bytes = max_bytes
+        self._items = items
+        self._get_size = get_size
+
+        self._ready: deque[tuple[T, int]] = deque()
+        self._ready_bytes = 0
+        self._exhausted = False
+        self._closed = False
+        self._error: Exception | None = None
+        self._condition = threading.Condition()
+
+        # Time the thread was blocked because the consumer did not take the items
+        self.full_time = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='prefetcher', daemon=True)
+        self._thread.start()
+
+    def _is_full(self) -> bool:
+        return bool(self._ready) and (len(self._ready) >= self.max_items or self._ready_bytes >= self.max_bytes)
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    stage_start = perf_counter()
+                    self._condition.wait_for(lambda: self._closed or not self._is_full())
+                    self.full_time += perf_counter() - stage_start
+                    if self._closed:
+                        return
+
+                item = next(self._items, None)
+                if item is None:
+                    break
+
+                size = self._get_size(item)
+                with self._condition:
+                    self._ready.append((item, size))
+                    self._ready_bytes += size
+                    self._condition.notify_all()
+                del item
+
+        except Exception as e:
+            self._error = e
+
+        with self._condition:
+            self._exhausted = True
+            self._condition.notify_all()
+
+    def get(self, block: bool = True) -> T | None:
+        """
+        The next item. `None` if the iterator is exhausted or, if not `block`, no item is ready yet
+        (`is_done` tells them apart)
+        """
+        with self._condition:
+            if block:
+                self._condition.wait_for(lambda: self._ready or self._exhausted)
+
+            if not self._ready:
+                if self._exhausted and self._error is not None:
+                    raise self._error
+                return None
+
+            item, size = self._ready.popleft()
+            self._ready_bytes -= size
+            self._condition.notify_all()
+            return item
+
+    def is_done(self) -> bool:
+        """All items were taken. Not after an error of the iterator, which is raised by the next `get`"""
+        with self._condition:
+            return self._exhausted and not self._ready and self._error is None
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._ready.clear()
+            self._ready_bytes = 0
+            self._condition.notify_all()
+        self._thread.join()
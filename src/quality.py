@@ -0,0 +1,75 @@
+"""
+Cheap language and quality checks of whole documents, done before they reach the tokenizer.
+A document is looked at through a histogram of its character classes, computed with a single `str.translate`
+"""
+
+from typing import NamedTuple
+
+import unicodedata
+
+
+class QualityThresholds(NamedTuple):
+    min_chars: int = 50
+    max_chars: int = 1_000_000
+    # Letters among the non-whitespace characters (lower for boilerplate: numbers, menus, markup)
+    min_letter_ratio: float = 0.5
+    # Cyrillic letters among the letters (lower for Latin texts)
+    min_cyrillic_ratio: float = 0.6
+    # `ңөү` among the Cyrillic letters (they are about 7% of Kyrgyz text, and absent from Russian)
+    min_kyrgyz_ratio: float = 0.01
+
+
+# Histogram classes: `k` letters specific to Kyrgyz, `c` other Cyrillic letters, `a` other letters,
+# `d` digits, ` ` whitespace, `o` anything else
+CHAR_CLASSES_ORDER = 'kcad o'
+
+
+class _QualityClasses(dict[int, str]):
+    """`str.translate` table: every character becomes a single character of its class"""
+
+    KYRGYZ = set('ңөүҢӨҮ')
+
+    def __missing__(self, code: int) -> str:
+        char = chr(code)
+        if char in self.KYRGYZ:
+            char_class = 'k'
+        elif char.isalpha():
+            char_class = 'c' if unicodedata.name(char, '').startswith('CYRILLIC') else 'a'
+        elif char.isdigit():
+            char_class = 'd'
+        elif char.isspace():
+            char_class = ' '
+        else:
+            char_class = 'o'
+
+        self[code] = char_class
+        return char_class
+
+
+CHAR_CLASSES = _QualityClasses()
+
+
+def get_char_histogram(text: str) -> dict[str, int]:
+    """Number of characters of every class of `CHAR_CLASSES_ORDER`"""
+    classes = text.translate(CHAR_CLASSES)
+    return {char_class: classes.count(char_class) for char_class in CHAR_CLASSES_ORDER}
+
+
+def check_text(text: str, thresholds: QualityThresholds) -> str | None:
+    """Reason to skip the text, or None if it passes"""
+    if len(text) < thresholds.min_chars:
+        return 'too_short'
+    if len(text) > thresholds.max_chars:
+        return 'too_long'
+
+    histogram = get_char_histogram(text)
+    cyrillic = histogram['k'] + histogram['c']
+    letters = cyrillic + histogram['a']
+
+    if letters < thresholds.min_letter_ratio * (len(text) - histogram[' ']):
+        return 'few_letters'
+    if cyrillic < thresholds.min_cyrillic_ratio * letters:
+        return 'not_cyrillic'
+    if histogram['k'] < thresholds.min_kyrgyz_ratio * cyrillic:
+        return 'not_kyrgyz'
+    return None
@@ -1,4 +1,10 @@
-from functools import cache
+from typing import Iterable
+
+from functools import lru_cache
+from hashlib import blake2b
+from array import array
+import mmap
+import json
 import sys
 import os
 
@@ -8,122 +14,353 @@ if __name__ == '__main__':
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
-from src.get_dictionary import get_kaikki_tili, get_kyrgyz_tili
-from src.tokenizer import Tokenizer
+from src.get_dictionary import (
+    get_kaikki_tili, get_kyrgyz_tili, get_dictionary_path, get_file_digest, get_file_stamp, KAIKKI_TILI, KYRGYZ_TILI
+)
+from src.normalization import normalize
 from src.utils import write_file
 
 
-class SuffixTrie:
-    TrieType = dict[str, 'TrieType']
+def _align(size: int) -> int:
+    # Arrays of the saved trie start at 8-byte boundaries
+    return (size + 7) & ~7
 
-    def __init__(self):
-        dictionary, _ = get_kaikki_tili()
-        kyrgyz_tili_dictionary, _ = get_kyrgyz_tili()
 
-        handmade_suffixes = {
-            'чы', 'чи', 'чу', 'чү',
-            'ба', 'бе', 'бо', 'бө',
+# Words remembered by every `SuffixTrie`
+SUFFIX_CACHE_SIZE = 1 << 16
+SUFFIXES_PATH = mkpath('../results/suffixes.txt')
+# Built trie, tied to its sources (the dictionaries, `HANDMADE_SUFFIXES` and `SUFFIX_TRIE_VERSION`)
+SUFFIX_TRIE_PATH = mkpath('../results/suffix_trie.bin')
+# Changes whenever the suffixes are derived differently or the layout of the file changes
+SUFFIX_TRIE_VERSION = 2
 
-            'мын', 'мин', 'мун', 'мүн',
-            'сың', 'сиң', 'суң', 'сүң',
-            'сыз', 'сиз', 'суз', 'сүз',
-            'быз', 'биз', 'буз', 'бүз',
-            'пыз', 'пиз', 'пуз', 'пүз',
+HANDMADE_SUFFIXES = {
+    'чы', 'чи', 'чу', 'чү',
+    'ба', 'бе', 'бо', 'бө',
 
-            'сыңар', 'сиңер', 'суңар', 'сүңөр',
-            'сыздар', 'сиздер', 'суздар', 'сүздөр',
+    'мын', 'мин', 'мун', 'мүн',
+    'сың', 'сиң', 'суң', 'сүң',
+    'сыз', 'сиз', 'суз', 'сүз',
+    'быз', 'биз', 'буз', 'бүз',
+    'пыз', 'пиз', 'пуз', 'пүз',
 
-            'нын', 'нин', 'нун', 'нүн',
-            'дын', 'дин', 'дун', 'дүн',
-            'тын', 'тин', 'тун', 'түн',
+    'сыңар', 'сиңер', 'суңар', 'сүңөр',
+    'сыздар', 'сиздер', 'суздар', 'сүздөр',
 
-            'га', 'ге', 'го', 'гө',
+    'нын', 'нин', 'нун', 'нүн',
+    'дын', 'дин', 'дун', 'дүн',
+    'тын', 'тин', 'тун', 'түн',
 
-            'дар', 'дер', 'дор', 'дөр',
-            'тар', 'тер', 'тор', 'төр',
-            'лар', 'лер', 'лор', 'лөр',
+    'га', 'ге', 'го', 'гө',
 
-            'па', 'пе', 'по', 'пө',
-            'би', 'бу', 'бү', 'бы',
-            'пи', 'пу', 'пү', 'пы',
+    'дар', 'дер', 'дор', 'дөр',
+    'тар', 'тер', 'тор', 'төр',
+    'лар', 'лер', 'лор', 'лөр',
 
-            'тон', 'төн', 'тан', 'тен',
-            'дон', 'дөн', 'дан', 'ден',
+    'па', 'пе', 'по', 'пө',
+    'би', 'бу', 'бү', 'бы',
+    'пи', 'пу', 'пү', 'пы',
 
-            'ги', 'гу', 'гы', 'гү',
-            'ки', 'ку', 'кы', 'кү',
-            'ка', 'ке', 'ко', 'кө',
+    'тон', 'төн', 'тан', 'тен',
+    'дон', 'дөн', 'дан', 'ден',
 
-            'гун', 'гүн', 'гын', 'гин',
-            'кун', 'күн', 'кын', 'кин',
+    'ги', 'гу', 'гы', 'гү',
+    'ки', 'ку', 'кы', 'кү',
+    'ка', 'ке', 'ко', 'кө',
 
-            'даш', 'деш', 'дош', 'дөш',
-            'таш', 'теш', 'тош', 'төш',
+    'гун', 'гүн', 'гын', 'гин',
+    'кун', 'күн', 'кын', 'кин',
 
-            'йм', 'өм', 'ам', 'ем', 'ом',
+    'даш', 'деш', 'дош', 'дөш',
+    'таш', 'теш', 'тош', 'төш',
 
-            'да', 'де', 'до', 'дө',
-            'та', 'те', 'то', 'тө',
-            'ына',
+    'йм', 'өм', 'ам', 'ем', 'ом',
 
-            'лик', 'лак', 'лөк', 'лок', 'лук', 'лүк',
+    'да', 'де', 'до', 'дө',
+    'та', 'те', 'то', 'тө',
+    'ына',
 
-            'ум', 'үм'
-        }
-        suffixes = {suffix.translate(Tokenizer.TRANSLATION_TABLE) for suffix in handmade_suffixes}
+    'лик', 'лак', 'лөк', 'лок', 'лук', 'лүк',
 
-        print(f'[Suffixes] Hand-made suffixes: {len(suffixes)}')
+    'ум', 'үм'
+}
 
-        dictionary_suffixes = set()
-        for word, forms in dictionary.items():
-            for form in forms:
-                if not form.startswith(word):
-                    continue
-                suffix = form.removeprefix(word)
-                if suffix:
-                    dictionary_suffixes.add(suffix)
 
-        print(f'[Suffixes] Dictionary suffixes: {len(dictionary_suffixes)}')
+def get_suffixes() -> set[str]:
+    """Hand-made suffixes and the suffixes of the dictionary forms. Also saved to `SUFFIXES_PATH`"""
+    dictionary, _ = get_kaikki_tili()
+    kyrgyz_tili_dictionary, _ = get_kyrgyz_tili()
 
-        kyrgyz_tili_dictionary_suffixes = set()
-        for word, forms in kyrgyz_tili_dictionary.items():
-            for form in forms:
-                if not form.startswith(word):
-                    continue
-                suffix = form.removeprefix(word)
-                if suffix:
-                    kyrgyz_tili_dictionary_suffixes.add(suffix)
+    suffixes = {normalize(suffix) for suffix in HANDMADE_SUFFIXES}
+
+    print(f'[Suffixes] Hand-made suffixes: {len(suffixes)}')
+
+    dictionary_suffixes = set()
+    for word, forms in dictionary.items():
+        for form in forms:
+            if not form.startswith(word):
+                continue
+            suffix = form.removeprefix(word)
+            if suffix:
+                dictionary_suffixes.add(suffix)
+
+    print(f'[Suffixes] Dictionary suffixes: {len(dictionary_suffixes)}')
+
+    kyrgyz_tili_dictionary_suffixes = set()
+    for word, forms in kyrgyz_tili_dictionary.items():
+        for form in forms:
+            if not form.startswith(word):
+                continue
+            suffix = form.removeprefix(word)
+            if suffix:
+                kyrgyz_tili_dictionary_suffixes.add(suffix)
+
+    print(f'[Suffixes] Dictionary (kyrgyz_tili) suffixes: {len(kyrgyz_tili_dictionary_suffixes)}')
+
+    suffixes = suffixes.union(dictionary_suffixes)
+    suffixes = suffixes.union(kyrgyz_tili_dictionary_suffixes)
+    print(f'[Suffixes] Total suffixes: {len(suffixes)}')
+
+    write_file(SUFFIXES_PATH, '\n'.join(sorted(suffixes)))
+    return suffixes
 
-        print(f'[Suffixes] Dictionary (kyrgyz_tili) suffixes: {len(kyrgyz_tili_dictionary_suffixes)}')
 
-        suffixes = suffixes.union(dictionary_suffixes)
-        suffixes = suffixes.union(kyrgyz_tili_dictionary_suffixes)
-        print(f'[Suffixes] Total suffixes: {len(suffixes)}')
+def _get_sources_stamps() -> dict[str, list[int]] | None:
+    """Sizes and modification times of the dictionaries, None if one is missing (it is generated first)"""
+    stamps = {}
+    for name in (KAIKKI_TILI, KYRGYZ_TILI):
+        path = get_dictionary_path(name)
+        if not os.path.isfile(path):
+            return None
+        stamps[name] = get_file_stamp(path)
+    return stamps
 
-        write_file(mkpath('../results/suffixes.txt'), '\n'.join(sorted(suffixes)))
 
-        self.trie: SuffixTrie.TrieType = {}
+def get_handmade_digest() -> str:
+    """Hash of `HANDMADE_SUFFIXES` and `SUFFIX_TRIE_VERSION`, cheap enough to be compared on every load"""
+    digest = blake2b(f'{SUFFIX_TRIE_VERSION}\n'.encode('utf-8'))
+    digest.update('\n'.join(sorted(normalize(suffix) for suffix in HANDMADE_SUFFIXES)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_sources_digest() -> str:
+    """Hash of the dictionaries, compared only when their sizes or modification times differ"""
+    digest = blake2b()
+    for name in (KAIKKI_TILI, KYRGYZ_TILI):
+        digest.update(get_file_digest(get_dictionary_path(name)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class _SuffixCodes(dict[int, str]):
+    """`str.translate` table: characters of the suffixes become their codes (from 1), any other one becomes 0"""
+
+    def __missing__(self, code: int) -> str:
+        self[code] = '\0'
+        return '\0'
+
+
+class SuffixTrie:
+    """
+    Reversed suffixes in a double-array trie: the child of node `n` by the character of code `c` is at
+    `base[n] + c` if its `check` is `n`. Nodes are numbered in breadth-first order of the suffix trie.
+
+    The trie of the dictionaries is saved to `SUFFIX_TRIE_PATH` (a JSON header line, then the arrays
+    in native byte order), and later runs map it instead of building it again. It is rebuilt only when
+    a source changes: the hand-made suffixes are always compared, the modification times of the dictionaries
+    are checked first and their contents are hashed only if they differ
+    """
+
+    BuildNode = dict[str, 'BuildNode']
+
+    # Arrays when built, views of the mapped file when loaded
+    base: 'array[int] | memoryview'
+    check: 'array[int] | memoryview'
+    is_end: bytearray | memoryview
+
+    def __init__(
+        self,
+        suffixes: Iterable[str] | None = None,
+        cache_size: int | None = SUFFIX_CACHE_SIZE,
+        path: str | None = SUFFIX_TRIE_PATH
+    ):
+        """Without `suffixes`, the trie of the dictionaries, mapped from `path` (None: always built)"""
+        self._mmap: mmap.mmap | None = None
+        if suffixes is not None:
+            self._build(set(suffixes))
+        elif path is None or not self._load(path):
+            self._build(get_suffixes())
+            if path is not None:
+                self._save(path, _get_sources_stamps(), get_sources_digest())
+
+        # Per instance and bounded (a `functools.cache` on the method would keep every word and `self` forever)
+        self.remove_suffix = lru_cache(maxsize=cache_size)(self._remove_suffix)
+
+    def _set_alphabet(self, alphabet: str):
+        self.alphabet = alphabet
+        self.codes = _SuffixCodes({ord(char): chr(code) for code, char in enumerate(alphabet, 1)})
+
+    def _build(self, suffixes: set[str]):
+        # Nested dicts only while building, `''` marks the end of a suffix
+        root: SuffixTrie.BuildNode = {}
         for suffix in suffixes:
-            node: SuffixTrie.TrieType = self.trie
+            node = root
             for char in reversed(suffix):
                 node = node.setdefault(char, {})
-            node['$'] = {}
+            node[''] = {}
 
-    @cache  # noqa
-    def remove_suffix(self, word: str) -> tuple[str, str]:
-        node = self.trie
-        longest_index = len(word)
+        self._set_alphabet(''.join(sorted({char for suffix in suffixes for char in suffix})))
+        self.base, self.check, self.is_end = self._place_nodes(
+            root, {char: code for code, char in enumerate(self.alphabet, 1)}
+        )
 
-        for i in range(len(word) - 1, -1, -1):
-            char = word[i]
-            if char not in node:
+    def _load(self, path: str) -> bool:
+        """Maps the saved trie, if it was built from the current sources"""
+        stamps = _get_sources_stamps()
+        if stamps is None or not os.path.isfile(path):
+            return False
+
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_size = mapped.find(b'\n') + 1
+        header = json.loads(mapped[:header_size])
+
+        if (
+            header['version'] != SUFFIX_TRIE_VERSION
+            or header['byteorder'] != sys.byteorder
+            or header['handmade'] != get_handmade_digest()
+        ):
+            mapped.close()
+            return False
+        # Touched but not changed: the file is saved again with the new times below, so they are not hashed next time
+        if header['sources'] != stamps and header['digest'] != get_sources_digest():
+            mapped.close()
+            return False
+
+        slots = header['slots']
+        offset = _align(header_size)
+        if len(mapped) != offset + 9 * slots:
+            mapped.close()
+            return False
+        with memoryview(mapped) as data:
+            self.base = data[offset:offset + 4 * slots].cast('i')
+            self.check = data[offset + 4 * slots:offset + 8 * slots].cast('i')
+            self.is_end = data[offset + 8 * slots:offset + 9 * slots]
+        self._set_alphabet(header['alphabet'])
+        self._mmap = mapped
+
+        if header['sources'] != stamps:
+            # Saved from a copy and mapped again: a mapped file can not be replaced on Windows
+            base, check, is_end = array('i', self.base), array('i', self.check), bytearray(self.is_end)
+            self.close()
+            self.base, self.check, self.is_end = base, check, is_end
+            self._save(path, stamps, header['digest'])
+            return self._load(path)
+        return True
+
+    def close(self):
+        """Unmaps the saved trie, if it was mapped (the trie can not be used afterwards)"""
+        if self._mmap is None:
+            return
+        # The views first, a mapping with exported buffers can not be closed
+        for view in (self.base, self.check, self.is_end):
+            if isinstance(view, memoryview):
+                view.release()
+        self._mmap.close()
+        self._mmap = None
+
+    def _save(self, path: str, stamps: dict[str, list[int]] | None, digest: str):
+        header = json.dumps({
+            'version': SUFFIX_TRIE_VERSION,
+            'byteorder': sys.byteorder,
+            'handmade': get_handmade_digest(),
+            'sources': stamps,
+            'digest': digest,
+            'alphabet': self.alphabet,
+            'slots': len(self.base),
+        }, ensure_ascii=False).encode('utf-8') + b'\n'
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Replaced atomically: other processes may have the previous one mapped
+        with open(path + '.tmp', 'wb') as file:
+            file.write(header.ljust(_align(len(header)), b' '))
+            for values in (self.base, self.check, self.is_end):
+                file.write(memoryview(values).cast('B'))
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def _place_nodes(root: BuildNode, codes: dict[str, int]) -> tuple['array[int]', 'array[int]', bytearray]:
+        """Places the children of every node at the first free offset where all of them fit"""
+        max_code = len(codes)
+        base = array('i', [0])
+        check = array('i', [-1])
+        is_end = bytearray(1)
+        # Slot 0 (the root) is taken, and so are the padding slots after the last node
+        used = bytearray(1)
+        first_free = 1
+
+        nodes = [(0, root)]
+        for slot, node in nodes:
+            is_end[slot] = '' in node
+            children = sorted((codes[char], child) for char, child in node.items() if char)
+            if not children:
+                continue
+
+            first_code = children[0][0]
+            position = max(first_free, first_code + 1)
+            while True:
+                node_base = position - first_code
+                if len(used) <= node_base + max_code:
+                    grow = node_base + max_code + 1 - len(used)
+                    used.extend(bytes(grow))
+                    base.extend([0] * grow)
+                    check.extend([-1] * grow)
+                    is_end.extend(bytes(grow))
+                if not any(used[node_base + code] for code, _ in children):
+                    break
+                # Past the end when every slot after it is taken, the arrays grow above
+                position = used.find(0, position + 1)
+                if position < 0:
+                    position = len(used)
+
+            base[slot] = node_base
+            for code, child in children:
+                used[node_base + code] = 1
+                check[node_base + code] = slot
+                nodes.append((node_base + code, child))
+            first_free = used.find(0, first_free)
+            if first_free < 0:
+                first_free = len(used)
+
+        return base, check, is_end
+
+    def __len__(self) -> int:
+        return len(self.base)
+
+    def _remove_suffix(self, word: str) -> tuple[str, str]:
+        """Splits the longest known suffix off the word"""
+        base = self.base
+        check = self.check
+        is_end = self.is_end
+        node = 0
+        index = longest_index = len(word)
+
+        for code in map(ord, reversed(word.translate(self.codes))):
+            child = base[node] + code
+            if check[child] != node:
                 break
-            node = node[char]
-            if '$' in node:
-                longest_index = i
+            node = child
+            index -= 1
+            if is_end[node]:
+                longest_index = index
 
         return word[:longest_index], word[longest_index:]
 
+    def remove_suffixes(self, words: Iterable[str]) -> list[tuple[str, str]]:
+        """`remove_suffix` of every word, repeated words are looked up once"""
+        words = list(words)
+        splits = {word: self.remove_suffix(word) for word in dict.fromkeys(words)}
+        return [splits[word] for word in words]
+
 
 ApertiumMapper = dict[str, str]
 
@@ -1,5 +1,7 @@
-from typing import Generator
+from typing import Generator, Iterable, Iterator, NamedTuple
 
+from array import array
+import itertools
 import sys
 
 if __name__ == '__main__':
@@ -10,33 +12,43 @@ import regex
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
+from src.normalization import REPLACEMENTS, TRANSLATION_TABLE, FOLDED_TRANSLATION_TABLE
+
+
+# Unsigned 32-bit, as in `src/corpus.py`
+SPAN_TYPECODE = 'I'
+
+
+class TokenSpans(NamedTuple):
+    """
+    Tokens of a batch of texts as flat arrays instead of strings.
+    Token `i` is `texts[text_ids[i]][starts[i]:ends[i]]` (the texts are normalized, but have the original offsets).
+    Arrays support the buffer protocol, e.g. `numpy.frombuffer(spans.starts, dtype=numpy.uint32)`
+    """
+    texts: list[str]
+    text_ids: 'array[int]'
+    # Sentences are numbered across the batch
+    sentence_ids: 'array[int]'
+    starts: 'array[int]'
+    ends: 'array[int]'
+    # Index of the first token of every sentence, followed by the number of tokens
+    sentence_offsets: 'array[int]'
+    # Ids of the tokens in the vocabulary given to `tokenize_batch`, if any
+    token_ids: 'array[int] | None'
+
+    def get_token(self, index: int) -> str:
+        return self.texts[self.text_ids[index]][self.starts[index]:self.ends[index]]
+
+    def iter_sentences(self) -> Iterator[range]:
+        """Token indexes of every sentence"""
+        return itertools.starmap(range, itertools.pairwise(self.sentence_offsets))
+
 
 class Tokenizer:
-    REPLACEMENTS = {
-        # 'c': 'с',
-        # 'o': 'о',
-        # 'p': 'р',
-        # 'a': 'а',
-        # 'e': 'е',
-        # 'y': 'у',
-
-        # 'ё': 'е',
-        # 'ң': 'н',
-        # 'ө': 'о',
-        # 'ү': 'у',
-
-        'ѳ': 'ө',  # Careful! Renders the same
-
-        # '-': None,
-        # '–': None,
-        # '—': None,
-
-        'ї': 'ү',
-        'є': 'ө',
-        'ў': 'ң',
-    }
-    REPLACEMENTS.update({k.upper(): (v.upper() if v else v) for k, v in REPLACEMENTS.items()})
-    TRANSLATION_TABLE = str.maketrans(REPLACEMENTS)
+    # Shared with the other stages, see `src/normalization.py`
+    REPLACEMENTS = REPLACEMENTS
+    TRANSLATION_TABLE = TRANSLATION_TABLE
+    FOLDED_TRANSLATION_TABLE = FOLDED_TRANSLATION_TABLE
 
     # WORD_PATTERN = regex.compile(r'\b[А-Яа-я]+(?:[-–—][А-Яа-я]+)*\b')
     WORD_PATTERN = regex.compile(
@@ -88,6 +100,265 @@ class Tokenizer:
             if words:
                 yield words
 
+    @classmethod
+    def _iter_sentence_spans(cls, text: str) -> Generator[list[tuple[int, int]], None, None]:
+        """Same sentences as `process_text`, as spans of the words in a text normalized with `TRANSLATION_TABLE`"""
+        # Words are searched in place instead of in the stripped parts: the characters around a part
+        # are whitespace or separators, neither word characters nor digits, so the boundaries behave the same
+        find_words = cls.WORD_PATTERN.finditer
+        start = 0
+        for separator in itertools.chain(cls.SENTENCE_SPLIT_PATERN.finditer(text), (None,)):
+            spans = list(map(regex.Match.span, find_words(text, start, separator.start() if separator else len(text))))
+            if spans:
+                yield spans
+            if separator:
+                start = separator.end()
+
+    @classmethod
+    def tokenize_batch(
+        cls,
+        texts: Iterable[str],
+        vocab: dict[str, int] | None = None,
+        fold_case: bool = False
+    ) -> TokenSpans:
+        """
+        Tokenizes many texts at once into flat span arrays, without a list of strings for every sentence.
+        With `vocab`, tokens are also interned: new tokens get the next ids (`len(vocab)`) and are added to it.
+        With `fold_case`, they are interned in lowercase (the original case is still available with `get_token`)
+        """
+        spans = TokenSpans(
+            texts=[],
+            text_ids=array(SPAN_TYPECODE),
+            sentence_ids=array(SPAN_TYPECODE),
+            starts=array(SPAN_TYPECODE),
+            ends=array(SPAN_TYPECODE),
+            sentence_offsets=array(SPAN_TYPECODE, [0]),
+            token_ids=None if vocab is None else array(SPAN_TYPECODE),
+        )
+        token_ids = spans.token_ids
+        sentence_id = 0
+
+        for text_id, source_text in enumerate(texts):
+            text = source_text.translate(cls.TRANSLATION_TABLE)
+            spans.texts.append(text)
+            # Both translations keep the offsets
+            tokens_text = text
+            if fold_case and vocab is not None:
+                tokens_text = source_text.translate(cls.FOLDED_TRANSLATION_TABLE)
+            del source_text
+
+            for sentence_spans in cls._iter_sentence_spans(text):
+                starts, ends = zip(*sentence_spans)
+                spans.text_ids.extend(itertools.repeat(text_id, len(starts)))
+                spans.sentence_ids.extend(itertools.repeat(sentence_id, len(starts)))
+                spans.starts.extend(starts)
+                spans.ends.extend(ends)
+                spans.sentence_offsets.append(len(spans.starts))
+                sentence_id += 1
+
+                if vocab is not None and token_ids is not None:
+                    for token in map(tokens_text.__getitem__, itertools.starmap(slice, sentence_spans)):
+                        token_id = vocab.get(token)
+                        if token_id is None:
+                            token_id = vocab[token] = len(vocab)
+                        token_ids.append(token_id)
+
+        return spans
+
+
+class _CharClasses(dict[int, str]):
+    """
+    `str.translate` table: every character becomes a single character of its class (see `LinearTokenizer`).
+    Classes follow the definitions of the `regex` module, and are computed once per distinct character
+    """
+
+    SPLIT_PUNCTUATION = '!?|()[]{}…\\/•。︖︕？！⁇⁈⁉؟¿¡।॥።⸮'
+    LOWER = set('abcdefghijklmnopqrstuvwxyz') | set(map(chr, range(ord('а'), ord('я') + 1))) | set('ёңүө')
+    UPPER = set('ABCDEFGHIJKLMNOPQRSTUVWXYZ') | set(map(chr, range(ord('А'), ord('Я') + 1))) | set('ЁҢҮӨ')
+
+    def __missing__(self, code: int) -> str:
+        char = chr(code)
+        if char == '\n':
+            char_class = 'n'
+        elif char == ' ':
+            char_class = ' '
+        elif char in self.SPLIT_PUNCTUATION:
+            char_class = 'p'
+        elif char in ':.,':
+            char_class = char
+        elif char in self.LOWER:
+            char_class = 'l'
+        elif char in self.UPPER:
+            char_class = 'u'
+        elif '0' <= char <= '9':
+            char_class = 'd'
+        elif regex.match(r'\d', char):
+            char_class = 'D'
+        elif regex.match(r'\s', char):
+            char_class = 's'
+        elif regex.match(r'\w', char):
+            char_class = 'w'
+        else:
+            char_class = 'o'
+
+        self[code] = char_class
+        return char_class
+
+
+class LinearTokenizer(Tokenizer):
+    """
+    Same output as `Tokenizer`, but sentences are split and words are extracted by a scan over character classes,
+    so the time is linear in the length of the text whatever it contains (no backtracking).
+
+    Classes: `n` linebreak, ` ` space, `s` other whitespace, `p` splitting punctuation, `:` `.` `,` themselves,
+    `l` / `u` lowercase / uppercase letters of the patterns, `d` ASCII digit, `D` other digit,
+    `w` other word character, `o` anything else.
+    The scan jumps between interesting positions with `str.find` over masks of the classes
+    instead of looking at every character in Python.
+    """
+
+    CHAR_CLASSES = _CharClasses()
+    WORD_CLASSES = frozenset('luwdD')
+
+    # Possible start of a separator: `!`
+    SPLIT_MASK = str.maketrans('np:.luwdD so,', '!!!!---------')
+    # Whitespace: ` `, anything else: `x`
+    SPACE_MASK = str.maketrans('n sp:.,luwdDo', '   xxxxxxxxxx')
+    # Possible start of a word: `x`
+    START_MASK = str.maketrans('ludn sp:.,wDo', 'xxx----------')
+    # Letters: `L`, dots: `.`, anything else: `-`
+    LETTER_MASK = str.maketrans('lun sp:,dwDo', 'LL----------')
+    # Digits: `d`, punctuation inside numbers: `.`, anything else: `-`
+    DIGIT_MASK = str.maketrans(':,ln spuwDo', '..---------')
+
+    @classmethod
+    def _split_sentences(cls, classes: str) -> Generator[tuple[int, int], None, None]:
+        """Bounds of the parts between the matches of `SENTENCE_SPLIT_PATERN`"""
+        word_classes = cls.WORD_CLASSES
+        split_mask = classes.translate(cls.SPLIT_MASK)
+        space_mask = classes.translate(cls.SPACE_MASK)
+        size = len(classes)
+        start = 0
+        i = split_mask.find('!')
+
+        while i != -1:
+            char_class = classes[i]
+
+            if char_class == 'n':
+                end = i + 1
+            elif char_class == 'p':
+                end = i + 1
+                while end < size and classes[end] == 'p':
+                    end += 1
+            elif char_class == ':':
+                if i + 1 == size or classes[i + 1] == 'd':
+                    i = split_mask.find('!', i + 1)
+                    continue
+                end = i + 1
+            elif i + 1 < size and classes[i + 1] == '.':
+                end = i + 2
+                while end < size and classes[end] == '.':
+                    end += 1
+            else:
+                # A dot (and the whitespace after it) splits depending on the characters around it
+                end = space_mask.find('x', i + 1)
+                if not i or end == -1:
+                    i = split_mask.find('!', i + 1)
+                    continue
+
+                previous_class = classes[i - 1]
+                next_class = classes[end]
+                if not (
+                    previous_class in 'lu dD' and next_class not in word_classes
+                    or previous_class in 'l ' and next_class == 'u'
+                    or previous_class in 'u ' and next_class == 'l'
+                    or previous_class in 'dD' and next_class in 'lu'
+                ):
+                    i = split_mask.find('!', i + 1)
+                    continue
+
+            yield start, i
+            start = end
+            i = split_mask.find('!', end)
+
+        yield start, size
+
+    @classmethod
+    def _iter_words(
+        cls,
+        classes: str,
+        masks: tuple[str, str, str],
+        start: int,
+        end: int
+    ) -> Generator[tuple[int, int], None, None]:
+        """Spans of the matches of `WORD_PATTERN` in `text[start:end]`"""
+        word_classes = cls.WORD_CLASSES
+        start_mask, letter_mask, digit_mask = masks
+        i = start_mask.find('x', start, end)
+
+        while i != -1:
+            previous_class = classes[i - 1] if i != start else ''
+            is_digit = classes[i] == 'd'
+            # Numbers start after anything but a digit, words after a boundary or a digit
+            if previous_class == 'd' if is_digit else previous_class in word_classes and previous_class != 'd':
+                i = start_mask.find('x', i + 1, end)
+                continue
+
+            if not is_digit:
+                # Letters and dots, the word ends with a letter before a boundary
+                k = letter_mask.find('-', i + 1, end)
+                if k == -1:
+                    k = end
+
+                if k >= i + 2 and classes[k - 1] != '.' and (
+                    k == end or classes[k] not in word_classes or classes[k] == 'd'
+                ):
+                    yield i, k
+                    i = start_mask.find('x', k, end)
+                    continue
+
+                # Otherwise, the last dot after a letter ends the word
+                last_dot = letter_mask.rfind('L.', i + 1, k) + 1
+                if last_dot:
+                    yield i, last_dot
+                    i = start_mask.find('x', last_dot, end)
+                    continue
+
+                i = start_mask.find('x', i + 1, end)
+                continue
+
+            # Digits with `:.,` between them
+            k = digit_mask.find('-', i + 1, end)
+            last_digit = digit_mask.rfind('d', i, end if k == -1 else k)
+            yield i, last_digit + 1
+            i = start_mask.find('x', last_digit + 1, end)
+
+    @classmethod
+    def _iter_sentence_spans(cls, text: str) -> Generator[list[tuple[int, int]], None, None]:
+        classes = text.translate(cls.CHAR_CLASSES)
+        masks = (
+            classes.translate(cls.START_MASK),
+            classes.translate(cls.LETTER_MASK),
+            classes.translate(cls.DIGIT_MASK),
+        )
+
+        # As in `Tokenizer`, words are searched in the parts as they are (without stripping)
+        for start, end in cls._split_sentences(classes):
+            spans = list(cls._iter_words(classes, masks, start, end))
+            if spans:
+                yield spans
+
+    @classmethod
+    def process_text(cls, text: str) -> Generator[list[str], None, None]:
+        text = text.translate(cls.TRANSLATION_TABLE)
+        for spans in cls._iter_sentence_spans(text):
+            yield [text[start:end] for start, end in spans]
+
+
+TOKENIZERS: dict[str, type[Tokenizer]] = {
+    'regex': Tokenizer,
+    'linear': LinearTokenizer,
+}
 
 if __name__ == '__main__':
     # print(tokenizer.SENTENCE_SPLIT_PATERN.pattern)
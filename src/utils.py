@@ -1,13 +1,25 @@
-from typing import no_type_check
+from typing import Any, BinaryIO, Container, Iterable, Generator, NamedTuple, no_type_check
 
-from multiprocessing import Process, Event, Value, Lock, Queue
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from multiprocessing import Process, Condition, Value, Array, Queue, Pipe
+from multiprocessing.connection import Connection
 from contextlib import contextmanager, suppress, chdir
 from concurrent.futures import ThreadPoolExecutor
-from queue import Empty as EmptyQueueException
-from time import sleep
+from time import perf_counter, time
+from collections import deque, OrderedDict
+from functools import partial
+from queue import SimpleQueue
+from zlib import crc32
+import threading
+import shutil
+import io
+import re
 import sys
 import os
 
+from src.compression import BLOCK_SIZE, get_compression_ext, compress_block, read_index, append_index, open_text
+
 
 def mkpath(*paths: str) -> str:
     return os.path.normpath(os.path.join(*paths))
@@ -56,128 +68,699 @@ def empty_file(path: str):
         pass
 
 
+SHARDS_MANIFEST = 'manifest.txt'
+
+
+def append_to_manifest(directory: str, shard_names: Iterable[str]) -> int:
+    """
+    Records finished shards (in order) in the manifest of a sharded file.
+    Returns the size of the manifest afterwards.
+    """
+    with open(mkpath(directory, SHARDS_MANIFEST), 'a', encoding='utf-8') as file:
+        file.write(''.join(shard_name + '\n' for shard_name in shard_names))
+        return file.tell()
+
+
+def get_shard_paths(directory: str) -> list[str]:
+    """Paths of the shards of a sharded file in their logical order. Shards missing from the manifest are ignored"""
+    with open(mkpath(directory, SHARDS_MANIFEST), 'r', encoding='utf-8') as file:
+        return [mkpath(directory, shard_name) for shard_name in filter(None, map(str.strip, file))]
+
+
+def get_shards_size(directory: str) -> int:
+    return sum(map(os.path.getsize, get_shard_paths(directory)))
+
+
+def iter_shards_lines(directory: str) -> Generator[str, None, None]:
+    """Iterates over the lines of all shards of a sharded file as if it was a single file"""
+    for shard_path in get_shard_paths(directory):
+        with open_text(shard_path) as file:
+            yield from file
+
+
+def compact_shards(directory: str, output_path: str) -> int:
+    """
+    Concatenates all shards of a sharded file into `output_path`. Returns the size of the result.
+    Compressed shards are concatenated as they are (their blocks stay valid), and so are their indexes
+    """
+    output_path = mkpath(output_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    block_ends: list[tuple[int, int]] = []
+    uncompressed_size = 0
+
+    with open(output_path, 'wb') as output_file:
+        for shard_path in get_shard_paths(directory):
+            if get_compression_ext(shard_path) is not None:
+                compressed_size = output_file.tell()
+                block_ends.extend(
+                    (compressed_size + compressed_end, uncompressed_size + uncompressed_end)
+                    for compressed_end, uncompressed_end in read_index(shard_path)
+                )
+                uncompressed_size = block_ends[-1][1] if block_ends else uncompressed_size
+            with open(shard_path, 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, output_file)
+        output_size = output_file.tell()
+
+    if get_compression_ext(output_path) is not None:
+        append_index(output_path, block_ends, overwrite=True)
+    return output_size
+
+
 def print_async(*args, **kwargs):
     print(*args, **kwargs)
     sys.stdout.flush()
 
 
+# Buckets of the FileWriter histograms: bucket 0 counts values below 1, bucket `i` values in [2^(i-1), 2^i)
+HISTOGRAM_BUCKETS = 40
+# Histograms: microseconds a producer waited for queue capacity, microseconds a task waited in the queue,
+# tasks in the queue (including the new one) when a task was queued, microseconds of every write (of a batch)
+FILE_WRITER_HISTOGRAMS = ('producer_wait_us', 'queue_wait_us', 'queue_depth', 'write_latency_us')
+# The writer samples its queue this often. When `QUEUE_SAMPLES` are taken, every other one is dropped
+# and the interval doubles, so that the samples always cover the whole run
+QUEUE_SAMPLE_INTERVAL = 1.0
+QUEUE_SAMPLES = 1000
+
+
+PAYLOAD_MODES = ('queue', 'shared_memory')
+# Smaller data goes through the queue in any mode, a shared memory block would cost more than pickling it
+SHARED_PAYLOAD_MIN_SIZE = 64 * 1024
+# Counters of queued tasks by path, for `FileWriter.flush(paths)`. Paths of the same slot are waited for together
+PATH_TASK_SLOTS = 4096
+
+
+def get_path_slot(path: str) -> int:
+    # Stable across processes (unlike `hash`), and the same for every spelling of the path
+    return crc32(os.path.abspath(path).encode('utf-8')) % PATH_TASK_SLOTS
+
+
+def add_to_histogram(histogram, value: float):
+    histogram[min(int(value).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+
+def get_histogram_percentile(histogram: list[int], percentile: float) -> int:
+    """Upper bound of the bucket holding the percentile (0 for an empty histogram)"""
+    total = sum(histogram)
+    count = 0
+    for bucket, bucket_count in enumerate(histogram):
+        count += bucket_count
+        if count and count >= total * percentile / 100:
+            return 1 << bucket
+    return 0
+
+
+class _SharedPayload(NamedTuple):
+    """Data of a write in a shared memory block, only this descriptor goes through the queue"""
+    name: str
+    size: int
+
+    @classmethod
+    def create(cls, data: bytes) -> '_SharedPayload':
+        block = SharedMemory(create=True, size=max(1, len(data)))
+        block.buf[:len(data)] = data
+        block.close()
+        # The writer process unlinks it
+        return cls(block.name, len(data))
+
+    def write_to(self, file: BinaryIO) -> int:
+        block = SharedMemory(self.name)
+        try:
+            with block.buf[:self.size] as data:
+                return file.write(data)
+        finally:
+            block.close()
+            # Also unregisters the block, as registered by its creator
+            block.unlink()
+
+
+class _WriteTask(NamedTuple):
+    data: str | bytes | _SharedPayload
+    append: bool
+    queued_at: float
+    # Accounted in the queue size
+    size: int
+
+
+class _WriterStats:
+    """
+    Counters of the writer process, sent to the parent by `FileWriter.get_stats`.
+    Paths are counted by group: names that only differ by numbers (the shards of a sharded file) go together
+    """
+
+    def __init__(self, num_threads: int, queued_tasks, data_size, producer_wait):
+        self.started_at = time()
+        self.num_threads = num_threads
+        self._queued_tasks = queued_tasks
+        self._data_size = data_size
+        self._producer_wait = producer_wait
+        # Queued tasks, queued size, writes (of batches), bytes written
+        self._paths: dict[str, list[int]] = {}
+        self._busy_threads = 0
+        self._writes = 0
+        self._written_bytes = 0
+        self._write_time = 0.0
+        # (seconds since the start, queued tasks, queued size, busy threads)
+        self._queue_samples: list[tuple[float, int, int, int]] = []
+        self._sample_interval = QUEUE_SAMPLE_INTERVAL
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_path_group(path: str) -> str:
+        # Numbers of the name, not of the extension (`.bz2`)
+        stem, ext = os.path.splitext(path)
+        directory, name = os.path.split(stem)
+        return os.path.join(directory, re.sub(r'\d+', '*', name)) + ext
+
+    def add_queued(self, path: str, size: int):
+        with self._lock:
+            path_stats = self._paths.setdefault(self.get_path_group(path), [0, 0, 0, 0])
+            path_stats[0] += 1
+            path_stats[1] += size
+
+    def start_write(self):
+        with self._lock:
+            self._busy_threads += 1
+
+    def finish_write(self, path: str, written_bytes: int, write_time: float):
+        with self._lock:
+            self._busy_threads -= 1
+            self._writes += 1
+            self._written_bytes += written_bytes
+            self._write_time += write_time
+            path_stats = self._paths[self.get_path_group(path)]
+            path_stats[2] += 1
+            path_stats[3] += written_bytes
+
+    def sample_queue(self, stop_event: threading.Event):
+        """Takes samples of the queue until `stop_event` is set"""
+        while not stop_event.wait(self._sample_interval):
+            with self._lock:
+                self._queue_samples.append((
+                    round(time() - self.started_at, 3), self._queued_tasks.value, self._data_size.value,
+                    self._busy_threads
+                ))
+                if len(self._queue_samples) >= QUEUE_SAMPLES:
+                    del self._queue_samples[::2]
+                    self._sample_interval *= 2
+
+    def get_snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            uptime = time() - self.started_at
+            return {
+                'uptime_seconds': round(uptime, 3),
+                'threads': self.num_threads,
+                # Share of the time the threads spent writing
+                'utilization': round(self._write_time / (uptime * self.num_threads), 4) if uptime else 0,
+                'writes': self._writes,
+                'written_bytes': self._written_bytes,
+                'write_seconds': round(self._write_time, 3),
+                'producer_wait_seconds': round(self._producer_wait.value, 3),
+                'queued_tasks': self._queued_tasks.value,
+                'queued_size': self._data_size.value,
+                'paths': {
+                    group: dict(zip(('queued_tasks', 'queued_size', 'writes', 'written_bytes'), path_stats))
+                    for group, path_stats in sorted(self._paths.items())
+                },
+                'queue_samples': [
+                    dict(zip(('seconds', 'queued_tasks', 'queued_size', 'busy_threads'), sample))
+                    for sample in self._queue_samples
+                ],
+            }
+
+
+class _FileHandles:
+    """
+    Files of the writer process, kept open between writes. Only used by the thread that owns the path,
+    while the least recently used idle files are closed beyond `max_open_files`
+    """
+
+    def __init__(self, max_open_files: int, buffer_size: int, fsync_interval: float | None, num_threads: int):
+        self.max_open_files = max_open_files
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self._files: OrderedDict[str, BinaryIO] = OrderedDict()
+        self._synced_at: dict[str, float] = {}
+        # Uncompressed sizes of the compressed files written so far
+        self._uncompressed_sizes: dict[str, int] = {}
+        self._lock = threading.Lock()
+        # Blocks of compressed files. Not the pool of the writer threads, which would wait here for themselves
+        self._compressor = ThreadPoolExecutor(max_workers=num_threads)
+
+    def _open(self, path: str) -> BinaryIO:
+        with self._lock:
+            file = self._files.get(path)
+            if file is not None:
+                self._files.move_to_end(path)
+                return file
+
+        os.makedirs(os.path.dirname(mkpath(path)), exist_ok=True)
+        # Stays open until `close`
+        file = open(mkpath(path), 'ab', buffering=self.buffer_size)  # noqa: SIM115
+        with self._lock:
+            self._files[path] = file
+            self._synced_at[path] = perf_counter()
+        return file
+
+    def write(self, path: str, tasks: list[_WriteTask]) -> int:
+        """Writes the tasks in one go (only the first one may overwrite the file), returns the bytes written"""
+        file = self._open(path)
+        if not tasks[0].append:
+            file.truncate(0)
+
+        ext = get_compression_ext(path)
+        if ext is None:
+            written_bytes = self._write_tasks(file, tasks)
+        else:
+            written_bytes = self._write_compressed(path, file, tasks, ext)
+        file.flush()
+
+        if self.fsync_interval is not None and perf_counter() - self._synced_at[path] >= self.fsync_interval:
+            os.fsync(file.fileno())
+            self._synced_at[path] = perf_counter()
+        return written_bytes
+
+    @staticmethod
+    def _write_tasks(file: BinaryIO, tasks: list[_WriteTask]) -> int:
+        written_bytes = 0
+        for task in tasks:
+            if isinstance(task.data, _SharedPayload):
+                written_bytes += task.data.write_to(file)
+            else:
+                written_bytes += file.write(task.data.encode('utf-8') if isinstance(task.data, str) else task.data)
+        return written_bytes
+
+    def _write_compressed(self, path: str, file: BinaryIO, tasks: list[_WriteTask], ext: str) -> int:
+        """Compresses the data as blocks in parallel, and records their ends in the index"""
+        buffer = io.BytesIO()
+        self._write_tasks(buffer, tasks)
+        data = buffer.getbuffer()
+
+        if not tasks[0].append:
+            uncompressed_end = 0
+        elif (uncompressed_end := self._uncompressed_sizes.get(path, -1)) == -1:
+            # Appending to a file from before this writer
+            index = read_index(path)
+            uncompressed_end = index[-1][1] if index else 0
+        file.flush()
+        compressed_start = compressed_end = os.fstat(file.fileno()).st_size
+
+        blocks = [data[start:start + BLOCK_SIZE] for start in range(0, len(data), BLOCK_SIZE)]
+        if not blocks and not compressed_start:
+            # An empty file is not a valid `.xz` or `.bz2` stream, a compressed empty block is
+            blocks.append(data[:0])
+
+        block_ends = []
+        for block, compressed_block in zip(blocks, self._compressor.map(partial(compress_block, ext), blocks)):
+            file.write(compressed_block)
+            compressed_end += len(compressed_block)
+            uncompressed_end += len(block)
+            block_ends.append((compressed_end, uncompressed_end))
+            block.release()
+        data.release()
+
+        append_index(path, block_ends, overwrite=not tasks[0].append)
+        self._uncompressed_sizes[path] = uncompressed_end
+        return compressed_end - compressed_start
+
+    def close(self, path: str):
+        with self._lock:
+            file = self._files.pop(path, None)
+            self._synced_at.pop(path, None)
+        if file is not None:
+            with suppress(OSError):
+                self._sync_and_close(file)
+
+    def pop_idle(self, busy_paths: Container[str]) -> list[BinaryIO]:
+        """Takes the least recently used files beyond `max_open_files` that are not written to, to be closed"""
+        idle_files = []
+        with self._lock:
+            for path in list(self._files):
+                if len(self._files) <= self.max_open_files:
+                    break
+                if path not in busy_paths:
+                    idle_files.append(self._files.pop(path))
+                    self._synced_at.pop(path)
+        return idle_files
+
+    def _sync_and_close(self, file: BinaryIO):
+        # Data is flushed after every write, so the file has nothing buffered
+        if self.fsync_interval is not None:
+            os.fsync(file.fileno())
+        file.close()
+
+    def close_files(self, files: list[BinaryIO]):
+        for file in files:
+            self._sync_and_close(file)
+
+    def close_all(self):
+        with self._lock:
+            files = list(self._files.values())
+            self._files.clear()
+        self.close_files(files)
+        self._compressor.shutdown()
+
+
 class FileWriter:
-    _queue: Queue          # type: ignore
-    _stop_event: Event     # type: ignore
+    """
+    Writes files in a separate process, so that the workers do not wait for the disk.
+    Producers wait on a condition while the queue is over `_max_size`, and are woken as soon as a write finishes.
+    The writer keeps an ordered queue for every path: writes to the same path happen one after another
+    in the order they were queued, and threads only take paths that nobody else is writing to.
+    Files stay open, and appends queued for the same path are written together through one buffer
+    """
+
+    _queue: Queue            # type: ignore
     _process: Process
-    _data_size: Value      # type: ignore
-    _wait_lock: Lock       # type: ignore
-    _pending_tasks: Value  # type: ignore
+    # Guards the counters below, notified whenever a task is queued or written
+    _condition: Condition    # type: ignore
+    _data_size: Value        # type: ignore
+    # Producers inside `write_file`, tasks queued or being written
+    _pending_tasks: Value    # type: ignore
+    _queued_tasks: Value     # type: ignore
+    # Queued tasks by `get_path_slot`
+    _queued_path_tasks: Array  # type: ignore
+    _write_stats: Array      # type: ignore
+    # Seconds producers waited for capacity
+    _producer_wait: Value    # type: ignore
+    _histograms: dict[str, Array]  # type: ignore
+    # Parent's end of the pipe to the writer, which answers every message with its `_WriterStats`
+    _stats_connection: Connection
+    _stats_lock = threading.Lock()
+    # Sent by the writer when it stops
+    _final_stats: dict[str, Any] | None = None
     # _max_size: int = 1_000_000_000
     _max_size: int = 1_000_000_000_000
     _num_threads: int = 10
+    # Files kept open by the writer for further appends, and the buffer of each of them
+    _max_open_files: int = 64
+    _buffer_size: int = 1024 * 1024
+    # `queue`: data is pickled through the queue, `shared_memory`: large data is copied into a shared memory block
+    # and the writer writes it from there, only a small descriptor goes through the queue
+    _payload_mode: str = 'queue'
 
     @classmethod
-    def init(cls):
+    def init(cls, max_size: int | None = None, fsync_interval: float | None = None, payload_mode: str | None = None):
+        """
+        Starts the writer process. Every finished write is in the OS (visible to readers) even though the files
+        stay open. `fsync_interval` also makes them durable: 0 syncs every write, otherwise a file is synced
+        when its last sync is older than this many seconds, and when it is closed
+        """
+        if max_size is not None:
+            cls._max_size = max_size
+        if payload_mode is not None:
+            assert payload_mode in PAYLOAD_MODES, payload_mode
+            cls._payload_mode = payload_mode
+        if cls._payload_mode == 'shared_memory':
+            # Started before the workers, so that they share it, and the blocks created by one process
+            # and unlinked by the writer are tracked by the same one
+            resource_tracker.ensure_running()
+
         cls._queue = Queue()
-        cls._stop_event = Event()
-        cls._data_size = Value('i', 0)
-        cls._wait_lock = Lock()
-        cls._pending_tasks = Value('i', 0)
+        cls._condition = Condition()
+        cls._data_size = Value('q', 0, lock=False)
+        cls._pending_tasks = Value('i', 0, lock=False)
+        cls._queued_tasks = Value('i', 0, lock=False)
+        cls._queued_path_tasks = Array('i', PATH_TASK_SLOTS, lock=False)
+        # Writes, bytes written, seconds spent writing
+        cls._write_stats = Array('d', 3)
+        cls._producer_wait = Value('d', 0.0)
+        cls._histograms = {name: Array('q', HISTOGRAM_BUCKETS) for name in FILE_WRITER_HISTOGRAMS}
+        cls._stats_connection, writer_connection = Pipe()
+        cls._final_stats = None
 
         cls._process = Process(
-            target=cls._writer_worker,
-            args=(cls._queue, cls._stop_event, cls._data_size),
+            target=cls._writer_process,
+            args=(
+                cls._queue, cls._condition, cls._data_size, cls._queued_tasks, cls._queued_path_tasks,
+                cls._write_stats, cls._producer_wait, cls._histograms, writer_connection, cls._num_threads,
+                cls._max_open_files, cls._buffer_size, fsync_interval
+            ),
         )
         cls._process.start()
+        # Only the writer keeps it, so that the parent sees the pipe closed if the writer dies
+        writer_connection.close()
 
-        return (cls._queue, cls._data_size, cls._wait_lock, cls._pending_tasks)
+        return (
+            cls._queue, cls._condition, cls._data_size, cls._pending_tasks, cls._queued_tasks, cls._queued_path_tasks,
+            cls._producer_wait, cls._histograms, cls._max_size, cls._payload_mode
+        )
 
     @classmethod
-    def bind_worker(cls, queue, data_size, wait_lock, pending_tasks):
+    def bind_worker(
+        cls, queue, condition, data_size, pending_tasks, queued_tasks, queued_path_tasks, producer_wait, histograms,
+        max_size, payload_mode
+    ):
+        cls._payload_mode = payload_mode
         cls._queue = queue
+        cls._condition = condition
         cls._data_size = data_size
-        cls._wait_lock = wait_lock
         cls._pending_tasks = pending_tasks
+        cls._queued_tasks = queued_tasks
+        cls._queued_path_tasks = queued_path_tasks
+        cls._producer_wait = producer_wait
+        cls._histograms = histograms
+        cls._max_size = max_size
+
+    @staticmethod
+    def _writer_process(
+        queue, condition, data_size, queued_tasks, queued_path_tasks, write_stats, producer_wait, histograms,
+        stats_connection, num_threads, max_open_files, buffer_size, fsync_interval
+    ):
+        # Tasks of every path that is being written or waits for a thread, in order
+        path_tasks: dict[str, deque[_WriteTask]] = {}
+        path_tasks_lock = threading.Lock()
+        # Paths with tasks and no thread, `None` stops a thread
+        ready_paths: SimpleQueue[str | None] = SimpleQueue()
+        handles = _FileHandles(max_open_files, buffer_size, fsync_interval, num_threads)
+
+        stats = _WriterStats(num_threads, queued_tasks, data_size, producer_wait)
+        stats_send_lock = threading.Lock()
+        stop_sampling = threading.Event()
+
+        def stats_loop():
+            # Until the parent closes its end
+            with suppress(EOFError, OSError):
+                while True:
+                    stats_connection.recv()
+                    with stats_send_lock:
+                        stats_connection.send(stats.get_snapshot())
 
-    @classmethod
-    def _writer_worker(cls, queue, stop_event, data_size):
-        active_writes_lock = Lock()
-        active_writes_to: set[str] = set()
-
-        def worker_loop():
-            while True:
-                try:
-                    args, kwargs = queue.get(timeout=1)
-                except EmptyQueueException:
-                    if stop_event.is_set():
-                        break
-                    continue
-
-                path, data, *args = args
+        threading.Thread(target=stats_loop, daemon=True).start()
+        threading.Thread(target=stats.sample_queue, args=(stop_sampling,), daemon=True).start()
 
+        def write_loop():
+            while (path := ready_paths.get()) is not None:
                 while True:
-                    with active_writes_lock:
-                        if path not in active_writes_to:
-                            active_writes_to.add(path)
+                    with path_tasks_lock:
+                        tasks = path_tasks[path]
+                        if not tasks:
+                            del path_tasks[path]
+                            # Only paths without a thread may be closed
+                            idle_files = handles.pop_idle(path_tasks)
                             break
-                    sleep(1)
-
-                # print_async('[FileWriter] Writing to', path)
-                try:
-                    write_file(path, data, *args, **kwargs)
-                except Exception as e:
-                    print_async(f'[FileWriter] Error writing to {path}: {e}')
-                finally:
-                    with active_writes_lock:
-                        active_writes_to.remove(path)
-                    with data_size.get_lock():
-                        data_size.value -= len(data)
-                # print_async('[FileWriter] Finished writing to', path)
-
-        with ThreadPoolExecutor(max_workers=cls._num_threads) as executor:
-            futures = [executor.submit(worker_loop) for _ in range(cls._num_threads)]
+                        # Appends queued behind the first task are written together with it
+                        batch = [tasks.popleft()]
+                        while tasks and tasks[0].append:
+                            batch.append(tasks.popleft())
+
+                    with histograms['queue_wait_us'].get_lock():
+                        now = time()
+                        for task in batch:
+                            add_to_histogram(histograms['queue_wait_us'], (now - task.queued_at) * 1e6)
+
+                    # print_async('[FileWriter] Writing to', path)
+                    stats.start_write()
+                    start_time = perf_counter()
+                    written_bytes = 0
+                    try:
+                        written_bytes = handles.write(path, batch)
+                        write_time = perf_counter() - start_time
+
+                        with write_stats.get_lock():
+                            write_stats[0] += len(batch)
+                            write_stats[1] += written_bytes
+                            write_stats[2] += write_time
+                    except Exception as e:
+                        print_async(f'[FileWriter] Error writing to {path}: {e}')
+                        handles.close(path)
+                        for task in batch:
+                            if isinstance(task.data, _SharedPayload):
+                                with suppress(FileNotFoundError):
+                                    SharedMemory(task.data.name).unlink()
+                    finally:
+                        write_time = perf_counter() - start_time
+                        stats.finish_write(path, written_bytes, write_time)
+                        with histograms['write_latency_us'].get_lock():
+                            add_to_histogram(histograms['write_latency_us'], write_time * 1e6)
+                        with condition:
+                            data_size.value -= sum(task.size for task in batch)
+                            queued_tasks.value -= len(batch)
+                            queued_path_tasks[get_path_slot(path)] -= len(batch)
+                            condition.notify_all()
+                    # print_async('[FileWriter] Finished writing to', path)
+
+                handles.close_files(idle_files)
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(write_loop) for _ in range(num_threads)]
+
+            while (message := queue.get()) is not None:
+                path, *task_fields = message
+                task = _WriteTask(*task_fields)
+                stats.add_queued(path, task.size)
+                with path_tasks_lock:
+                    if path in path_tasks:
+                        # A thread is on it, or the path is already waiting for one
+                        path_tasks[path].append(task)
+                        continue
+                    path_tasks[path] = deque([task])
+                ready_paths.put(path)
+
+            # Paths queued before are taken first
+            for _ in range(num_threads):
+                ready_paths.put(None)
             for f in futures:
                 f.result()
 
+        handles.close_all()
+        stop_sampling.set()
+        # The final stats, `FileWriter.stop` waits for them
+        with stats_send_lock:
+            stats_connection.send(stats.get_snapshot())
+
     @classmethod
     @no_type_check
-    def write_file(cls, path: str, data: str | bytes, *args, **kwargs):
-        with cls._pending_tasks.get_lock():
-            cls._pending_tasks.value += 1
-
+    def write_file(cls, path: str, data: str | bytes, append: bool = False, binary: bool = False):
+        """Queues a write of `data` (text is written as UTF-8, so `binary` only tells what `data` is)"""
         cur_data_size = len(data)
-        with cls._wait_lock:
-            while cls._data_size.value and cls._data_size.value + cur_data_size > cls._max_size:
+
+        def has_capacity():
+            # A task larger than the limit still goes through when the queue is empty
+            return not cls._data_size.value or cls._data_size.value + cur_data_size <= cls._max_size
+
+        wait_start = perf_counter()
+        with cls._condition:
+            cls._pending_tasks.value += 1
+            if not has_capacity():
                 print_async(
                     '[FileWriter] Data queue too large, waiting... '
                     f'({cls._data_size.value:,d} + {cur_data_size:,d} > {cls._max_size:,d}, '
-                    f'{cls._queue.qsize()} tasks in queue, {cls._pending_tasks.value} pending)'
+                    f'{cls._queued_tasks.value} tasks in queue, {cls._pending_tasks.value} pending)'
                 )
-                sleep(1)
+                cls._condition.wait_for(has_capacity)
+
+            cls._data_size.value += cur_data_size
+            cls._queued_tasks.value += 1
+            cls._queued_path_tasks[get_path_slot(path)] += 1
+            queue_depth = cls._queued_tasks.value
+        wait_time = perf_counter() - wait_start
+        if wait_time:
+            with cls._producer_wait.get_lock():
+                cls._producer_wait.value += wait_time
 
-            with cls._data_size.get_lock():
-                cls._data_size.value += cur_data_size
+        if cls._payload_mode == 'shared_memory' and cur_data_size >= SHARED_PAYLOAD_MIN_SIZE:
+            # Encoded right here, instead of being pickled here and unpickled and encoded by the writer
+            data = _SharedPayload.create(data.encode('utf-8') if isinstance(data, str) else data)
 
-        cls._queue.put(((path, data, *args), kwargs))
+        cls._queue.put((path, data, append, time(), cur_data_size))
 
         # print_async(
         #     f'[FileWriter] New task: write to {path}. Tasks in queue: {cls._queue.qsize()}. '
         #     f'Total size of text: {cls._data_size.value} characters'
         # )
 
-        with cls._pending_tasks.get_lock():
+        with cls._condition:
             cls._pending_tasks.value -= 1
+            cls._condition.notify_all()
+
+        with cls._histograms['producer_wait_us'].get_lock():
+            add_to_histogram(cls._histograms['producer_wait_us'], wait_time * 1e6)
+        with cls._histograms['queue_depth'].get_lock():
+            add_to_histogram(cls._histograms['queue_depth'], queue_depth)
+
+    @classmethod
+    @no_type_check
+    def get_write_stats(cls) -> tuple[int, int, float]:
+        """Number of finished writes, bytes written and seconds spent writing"""
+        with cls._write_stats.get_lock():
+            writes, written_bytes, write_time = cls._write_stats[:]
+        return int(writes), int(written_bytes), write_time
+
+    @classmethod
+    @no_type_check
+    def get_histograms(cls) -> dict[str, list[int]]:
+        """Log2 histograms of `FILE_WRITER_HISTOGRAMS` (see `HISTOGRAM_BUCKETS`), from any process"""
+        histograms = {}
+        for name, histogram in cls._histograms.items():
+            with histogram.get_lock():
+                histograms[name] = histogram[:]
+        return histograms
+
+    @classmethod
+    @no_type_check
+    def get_stats(cls) -> dict[str, Any]:
+        """
+        Counters of the writer (bytes queued and written by path, queue samples, utilization of the threads),
+        from the parent at any time. After `stop`, the final ones
+        """
+        with cls._stats_lock:
+            if cls._final_stats is not None:
+                return cls._final_stats
+            cls._stats_connection.send(None)
+            return cls._stats_connection.recv()
+
+    @classmethod
+    @no_type_check
+    def flush(cls, paths: Iterable[str] | None = None):
+        """
+        Waits until everything queued so far (from any process) is written. With `paths`, only the writes to them
+        that were queued when it is called (by `write_file` calls that returned), other writes go on meanwhile
+        """
+        if paths is None:
+            with cls._condition:
+                cls._condition.wait_for(lambda: not cls._pending_tasks.value and not cls._queued_tasks.value)
+            return
+
+        slots = set(map(get_path_slot, paths))
+        with cls._condition:
+            cls._condition.wait_for(lambda: not any(cls._queued_path_tasks[slot] for slot in slots))
 
     @classmethod
     @no_type_check
     def stop(cls):
         print_async('[FileWriter] Termination requested, waiting for all writes to finish...')
-        while cls._pending_tasks.value:
-            print_async(cls._pending_tasks.value)
-            sleep(1)
-        cls._stop_event.set()
+        with cls._condition:
+            cls._condition.wait_for(lambda: not cls._pending_tasks.value)
+        cls._queue.put(None)
+        with cls._stats_lock:
+            cls._final_stats = cls._stats_connection.recv()
+            cls._stats_connection.close()
         cls._process.join()
         assert cls._data_size.value == 0, (
             f'[FileWriter] Not all writes have finished. '
             f'Total size: {cls._data_size.value} characters'
         )
-        print_async('[FileWriter] Stopped')
+
+        stats = cls._final_stats
+        histograms = cls.get_histograms()
+        print_async(
+            f'[FileWriter] Stopped. {stats["writes"]:,d} writes, {stats["written_bytes"]:,d} bytes '
+            f'in {stats["write_seconds"]:.1f} s, {stats["threads"]} threads {stats["utilization"]:.1%} utilized, '
+            f'producers waited {stats["producer_wait_seconds"]:.1f} s\n  '
+            + ', '.join(
+                f'{name} p50 < {get_histogram_percentile(histograms[name], 50):,d}, '
+                f'p99 < {get_histogram_percentile(histograms[name], 99):,d}, '
+                f'max < {get_histogram_percentile(histograms[name], 100):,d}'
+                for name in FILE_WRITER_HISTOGRAMS
+            )
+            + ''.join(
+                f'\n  {group}: {path_stats["queued_tasks"]:,d} tasks of {path_stats["queued_size"]:,d} queued, '
+                f'{path_stats["written_bytes"]:,d} bytes in {path_stats["writes"]:,d} writes'
+                for group, path_stats in sorted(
+                    stats['paths'].items(), key=lambda item: item[1]['written_bytes'], reverse=True
+                )
+            )
+        )
 
 
 # def _test_worker(i):
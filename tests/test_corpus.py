@@ -0,0 +1,30 @@
+import os
+
+from src.utils import append_to_manifest, write_file, empty_file, SHARDS_MANIFEST
+from src.corpus import encode_sentences, link_token_corpus, open_token_corpus, get_ids_path, get_vocab_path
+
+
+def test_shards_are_linked_to_word_freq_ids(tmp_path):
+    directory = str(tmp_path / 'sentences')
+    empty_file(os.path.join(directory, SHARDS_MANIFEST))
+
+    for shard_name, sentences in (
+        ('1.txt', [['бул', 'китеп'], ['мен', 'окуйм', 'китеп']]),
+        ('2.txt', [['китеп', 'бул']]),
+    ):
+        vocab = dict.fromkeys(word for sentence in sentences for word in sentence)
+        ids_data, vocab_data = encode_sentences(sentences, vocab)
+        write_file(get_ids_path(os.path.join(directory, shard_name)), ids_data, binary=True)
+        write_file(get_vocab_path(os.path.join(directory, shard_name)), vocab_data)
+        append_to_manifest(directory, [shard_name])
+
+    word_freq_path = str(tmp_path / 'word_freq.txt')
+    write_file(word_freq_path, 'китеп 3\nбул 2\nмен 1\nокуйм 1')
+
+    corpus_path = str(tmp_path / 'corpus.bin')
+    assert link_token_corpus(directory, word_freq_path, corpus_path) == 10
+
+    with open_token_corpus(corpus_path) as token_ids:
+        assert token_ids.tolist() == [2, 1, 0, 3, 4, 1, 0, 1, 2, 0]
+
+    assert not os.path.exists(get_ids_path(os.path.join(directory, '1.txt')))
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import Counter
+
+from src.counts import CountReducer, ShardedCounter, write_count_run, write_freq_file, get_unit_run_path
+
+
+def test_reduced_runs_match_counter(tmp_path):
+    directory = str(tmp_path / 'counts')
+    units = [
+        ['бул', 'китеп', 'бул'],
+        ['мен', 'китеп'],
+        ['окуйм', 'бул', 'мен'],
+        ['китеп'],
+        ['жаңы', 'китеп', 'жаңы'],
+    ]
+
+    expected: Counter[str] = Counter()
+    with ThreadPoolExecutor(2) as executor:
+        reducer = CountReducer('word_freq', directory)
+        for unit_num, words in enumerate(units, 1):
+            expected.update(words)
+            write_count_run(get_unit_run_path(directory, 'word_freq', unit_num), Counter(words))
+            reducer.add(executor, get_unit_run_path(directory, 'word_freq', unit_num))
+
+        while reducer.merging:
+            done, _ = wait(list(reducer.merging))
+            for future in done:
+                reducer.on_merged(executor, future)
+
+    runs = [path for path, _ in reducer.get_runs()]
+    assert len(runs) == 2
+
+    output_path = str(tmp_path / 'word_freq.txt')
+    assert write_freq_file(runs, output_path, block_size=2) == len(expected)
+
+    with open(output_path, 'r', encoding='utf-8') as file:
+        assert file.read() == '\n'.join(
+            f'{word} {freq}' for word, freq in sorted(expected.items(), key=lambda item: (-item[1], item[0]))
+        )
+
+
+def test_sharded_counter_is_thread_safe():
+    counter = ShardedCounter(num_shards=4)
+    words = [f'сөз{i % 50}' for i in range(1000)]
+
+    with ThreadPoolExecutor(8) as executor:
+        for _ in range(100):
+            executor.submit(counter.update, Counter(words).items())
+
+    assert len(counter) == 50
+    assert dict(counter.items()) == {word: count * 100 for word, count in Counter(words).items()}
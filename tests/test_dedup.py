@@ -0,0 +1,63 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from src.dedup import SharedHashSet, hash_key, get_minhash_bands, MINHASH_BINS, MINHASH_BAND_SIZE
+
+
+_worker_sets: list[SharedHashSet] = []
+
+
+def _init_worker(bind_args):
+    _worker_sets.append(SharedHashSet(*bind_args))
+
+
+def _add_new(keys, unit_num):
+    return _worker_sets[0].add_new(keys, unit_num)
+
+
+def test_shared_hash_set_across_processes():
+    shared_set = SharedHashSet.create(64)
+    with ProcessPoolExecutor(2, initializer=_init_worker, initargs=(shared_set.bind_args,)) as executor:
+        assert executor.submit(_add_new, [1, 2, 2, 3], 1).result() == [True, True, False, True]
+        assert executor.submit(_add_new, [3, 4, 65], 2).result() == [False, True, True]
+
+    assert shared_set.add_new([1, 4, 65, 129], 3) == [False, False, False, True]
+    assert len(shared_set) == 6
+
+
+def test_shared_hash_set_forgets_uncommitted_units(tmp_path):
+    path = str(tmp_path / 'hashes.bin')
+    shared_set = SharedHashSet.create(16)
+    shared_set.add_new([1, 17, 2], 1)
+    shared_set.add_new([3, 33], 2)
+    shared_set.save(path)
+
+    loaded_set = SharedHashSet.create(16)
+    loaded_set.load(path, max_unit_num=1)
+    # Hashes of unit 2 are new again, and probing still goes through their slots
+    assert loaded_set.add_new([1, 17, 2, 3, 33, 33], 2) == [False, False, False, True, True, False]
+
+
+def test_minhash_bands():
+    text = ' '.join(f'сөз{i}' for i in range(300))
+    near_duplicate = text.replace('сөз150', 'башка')
+    different = ' '.join(f'сөз{i}' for i in range(300, 600))
+
+    assert set(get_minhash_bands(text)) & set(get_minhash_bands(near_duplicate))
+    assert not set(get_minhash_bands(text)) & set(get_minhash_bands(different))
+    assert get_minhash_bands(text.upper()) == get_minhash_bands(text)
+    assert hash_key('') != 0
+
+
+def test_minhash_bands_of_short_texts():
+    # Every pair shares one of its 4 shingles (Jaccard similarity 1/7). 8 bands of 4 bins flag ~0.5% of them
+    # (measured over 20,000 pairs), up to 3% is allowed
+    flagged = 0
+    for i in range(1000):
+        common = ' '.join(f'жалпы{i}_{j}' for j in range(5))
+        text = common + ' ' + ' '.join(f'биринчи{i}_{j}' for j in range(3))
+        other = common + ' ' + ' '.join(f'экинчи{i}_{j}' for j in range(3))
+        flagged += bool(set(get_minhash_bands(text)) & set(get_minhash_bands(other)))
+    assert flagged < 30
+
+    assert len(get_minhash_bands('кыска')) == MINHASH_BINS // MINHASH_BAND_SIZE
+    assert get_minhash_bands('кыска текст') != get_minhash_bands('башка текст')
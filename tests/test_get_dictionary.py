@@ -0,0 +1,68 @@
+import sys
+import os
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+import pytest
+
+from src.utils import write_file
+from src import get_dictionary
+from src.get_dictionary import CompiledDictionary, _load_file, _parse_file
+
+
+DICTIONARY = '\n'.join([
+    'китеп', '├╴китептер', '├╴китепке', '├╴китептин',
+    'үй', '├╴үйлөр', '├╴үйгө',
+    'бала', '├╴балдар', '├╴балага',
+    'ат',
+])
+
+
+def _get_header(path):
+    compiled = CompiledDictionary(path)
+    compiled.close()
+    return compiled.header
+
+
+def test_compiled_dictionary(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_dictionary, 'DICTIONARIES_DIR', str(tmp_path))
+    path = get_dictionary.get_dictionary_path('test')
+    write_file(path, DICTIONARY)
+
+    expected_dictionary, expected_word_to_base = _parse_file('test')
+    dictionary, word_to_base = _load_file('test')
+
+    assert dict(dictionary) == expected_dictionary
+    assert dict(dictionary.items()) == expected_dictionary
+    assert dict(word_to_base) == expected_word_to_base
+    assert len(dictionary) == 4 and len(word_to_base) == 11
+    assert list(word_to_base) == sorted(expected_word_to_base, key=lambda word: word.encode('utf-8'))
+
+    assert word_to_base['балдар'] == 'бала'
+    assert dictionary['ат'] == []
+    assert 'китеп' in dictionary and 'китептер' not in dictionary
+    assert word_to_base.get('китептерди') is None
+    with pytest.raises(KeyError):
+        word_to_base['']
+    with pytest.raises(KeyError):
+        dictionary['үйлөр']
+
+    # Touched only: the same cache, stamped again without being compiled. The mappings of the previous load
+    # are released first, Windows does not replace a mapped file
+    del dictionary, word_to_base
+    cache_path = get_dictionary.get_dictionary_cache_path('test')
+    digest = _get_header(cache_path)['digest']
+    os.utime(path, ns=(0, 0))
+    dictionary, word_to_base = _load_file('test')
+    header = _get_header(cache_path)
+    assert header['source'] == get_dictionary.get_file_stamp(path) and header['digest'] == digest
+    assert word_to_base['үйгө'] == 'үй'
+
+    # Changed: compiled again
+    del dictionary, word_to_base
+    write_file(path, DICTIONARY + '\nжол\n├╴жолдор')
+    dictionary, word_to_base = _load_file('test')
+    assert _get_header(cache_path)['digest'] != digest
+    assert word_to_base['жолдор'] == 'жол'
+    assert dictionary['жол'] == ['жолдор']
@@ -0,0 +1,60 @@
+import time
+import os
+
+import pytest
+
+from src.prefetch import Prefetcher
+
+
+def test_prefetcher_is_bounded_by_size():
+    produced = []
+
+    def iter_items():
+        for i in range(10):
+            produced.append(i)
+            yield b'x' * 100
+
+    prefetcher = Prefetcher(iter_items(), max_items=5, max_bytes=250, get_size=len)
+    time.sleep(0.1)
+    # Three items reach the limit, the thread waits before producing the fourth
+    assert len(produced) == 3
+
+    items = []
+    while (item := prefetcher.get()) is not None:
+        items.append(item)
+    assert len(items) == 10
+    assert prefetcher.is_done()
+    prefetcher.close()
+
+
+def test_prefetcher_raises_errors_of_iterator():
+    def iter_items():
+        yield 1
+        raise ValueError('broken input')
+
+    prefetcher = Prefetcher(iter_items(), max_items=2, max_bytes=100, get_size=lambda _: 1)
+    assert prefetcher.get() == 1
+    with pytest.raises(ValueError):
+        prefetcher.get()
+    prefetcher.close()
+
+
+def test_run_raises_errors_of_source(tmp_path, monkeypatch):
+    import run
+    from src.utils import FileWriter
+
+    def iter_file_texts(_paths):
+        for i in range(20):
+            yield f'Бул {i} текст. Ал кыргызча жазылган.'
+        raise ValueError('broken input')
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(run, 'iter_file_texts', iter_file_texts)
+    with pytest.raises(ValueError):
+        run.main(files=['texts.jsonl'], unit_chars=50, checkpoint_every=5, executor_type='threads')
+
+    # The writer process is stopped (the interpreter would wait for it), nothing is finalized,
+    # and the last checkpoint is kept for `--resume`
+    assert not FileWriter._process.is_alive()
+    assert not os.path.exists('results/word_freq.txt')
+    assert os.path.isfile(run.CHECKPOINT_PATH)
@@ -0,0 +1,16 @@
+from src.quality import QualityThresholds, check_text, get_char_histogram
+
+
+def test_char_histogram():
+    assert get_char_histogram('Бүгүн 5 km!') == {'k': 2, 'c': 3, 'a': 2, 'd': 1, ' ': 2, 'o': 1}
+
+
+def test_check_text():
+    thresholds = QualityThresholds(min_chars=10, max_chars=200)
+
+    assert check_text('Бүгүн аба ырайы жакшы, күн ачык болот.', thresholds) is None
+    assert check_text('Бүгүн', thresholds) == 'too_short'
+    assert check_text('Бүгүн аба ырайы жакшы. ' * 10, thresholds) == 'too_long'
+    assert check_text('12.06.2024 | 15:30 | 100 000 сом', thresholds) == 'few_letters'
+    assert check_text('The weather is nice today, бүгүн', thresholds) == 'not_cyrillic'
+    assert check_text('Сегодня хорошая погода, солнечно.', thresholds) == 'not_kyrgyz'
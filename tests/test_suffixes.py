@@ -0,0 +1,125 @@
+from typing import Iterable
+
+from functools import cache
+import random
+import sys
+import os
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.suffixes import SuffixTrie
+from src.utils import write_file
+from src import get_dictionary, suffixes
+
+
+class DictSuffixTrie:
+    """
+    Reference for the tests, and the previous `SuffixTrie` for `scripts/benchmark_suffix_trie.py`:
+    nested dicts with a `'$'` key at the end of every suffix, unbounded cache
+    """
+
+    TrieType = dict[str, 'TrieType']
+
+    def __init__(self, suffixes: Iterable[str]):
+        self.trie: DictSuffixTrie.TrieType = {}
+        for suffix in suffixes:
+            node: DictSuffixTrie.TrieType = self.trie
+            for char in reversed(suffix):
+                node = node.setdefault(char, {})
+            node['$'] = {}
+
+    @cache  # noqa
+    def remove_suffix(self, word: str) -> tuple[str, str]:
+        node = self.trie
+        longest_index = len(word)
+
+        for i in range(len(word) - 1, -1, -1):
+            char = word[i]
+            if char not in node:
+                break
+            node = node[char]
+            if '$' in node:
+                longest_index = i
+
+        return word[:longest_index], word[longest_index:]
+
+
+SUFFIXES = ('лар', 'лардын', 'дын', 'га', 'ча', 'а')
+
+
+def test_remove_longest_suffix():
+    trie = SuffixTrie(SUFFIXES, cache_size=2)
+
+    assert trie.remove_suffix('балдардын') == ('балдар', 'дын')
+    assert trie.remove_suffix('китептерлардын') == ('китептер', 'лардын')
+    assert trie.remove_suffix('кыргызча') == ('кыргыз', 'ча')
+    assert trie.remove_suffix('үй') == ('үй', '')
+    assert trie.remove_suffix('') == ('', '')
+
+    # The whole word may be a suffix
+    assert trie.remove_suffix('лардын') == ('', 'лардын')
+    for word in ('лардын', 'ардын', 'а', 'лар'):
+        stem, suffix = trie.remove_suffix(word)
+        assert stem + suffix == word
+        assert suffix == max((s for s in SUFFIXES if word.endswith(s)), key=len, default='')
+
+    assert trie.remove_suffix.cache_info().currsize == 2
+
+
+def test_remove_suffixes():
+    trie = SuffixTrie(SUFFIXES)
+    words = ['шаарга', 'үй', 'шаарга', 'жолдордун']
+    assert trie.remove_suffixes(words) == [trie.remove_suffix(word) for word in words]
+    assert trie.remove_suffix.cache_info().currsize == 3
+
+
+def test_random_suffixes():
+    rng = random.Random(0)
+    alphabet = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюяңөү'
+    for _ in range(300):
+        letters = rng.sample(alphabet, rng.randint(1, 8))
+        suffixes = [''.join(rng.choices(letters, k=rng.randint(1, 5))) for _ in range(rng.randint(1, 30))]
+        words = [''.join(rng.choices(letters + ['x'], k=rng.randint(0, 8))) for _ in range(50)]
+
+        trie = SuffixTrie(suffixes, cache_size=0)
+        dict_trie = DictSuffixTrie(suffixes)
+        for word in words + suffixes:
+            assert trie.remove_suffix(word) == dict_trie.remove_suffix(word), (suffixes, word)
+
+
+def test_trie_is_saved_and_mapped(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_dictionary, 'DICTIONARIES_DIR', str(tmp_path))
+    monkeypatch.setattr(suffixes, 'SUFFIXES_PATH', str(tmp_path / 'suffixes.txt'))
+    for name in (get_dictionary.KAIKKI_TILI, get_dictionary.KYRGYZ_TILI):
+        write_file(get_dictionary.get_dictionary_path(name), 'китеп\n├╴китептерди\n├╴китепке\n')
+    path = str(tmp_path / 'suffix_trie.bin')
+
+    built = SuffixTrie(path=path)
+    mapped = SuffixTrie(path=path)
+    assert mapped._mmap is not None
+    for word in ('китептерди', 'үйгө', 'балдардын', 'кыргызча', 'Ош'):
+        assert mapped.remove_suffix(word) == built.remove_suffix(word)
+    assert mapped.remove_suffix('окуучутерди') == ('окуучу', 'терди')
+
+    # Touched only: still mapped
+    os.utime(get_dictionary.get_dictionary_path(get_dictionary.KAIKKI_TILI), ns=(0, 0))
+    touched = SuffixTrie(path=path)
+    assert touched._mmap is not None
+    assert touched.remove_suffix('окуучутерди') == ('окуучу', 'терди')
+    mapped.close()
+    touched.close()
+
+    # Changed: built again
+    write_file(get_dictionary.get_dictionary_path(get_dictionary.KAIKKI_TILI), 'үй\n├╴үйлөрдү\n')
+    rebuilt = SuffixTrie(path=path)
+    assert rebuilt._mmap is None
+    assert rebuilt.remove_suffix('балдарлөрдү') == ('балдар', 'лөрдү')
+    assert SuffixTrie(path=path)._mmap is not None
+
+    # Hand-made suffixes changed: built again, although the dictionaries did not
+    monkeypatch.setattr(suffixes, 'HANDMADE_SUFFIXES', suffixes.HANDMADE_SUFFIXES | {'зырп'})
+    rebuilt = SuffixTrie(path=path)
+    assert rebuilt._mmap is None
+    assert rebuilt.remove_suffix('үйзырп') == ('үй', 'зырп')
+    assert SuffixTrie(path=path)._mmap is not None
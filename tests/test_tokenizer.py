@@ -1,5 +1,6 @@
 import jstyleson as json
 import pytest
+import random
 import sys
 import os
 
@@ -9,10 +10,16 @@ if __name__ == '__main__':
 from src.utils import PathMagic
 mkpath = PathMagic(__file__)
 
-from src.tokenizer import Tokenizer
+from src.tokenizer import Tokenizer, LinearTokenizer
+from src.normalization import normalize, TRANSLATION_TABLE
 
 
-tokenizer = Tokenizer()
+# Characters that matter for the patterns: letters of both cases and scripts, digits (also non-ASCII),
+# separators, whitespace, word characters outside of the patterns and replaced characters
+FUZZ_ALPHABET = [
+    *'аяАЯңӨёzZ 1 9.:,.\n\t!?…(|_é٣²\u0301\xa0\u2028\x1cѳї',
+    '..', '. ', ' .', 'а.', 'Б.', '1.', ': ',
+]
 
 
 def get_test_cases():
@@ -26,8 +33,9 @@ def get_test_cases():
     return cases
 
 
+@pytest.mark.parametrize('tokenizer', (Tokenizer, LinearTokenizer))
 @pytest.mark.parametrize('case_name', get_test_cases())
-def test_tokenizer_case(case_name):
+def test_tokenizer_case(case_name, tokenizer):
     with open(mkpath(f'data/{case_name}.txt'), encoding='utf-8') as f:
         text = f.read()
 
@@ -39,6 +47,48 @@ def test_tokenizer_case(case_name):
     assert output == expected, f'\n{output}\n\n{expected}'
 
 
+@pytest.mark.parametrize('tokenizer', (Tokenizer, LinearTokenizer))
+def test_tokenize_batch_matches_process_text(tokenizer):
+    texts = []
+    for case_name in get_test_cases():
+        with open(mkpath(f'data/{case_name}.txt'), encoding='utf-8') as f:
+            texts.append(f.read())
+    texts.extend(['', 'ѳ 1.5 кг. Бул - а.б.', '?!'])
+
+    vocab: dict[str, int] = {}
+    spans = tokenizer.tokenize_batch(texts, vocab)
+    words = list(vocab)
+
+    expected = [(text_id, sentence) for text_id, text in enumerate(texts) for sentence in tokenizer.process_text(text)]
+    sentences = list(spans.iter_sentences())
+    assert [(spans.text_ids[sentence[0]], [spans.get_token(i) for i in sentence]) for sentence in sentences] == expected
+    assert [[words[spans.token_ids[i]] for i in sentence] for sentence in sentences] == [s for _, s in expected]
+    assert list(spans.sentence_ids) == [sentence_id for sentence_id, sentence in enumerate(sentences) for _ in sentence]
+
+
+def test_fold_case_matches_lower():
+    texts = ['ѳ Бул КИТЕП, Ѳзгөчө Їй. İstanbul ΣΑΣ']
+    vocab: dict[str, int] = {}
+    spans = Tokenizer.tokenize_batch(texts, vocab, fold_case=True)
+    words = list(vocab)
+
+    assert spans.token_ids is not None
+    tokens = [spans.get_token(i) for i in range(len(spans.token_ids))]
+    assert tokens == [word for sentence in Tokenizer.process_text(texts[0]) for word in sentence]
+    assert [words[token_id] for token_id in spans.token_ids] == [normalize(token, fold_case=True) for token in tokens]
+    for token in tokens:
+        if token != 'İstanbul':
+            assert normalize(token, fold_case=True) == token.translate(TRANSLATION_TABLE).lower()
+
+
+def test_linear_tokenizer_matches_regex():
+    rng = random.Random(0)
+    for _ in range(20_000):
+        text = ''.join(rng.choices(FUZZ_ALPHABET, k=rng.randint(0, 30)))
+        assert list(LinearTokenizer.process_text(text)) == list(Tokenizer.process_text(text)), repr(text)
+
+
 if __name__ == '__main__':
     for case_name in get_test_cases():
-        test_tokenizer_case(case_name)
+        test_tokenizer_case(case_name, Tokenizer)
+        test_tokenizer_case(case_name, LinearTokenizer)
@@ -0,0 +1,178 @@
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+import lzma
+import gzip
+import bz2
+import sys
+import os
+
+if __name__ == '__main__':
+    sys.path.append('../')
+
+from src.utils import (
+    append_to_manifest, compact_shards, get_shard_paths, get_shards_size, iter_shards_lines, write_file, empty_file,
+    SHARDS_MANIFEST, FileWriter
+)
+from src.compression import open_text, read_index
+from src import utils
+
+
+def test_shards_are_read_in_manifest_order(tmp_path):
+    directory = str(tmp_path / 'sentences')
+    empty_file(os.path.join(directory, SHARDS_MANIFEST))
+
+    write_file(os.path.join(directory, '2.txt'), 'c d\n')
+    write_file(os.path.join(directory, '1.txt'), 'a b\n')
+    # Not listed in the manifest (unfinished), must be ignored
+    write_file(os.path.join(directory, '3.txt'), 'e f\n')
+
+    append_to_manifest(directory, ['1.txt'])
+    append_to_manifest(directory, ['2.txt'])
+
+    assert [os.path.basename(path) for path in get_shard_paths(directory)] == ['1.txt', '2.txt']
+    assert list(iter_shards_lines(directory)) == ['a b\n', 'c d\n']
+    assert get_shards_size(directory) == 8
+
+    output_path = str(tmp_path / 'sentences.txt')
+    assert compact_shards(directory, output_path) == 8
+    with open(output_path, 'r', encoding='utf-8') as file:
+        assert file.read() == 'a b\nc d\n'
+
+
+def _write_lines(args):
+    directory, producer = args
+    for i in range(200):
+        FileWriter.write_file(os.path.join(directory, f'{i % 2}.txt'), f'{producer} {i}\n' * 10, append=True)
+
+
+def test_file_writer_keeps_order_of_every_path(tmp_path):
+    directory = str(tmp_path)
+    # Only a few tasks fit in the queue, so producers have to wait for the writer
+    bind_args = FileWriter.init(max_size=500)
+    with ProcessPoolExecutor(3, initializer=FileWriter.bind_worker, initargs=bind_args) as executor:
+        list(executor.map(_write_lines, [(directory, producer) for producer in range(3)]))
+
+    FileWriter.flush()
+    # Readable while the writer runs
+    assert FileWriter.get_stats()['queued_tasks'] == 0
+    FileWriter.stop()
+
+    for path_num in range(2):
+        with open(os.path.join(directory, f'{path_num}.txt'), 'r', encoding='utf-8') as file:
+            lines = [tuple(map(int, line.split())) for line in file]
+        assert len(lines) == 3 * 100 * 10
+        for producer in range(3):
+            numbers = [i for line_producer, i in lines if line_producer == producer]
+            assert numbers == sorted(numbers)
+
+    histograms = FileWriter.get_histograms()
+    assert sum(histograms['queue_depth']) == sum(histograms['queue_wait_us']) == 3 * 200
+    # Names that differ by numbers are counted together
+    stats = FileWriter.get_stats()
+    path_stats = stats['paths'][os.path.join(directory, '*.txt')]
+    assert list(stats['paths']) == [os.path.join(directory, '*.txt')]
+    assert path_stats['queued_tasks'] == 3 * 200
+    assert path_stats['written_bytes'] == sum(os.path.getsize(os.path.join(directory, f'{i}.txt')) for i in range(2))
+    assert sum(histograms['write_latency_us']) == path_stats['writes'] == stats['writes']
+    assert 0 < stats['utilization'] <= 1
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='needs named pipes')
+def test_file_writer_flushes_only_given_paths(tmp_path):
+    FileWriter.init()
+    # Opening a named pipe for writing blocks until it is read
+    blocked_path = str(tmp_path / 'blocked.txt')
+    os.mkfifo(blocked_path)
+    FileWriter.write_file(blocked_path, 'blocked\n', append=True)
+    path = str(tmp_path / 'shard.txt')
+    FileWriter.write_file(path, 'shard\n')
+
+    FileWriter.flush([path])
+    with open(path, 'r', encoding='utf-8') as file:
+        assert file.read() == 'shard\n'
+    assert FileWriter.get_stats()['queued_tasks'] == 1
+
+    # The writer keeps the pipe open, there is no end of file
+    with open(blocked_path, 'r', encoding='utf-8') as file:
+        assert file.readline() == 'blocked\n'
+    FileWriter.flush([blocked_path])
+    FileWriter.stop()
+
+
+def test_file_writer_appends_and_overwrites(tmp_path, monkeypatch):
+    # More paths than open files, so that idle files are closed and opened again
+    monkeypatch.setattr(FileWriter, '_max_open_files', 2)
+    FileWriter.init(fsync_interval=0)
+
+    paths = [os.path.join(str(tmp_path), 'dir', f'{i}.txt') for i in range(5)]
+    for path in paths:
+        FileWriter.write_file(path, 'old\n')
+    FileWriter.flush()
+    for path in paths:
+        FileWriter.write_file(path, 'а\n', append=True)
+        FileWriter.write_file(path, b'b\n', append=True, binary=True)
+    # Appends after an overwrite are written together with it
+    FileWriter.write_file(paths[0], 'new\n')
+    FileWriter.write_file(paths[0], 'c\n', append=True)
+    FileWriter.stop()
+
+    with open(paths[0], 'r', encoding='utf-8') as file:
+        assert file.read() == 'new\nc\n'
+    for path in paths[1:]:
+        with open(path, 'r', encoding='utf-8') as file:
+            assert file.read() == 'old\nа\nb\n'
+
+
+def test_file_writer_shared_memory_payloads(tmp_path, monkeypatch):
+    # Restored after the test
+    monkeypatch.setattr(FileWriter, '_payload_mode', FileWriter._payload_mode)
+    bind_args = FileWriter.init(payload_mode='shared_memory')
+    path = os.path.join(str(tmp_path), 'sentences.txt')
+    data = 'сөз\n' * 100_000
+    with ProcessPoolExecutor(1, initializer=FileWriter.bind_worker, initargs=bind_args) as executor:
+        executor.submit(FileWriter.write_file, path, data).result()
+    # Small data goes through the queue
+    FileWriter.write_file(path, 'а\n', append=True)
+    FileWriter.stop()
+
+    with open(path, 'r', encoding='utf-8') as file:
+        assert file.read() == data + 'а\n'
+
+
+@pytest.mark.parametrize('ext', ['.gz', '.xz', '.bz2'])
+def test_file_writer_compressed_blocks(tmp_path, monkeypatch, ext):
+    # Several blocks per write
+    monkeypatch.setattr(utils, 'BLOCK_SIZE', 1000)
+    FileWriter.init()
+
+    directory = str(tmp_path / 'sentences')
+    empty_file(os.path.join(directory, SHARDS_MANIFEST))
+    lines = [f'{i} сүйлөм\n' for i in range(1000)]
+    FileWriter.write_file(os.path.join(directory, f'1.txt{ext}'), 'old\n')
+    FileWriter.write_file(os.path.join(directory, f'1.txt{ext}'), ''.join(lines[:300]))
+    FileWriter.write_file(os.path.join(directory, f'1.txt{ext}'), ''.join(lines[300:600]), append=True)
+    FileWriter.write_file(os.path.join(directory, f'2.txt{ext}'), ''.join(lines[600:]))
+    # E.g. every sentence of a unit was a duplicate
+    FileWriter.write_file(os.path.join(directory, f'3.txt{ext}'), '')
+    FileWriter.stop()
+    append_to_manifest(directory, [f'1.txt{ext}', f'3.txt{ext}', f'2.txt{ext}'])
+    # Numbers of the extensions are kept
+    assert list(FileWriter.get_stats()['paths']) == [os.path.join(directory, f'*.txt{ext}')]
+
+    # Readable by the standard tools, block after block
+    with {'.gz': gzip, '.xz': lzma, '.bz2': bz2}[ext].open(os.path.join(directory, f'1.txt{ext}'), 'rt') as file:
+        assert file.read() == ''.join(lines[:600])
+    with {'.gz': gzip, '.xz': lzma, '.bz2': bz2}[ext].open(os.path.join(directory, f'3.txt{ext}'), 'rt') as file:
+        assert file.read() == ''
+    assert list(iter_shards_lines(directory)) == lines
+
+    output_path = str(tmp_path / f'sentences.txt{ext}')
+    compact_shards(directory, output_path)
+    index = read_index(output_path)
+    assert len(index) > 3 and index[-1] == (os.path.getsize(output_path), len(''.join(lines).encode('utf-8')))
+
+    offset = len(''.join(lines[:700]).encode('utf-8'))
+    with open_text(output_path, offset) as file:
+        assert file.read() == ''.join(lines[700:])
+    with open_text(output_path, index[-1][1]) as file:
+        assert file.read() == ''